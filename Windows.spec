@@ -9,7 +9,8 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('data/template_config.ini', 'data'), ('vendor/lame.exe', 'vendor')],
-    hiddenimports=[],
+    # Loaded by name, when they're first used (see model.LAZY_CLASSES)
+    hiddenimports=['tagger', 'encoder'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""Time PostShow's hot paths on synthetic recordings and marker files.
+
+Run it from anywhere, with PostShow's dependencies installed:
+
+    python benchmarks/bench.py --quick --output baseline.json
+    python benchmarks/bench.py --quick --baseline baseline.json
+
+The results are written as JSON.  Given a baseline from an earlier run, each
+benchmark is compared against it, and the exit status is 1 if anything got
+slower by more than the tolerance.
+
+Startup is checked too: importing ``main`` (which is what launching the wizard
+waits for) has to fit in the import budget, and mustn't load the tagger,
+encoder or anything else that's only needed later.  The exit status is 1 if it
+doesn't.
+
+If LAME isn't where PostShow looks for it, a stand-in encoder is used, which
+writes silent frames.  Encoding times then measure PostShow's own overhead
+(reading and streaming the PCM, and indexing the frames), not LAME's.
+"""
+
+import argparse
+import array
+import json
+import math
+import os
+import platform
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(HERE, "..", "src", "postshow")
+sys.path.insert(0, SOURCE)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import config  # noqa: E402
+from main import Controller  # noqa: E402
+import model  # noqa: E402
+
+STANDIN_LAME = os.path.join(HERE, "standin_lame.py")
+# Recording lengths, in seconds
+DURATIONS = [60, 600, 3600, 4 * 3600]
+QUICK_DURATIONS = [60, 600]
+MARKER_COUNTS = [10, 1000, 10000, 50000]
+QUICK_MARKER_COUNTS = [10, 1000]
+# How many chapters go in the tag when timing tagging at each length
+TAG_CHAPTERS = 100
+SAMPLE_RATE = 44100
+BITRATE = "64"
+# Anything quicker than this is mostly timer noise.
+NOISE_SECONDS = 0.005
+# How long importing ``main`` may take, in a fresh interpreter
+IMPORT_BUDGET_SECONDS = 1.0
+# Modules that are only needed once encoding starts, so importing ``main``
+# mustn't load them.
+LAZY_MODULES = [
+    "mutagen",
+    "tagger",
+    "encoder",
+    "publish",
+    "MetadataPage",
+    "FinishPage",
+]
+STARTUP_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {source!r})
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "loaded": [name for name in {lazy!r} if name in sys.modules],
+}}))
+"""
+MARKER_LOADERS = ["txt", "lrc"]
+MARKER_SAVERS = {
+    "audacity": (model.MCS.AUDACITY, "txt"),
+    "lrc": (model.MCS.LRC, "lrc"),
+    "cue": (model.MCS.CUE, "cue"),
+    "simple": (model.MCS.SIMPLE, "txt"),
+    "ffmetadata1": (model.MCS.FFMETADATA1, "ffmetadata"),
+    "json": (model.MCS.JSON_CHAPTERS, "json"),
+}
+CONFIG = """[default]
+slug = BENCH
+filename = {slug}-{epnum}.{ext}
+bitrate = 64
+language = eng
+title = {slug}-{epnum} {name}
+album = Benchmarks
+artist = PostShow
+season = 1
+genre = Podcast
+write_date = True
+write_trackno = True
+lyrics_equals_comment = True
+"""
+
+
+class NullProgress:
+    """Stands in for the encoder's progress emitter."""
+
+    def set_progress(self, value):
+        pass
+
+    def set_finished(self):
+        pass
+
+
+class NullSignal:
+    """Stands in for the tagger's progress signal."""
+
+    def __init__(self):
+        self.progressed = self
+
+    def emit(self, value):
+        pass
+
+
+def make_wav(path: str, seconds: int, channels: int = 2) -> None:
+    """Write a 16-bit WAV of a quiet, slowly warbling tone."""
+    one_second = array.array(
+        "h",
+        (
+            int(6000 * math.sin(2 * math.pi * (220 + channel * 110) * i / SAMPLE_RATE))
+            for i in range(SAMPLE_RATE)
+            for channel in range(channels)
+        ),
+    ).tobytes()
+    data_length = len(one_second) * seconds
+    with open(path, "wb") as fp:
+        fp.write(b"RIFF" + struct.pack("<I", 36 + data_length) + b"WAVE")
+        fp.write(b"fmt " + struct.pack("<I", 16))
+        fp.write(
+            struct.pack(
+                "<HHIIHH",
+                1,
+                channels,
+                SAMPLE_RATE,
+                SAMPLE_RATE * channels * 2,
+                channels * 2,
+                16,
+            )
+        )
+        fp.write(b"data" + struct.pack("<I", data_length))
+        for _ in range(seconds):
+            fp.write(one_second)
+
+
+def make_labels(path: str, count: int, duration_ms: int) -> None:
+    """Write Audacity labels spread evenly over ``duration_ms``."""
+    step = duration_ms / count / 1000
+    with open(path, "w", encoding="utf-8") as fp:
+        for number in range(count):
+            text = "Chapter {} of the benchmark".format(number)
+            if number % 2 == 0:
+                text += "|https://example.com/{}".format(number)
+            start = number * step
+            fp.write("{:.6f}\t{:.6f}\t{}\n".format(start, start, text))
+
+
+def make_lrc(labels_path: str, path: str) -> None:
+    mcs = model.MCS()
+    mcs.load(labels_path)
+    mcs.save(path, model.MCS.LRC)
+
+
+def measure(function, repeat: int, setup=None) -> dict:
+    """Time ``function``, ``repeat`` times, calling ``setup`` before each run."""
+    runs = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        if setup is not None:
+            function(argument)
+        else:
+            function()
+        runs.append(time.perf_counter() - start)
+    return {
+        "seconds": min(runs),
+        "median": statistics.median(runs),
+        "runs": runs,
+    }
+
+
+class Suite:
+    def __init__(
+        self,
+        workdir: str,
+        repeat: int,
+        quick: bool,
+        import_budget: float = IMPORT_BUDGET_SECONDS,
+    ):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.durations = QUICK_DURATIONS if quick else DURATIONS
+        self.marker_counts = QUICK_MARKER_COUNTS if quick else MARKER_COUNTS
+        self.import_budget = import_budget
+        self.results = {}
+        # Startup problems, which fail the run whatever the baseline says
+        self.budget_failures = []
+        config_path = os.path.join(workdir, "config.ini")
+        with open(config_path, "w", encoding="utf-8") as fp:
+            fp.write(CONFIG)
+        self.config_data = config.check_config(config_path)
+
+    def record(self, name: str, result: dict, **details) -> None:
+        result.update(details)
+        self.results[name] = result
+        print("{:40} {:10.4f} s".format(name, result["seconds"]), flush=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.workdir, name)
+
+    def run(self) -> None:
+        self.bench_startup()
+        for seconds in self.durations:
+            self.bench_encode_and_tag(seconds)
+        for count in self.marker_counts:
+            self.bench_markers(count)
+
+    def bench_startup(self) -> None:
+        """Time importing ``main`` in a fresh interpreter, and check what it
+        loaded."""
+        script = STARTUP_SCRIPT.format(
+            source=os.path.abspath(SOURCE), lazy=LAZY_MODULES
+        )
+        runs = []
+        loaded = set()
+        for _ in range(self.repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", script],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            report = json.loads(output.strip().splitlines()[-1])
+            runs.append(report["seconds"])
+            loaded.update(report["loaded"])
+        result = {
+            "seconds": min(runs),
+            "median": statistics.median(runs),
+            "runs": runs,
+        }
+        self.record(
+            "startup/import-main",
+            result,
+            budget=self.import_budget,
+            loaded=sorted(loaded),
+        )
+        if result["seconds"] > self.import_budget:
+            self.budget_failures.append(
+                "importing main took {:.3f} s, over the {:.3f} s budget".format(
+                    result["seconds"], self.import_budget
+                )
+            )
+        if loaded:
+            self.budget_failures.append(
+                "importing main loaded {}".format(", ".join(sorted(loaded)))
+            )
+
+    def bench_encode_and_tag(self, seconds: int) -> None:
+        wav_path = self.path("{}s.wav".format(seconds))
+        mp3_path = self.path("{}s.mp3".format(seconds))
+        make_wav(wav_path, seconds)
+        size = os.path.getsize(wav_path)
+
+        def encode():
+            encoder = model.MP3Encoder(wav_path, mp3_path, BITRATE, NullProgress())
+            encoder.run()
+            if not encoder.succeeded:
+                raise model.PostShowError(
+                    "The encoder failed: {}".format(encoder.error)
+                )
+
+        result = measure(encode, self.repeat)
+        self.record(
+            "encode/{}s".format(seconds),
+            result,
+            input_bytes=size,
+            mb_per_second=size / 1e6 / result["seconds"],
+        )
+
+        labels_path = self.path("{}s-labels.txt".format(seconds))
+        make_labels(labels_path, TAG_CHAPTERS, seconds * 1000)
+        tagged_path = self.path("{}s-tagged.mp3".format(seconds))
+
+        def make_tagger():
+            mcs = model.MCS()
+            mcs.load(labels_path)
+            tagger = model.MP3Tagger(
+                mp3_path, NullSignal(), tagged_path, length_ms=seconds * 1000
+            )
+            tagger.set_title("Benchmark")
+            tagger.add_chapters(mcs.get())
+            return tagger
+
+        self.record(
+            "tag/{}s".format(seconds),
+            measure(lambda tagger: tagger.run(), self.repeat, make_tagger),
+            chapters=TAG_CHAPTERS,
+            input_bytes=os.path.getsize(mp3_path),
+        )
+        for path in (wav_path, mp3_path, tagged_path):
+            os.remove(path)
+
+    def bench_markers(self, count: int) -> None:
+        # Spread the markers over a long show, so they're all distinct.
+        duration_ms = max(4 * 3600 * 1000, count * 1000)
+        paths = {"txt": self.path("{}-markers.txt".format(count))}
+        make_labels(paths["txt"], count, duration_ms)
+        paths["lrc"] = self.path("{}-markers.lrc".format(count))
+        make_lrc(paths["txt"], paths["lrc"])
+
+        for extension in MARKER_LOADERS:
+
+            def load(path=paths[extension]):
+                model.MCS().load(path)
+
+            self.record(
+                "mcs-load/{}/{}".format(extension, count),
+                measure(load, self.repeat),
+                markers=count,
+            )
+
+        # The CUE sheet needs to know what it's describing.
+        mcs = model.MCS(media_filename="benchmark.mp3")
+        mcs.load(paths["txt"])
+        for name, (marker_type, extension) in MARKER_SAVERS.items():
+            output_path = self.path("saved-{}.{}".format(count, extension))
+            self.record(
+                "mcs-save/{}/{}".format(name, count),
+                measure(
+                    lambda path=output_path, kind=marker_type: mcs.save(path, kind),
+                    self.repeat,
+                ),
+                markers=count,
+            )
+            os.remove(output_path)
+
+        outdir = self.path("out-{}".format(count))
+        os.makedirs(outdir, exist_ok=True)
+
+        def make_controller():
+            controller = Controller(self.config_data)
+            controller.outdir = outdir
+            controller.markers_file = paths["txt"]
+            controller.set_metadata(model.EpisodeMetadata("1", "Benchmark"))
+            return controller
+
+        self.record(
+            "build-chapters/{}".format(count),
+            measure(
+                lambda controller: controller.build_chapters(),
+                self.repeat,
+                make_controller,
+            ),
+            markers=count,
+        )
+
+
+def compare(results: dict, baseline: dict, tolerance: float, skip=()) -> list:
+    """Compare results against a baseline.
+
+    Benchmarks that take less than ``NOISE_SECONDS`` are too noisy to call
+    slower.
+
+    :param skip: Prefixes of benchmark names not to compare.
+    :return: The names of the benchmarks that got slower by more than
+    ``tolerance`` (a fraction).
+    """
+    regressions = []
+    print()
+    print("{:40} {:>10} {:>10} {:>8}".format("benchmark", "baseline", "now", "ratio"))
+    for name, result in results.items():
+        if name not in baseline or name.startswith(tuple(skip)):
+            continue
+        before = baseline[name]["seconds"]
+        ratio = result["seconds"] / before if before > 0 else 1.0
+        flag = ""
+        if ratio > 1 + tolerance and result["seconds"] >= NOISE_SECONDS:
+            flag = "  SLOWER"
+            regressions.append(name)
+        print(
+            "{:40} {:10.4f} {:10.4f} {:7.2f}x{}".format(
+                name, before, result["seconds"], ratio, flag
+            )
+        )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="only the shorter recordings and smaller marker files",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument("--output", help="where to write the results, as JSON")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="how much slower than the baseline counts as a regression",
+    )
+    parser.add_argument(
+        "--workdir", help="where to put the synthetic files (default: a temp dir)"
+    )
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        default=IMPORT_BUDGET_SECONDS,
+        help="how many seconds importing main may take (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    encoder = "lame"
+    if "POSTSHOW_LAME" not in os.environ and not os.path.exists(
+        model.MP3Encoder.find_lame()
+    ):
+        os.environ["POSTSHOW_LAME"] = STANDIN_LAME
+    if os.environ.get("POSTSHOW_LAME") == STANDIN_LAME:
+        encoder = "stand-in"
+        print("LAME isn't available, so encoding uses the stand-in encoder")
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        suite = Suite(workdir, args.repeat, args.quick, args.import_budget)
+        suite.run()
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "encoder": encoder,
+        "quick": args.quick,
+        "results": suite.results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+    status = 0
+    for failure in suite.budget_failures:
+        print("Startup budget exceeded: {}".format(failure))
+        status = 1
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fp:
+            baseline = json.load(fp)
+        skip = []
+        if baseline.get("encoder") != encoder:
+            print("The baseline used a different encoder; not comparing encode times")
+            skip.append("encode/")
+        regressions = compare(suite.results, baseline["results"], args.tolerance, skip)
+        if regressions:
+            print("{} benchmark(s) got slower".format(len(regressions)))
+            return 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""A stand-in for LAME, for benchmarking where the real one isn't available.
+
+It understands the command lines that ``MP3Encoder`` uses, reads all of the
+input, and writes the right number of well-formed (but silent) CBR frames, so
+everything downstream of the encoder sees a realistic MP3.  Timings taken with
+it measure PostShow's own overhead, not LAME's.
+"""
+
+import sys
+import wave
+
+SAMPLES_PER_FRAME = 1152
+# LAME's delay, and the frame it adds to flush its buffers
+ENCODER_DELAY = 576
+BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+SAMPLE_RATES = [44100, 48000, 32000]
+READ_SIZE = 1024 * 1024
+
+
+class FrameWriter:
+    def __init__(self, out, bitrate: int, sample_rate: int, mono: bool):
+        if sample_rate not in SAMPLE_RATES:
+            # LAME would resample; the frame count is close enough.
+            sample_rate = 44100
+        self.out = out
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+        self.size = 144 * bitrate * 1000 // sample_rate
+        # Frames get a padding byte now and then, to keep the bitrate exact.
+        self.remainder = 144 * bitrate * 1000 % sample_rate
+        self.header = bytes(
+            [
+                0xFF,
+                0xFB,
+                BITRATES.index(bitrate) << 4 | SAMPLE_RATES.index(sample_rate) << 2,
+                0xC0 if mono else 0x40,
+            ]
+        )
+        self.frames = 0
+        self.samples = 0
+
+    def _frame(self) -> bytes:
+        padding = (self.frames + 1) * self.remainder // self.sample_rate - (
+            self.frames * self.remainder // self.sample_rate
+        )
+        header = bytearray(self.header)
+        header[2] |= padding << 1
+        self.frames += 1
+        return bytes(header) + bytes(self.size + padding - 4)
+
+    def add(self, samples: int) -> None:
+        """Write every frame that ``samples`` more input completes."""
+        self.samples += samples
+        frames = []
+        while (self.frames + 1) * SAMPLES_PER_FRAME <= self.samples + ENCODER_DELAY:
+            frames.append(self._frame())
+        self.out.write(b"".join(frames))
+
+    def flush(self) -> None:
+        self.out.write(self._frame() + self._frame())
+        self.out.flush()
+
+
+def main(args) -> int:
+    bitrate = 128
+    raw = False
+    sample_rate = 44100
+    bitwidth = 16
+    mono = False
+    files = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-b":
+            bitrate = int(args[i + 1])
+            i += 1
+        elif arg == "-s":
+            sample_rate = int(float(args[i + 1]) * 1000)
+            i += 1
+        elif arg == "--bitwidth":
+            bitwidth = int(args[i + 1])
+            i += 1
+        elif arg == "-m":
+            mono = args[i + 1] == "m"
+            i += 1
+        elif arg == "-r":
+            raw = True
+        elif arg in ("-V", "-B", "--abr", "-q", "--resample"):
+            i += 1
+        elif arg.startswith("-") and arg != "-":
+            pass
+        else:
+            files.append(arg)
+        i += 1
+    source, destination = files
+    out = sys.stdout.buffer if destination == "-" else open(destination, "wb")
+    if raw:
+        frame_size = bitwidth // 8 * (1 if mono else 2)
+        writer = FrameWriter(out, bitrate, sample_rate, mono)
+        for block in iter(lambda: sys.stdin.buffer.read(READ_SIZE), b""):
+            writer.add(len(block) // frame_size)
+    else:
+        with wave.open(source) as wav:
+            writer = FrameWriter(
+                out, bitrate, wav.getframerate(), wav.getnchannels() == 1
+            )
+            total = max(1, wav.getnframes())
+            done = 0
+            for block in iter(lambda: wav.readframes(READ_SIZE // 4), b""):
+                frames = len(block) // (wav.getsampwidth() * wav.getnchannels())
+                writer.add(frames)
+                done += frames
+                sys.stderr.write("  ({:2d}%)|\n".format(min(99, done * 100 // total)))
+                sys.stderr.flush()
+    writer.flush()
+    if not raw:
+        sys.stderr.write("(100%)|\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
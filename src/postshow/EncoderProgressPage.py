@@ -1,4 +1,5 @@
 import platform
+import time
 
 import random
 from PySide6.QtCore import QObject, Signal
@@ -9,6 +10,8 @@ from PySide6.QtWidgets import (
     QWizardPage,
 )
 
+import history
+
 
 class ProgressUpdateEmitter(QObject):
     progressed = Signal(int)
@@ -78,6 +81,10 @@ class EncoderProgressPage(QWizardPage):
         self.controller.encoder_progress_signal.encoder_finished.connect(
             self.finish_encoder
         )
+        # How long each stage should take, from the run history
+        self.prediction = None
+        self.eta_label = QLabel("")
+        self.controller.encoder_progress_signal.progressed.connect(self.update_eta)
 
         main_layout = QVBoxLayout()
         main_layout.addWidget(feel_free_label)
@@ -89,8 +96,49 @@ class EncoderProgressPage(QWizardPage):
             mac_label.setWordWrap(True)
             main_layout.addWidget(mac_label)
         main_layout.addWidget(self.progress_bar)
+        main_layout.addWidget(self.eta_label)
         self.setLayout(main_layout)
 
+    def initializePage(self) -> None:
+        # When resuming an unfinished run, there's no encoder to wait for.
+        if self.controller.resumed:
+            self.finish_encoder()
+            return
+        self.prediction = self.controller.predict_seconds()
+        self.update_eta(self.progress_bar.value())
+
+    def update_eta(self, value):
+        """Estimate how much longer the whole run will take.
+
+        At first this goes by how long runs like it have taken before; as the
+        encode goes on, it trusts the encoder's own pace more and more.
+        """
+        encoder = self.controller.encoder
+        if value >= 100 or encoder is None or encoder.stopwatch is None:
+            self.eta_label.setText("")
+            return
+        elapsed = time.perf_counter() - encoder.stopwatch.wall
+        after_encode = 0
+        remaining = None
+        if value > 0:
+            remaining = elapsed * (100 - value) / value
+        if self.prediction is not None and "encode" in self.prediction:
+            predicted = max(0, self.prediction["encode"] - elapsed)
+            if remaining is None:
+                remaining = predicted
+            else:
+                remaining = predicted + (remaining - predicted) * value / 100
+            after_encode = sum(
+                seconds
+                for stage, seconds in self.prediction.items()
+                if stage != "encode"
+            )
+        if remaining is None:
+            return
+        self.eta_label.setText(
+            "About {} left".format(history.format_seconds(remaining + after_encode))
+        )
+
     def finish_encoder(self):
         self.controller.progress_view_finished()
         self.controller.do_tag()
@@ -100,4 +148,6 @@ class EncoderProgressPage(QWizardPage):
 
     def emit_complete_when_finished(self, value):
         if value == 101:
+            self.controller.tagging_finished()
+            self.controller.run_finished()
             self.wizard().next()
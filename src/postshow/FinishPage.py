@@ -91,7 +91,11 @@ class FinishPage(QWizardPage):
 
     def initializePage(self) -> None:
         # self.file_list_model.setRootPath("/Users/s0ph0s/Desktop/test_folder")
-        mp3_size = os.path.getsize(self.controller.mp3_path)
+        mp3_digest = self.controller.file_digests.get(self.controller.mp3_path)
+        if mp3_digest is not None:
+            mp3_size = mp3_digest.length
+        else:
+            mp3_size = os.path.getsize(self.controller.mp3_path)
         self.size_field.setText(str(mp3_size))
         mp3_duration_ms = self.controller.get_mp3_length_ms()
         mp3_duration = datetime.timedelta(milliseconds=mp3_duration_ms)
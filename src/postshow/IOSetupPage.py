@@ -1,6 +1,7 @@
 from typing import List
 import os.path
-from PySide6.QtCore import QStandardPaths
+import threading
+from PySide6.QtCore import QEventLoop, QStandardPaths, Qt
 from PySide6.QtGui import QIcon
 from PySide6.QtWidgets import (
     QComboBox,
@@ -10,10 +11,12 @@ from PySide6.QtWidgets import (
     QLabel,
     QLineEdit,
     QMessageBox,
+    QProgressDialog,
     QPushButton,
     QVBoxLayout,
     QWizardPage,
 )
+import EncoderProgressPage
 import model
 
 import configparser
@@ -95,8 +98,9 @@ class InputOutputPage(QWizardPage):
             lambda: self.show_file_chooser_for_field(
                 self.recording_file_line,
                 "recording_file",
-                "Final episode recording (WAV or MP3)",
-                "Audio file (*.wav *.mp3)",
+                "Final episode recording",
+                "Audio file (*.wav *.bwf *.rf64 *.w64 *.aif *.aiff *.aifc *.flac "
+                "*.opus *.ogg *.m4a *.mp3)",
             )
         )
         wav_chooser_layout.addWidget(self.recording_file_line)
@@ -191,7 +195,8 @@ class InputOutputPage(QWizardPage):
 
     def confirm_overwrite(self, existing_files: List[str]) -> bool:
         """Ask the user whether they want to overwrite existing files.
-        :return: True if they want to destroy data, False if they want to go back and try again.
+        :return: True if they want to destroy data, False if they want to go back
+            and try again.
         """
         confirm_box = QMessageBox(
             QMessageBox.Warning,
@@ -204,8 +209,85 @@ class InputOutputPage(QWizardPage):
         confirm_box.exec()
         return confirm_box.clickedButton() == overwrite
 
+    def confirm_resume(self, stage: str) -> bool:
+        """Ask the user whether they want to resume an unfinished run.
+        :return: True to resume, False to start over.
+        """
+        resume_box = QMessageBox(
+            QMessageBox.Question,
+            "Resume unfinished episode?",
+            "PostShow didn't finish this episode last time, but the {} step was "
+            "completed. Pick up where it left off?".format(stage),
+        )
+        resume = resume_box.addButton("Resume", QMessageBox.AcceptRole)
+        resume_box.addButton("Start Over", QMessageBox.RejectRole)
+        resume_box.exec()
+        return resume_box.clickedButton() == resume
+
+    def confirm_problems(self, problems: List[str]) -> bool:
+        """Tell the user about problems with the recording.
+        :return: True to encode it anyway, False to go back and fix it.
+        """
+        problem_box = QMessageBox(
+            QMessageBox.Warning,
+            "Problems with the recording",
+            "PostShow found some problems with the recording:\n\n{}".format(
+                "\n".join(problems)
+            ),
+        )
+        proceed = problem_box.addButton("Continue Anyway", QMessageBox.AcceptRole)
+        problem_box.addButton("Cancel", QMessageBox.RejectRole)
+        problem_box.exec()
+        return problem_box.clickedButton() == proceed
+
+    def run_preflight(self, recording_file_path: str) -> List[str]:
+        """Check the recording on another thread, showing how far it's got.
+
+        A long recording (or one that has to be decoded) takes a while to read,
+        and the wizard would stop responding if it were read on this thread.
+        :return: A description of every problem found.
+        """
+        progress_dialog = QProgressDialog(
+            "Checking the recording...", None, 0, 100, self
+        )
+        progress_dialog.setWindowTitle("Pre-flight check")
+        progress_dialog.setWindowModality(Qt.WindowModal)
+        progress_dialog.setMinimumDuration(500)
+        emitter = EncoderProgressPage.ProgressUpdateEmitter()
+        emitter.progressed.connect(progress_dialog.setValue)
+        loop = QEventLoop()
+        emitter.encoder_finished.connect(loop.quit)
+        result = {}
+
+        def check():
+            try:
+                result["problems"] = self.controller.run_preflight(
+                    recording_file_path,
+                    progress=lambda fraction: emitter.set_progress(
+                        min(100, int(fraction * 100))
+                    ),
+                )
+            except (model.PostShowError, OSError) as e:
+                result["error"] = e
+            finally:
+                emitter.set_finished()
+
+        checker = threading.Thread(target=check)
+        checker.start()
+        # The signal is queued until the loop runs, so it can't be missed.
+        loop.exec()
+        checker.join()
+        progress_dialog.close()
+        if "error" in result:
+            raise result["error"]
+        return result["problems"]
+
     def validatePage(self) -> bool:
-        self.controller.profile = self.template_box.currentData()
+        try:
+            self.controller.set_profile(self.template_box.currentData())
+        except model.PostShowError as e:
+            QMessageBox.warning(self, "Can't use this profile", str(e))
+            return False
         recording_file_path = self.recording_file_line.text()
         self.controller.outdir = self.outfolder_folder_line.text()
         self.controller.markers_file = self.chap_file_line.text()
@@ -213,16 +295,31 @@ class InputOutputPage(QWizardPage):
             self.number_line.text(), self.title_line.text()
         )
         self.controller.set_metadata(metadata)
-        files_that_exist = self.controller.check_before_wreck()
-        if len(files_that_exist) > 0:
-            if not self.confirm_overwrite(files_that_exist):
-                return False
+        if not os.access(self.controller.outdir, os.W_OK):
+            QMessageBox.warning(
+                self,
+                "Can't write to the output folder",
+                "PostShow can't write to {}. Choose another output folder.".format(
+                    self.controller.outdir
+                ),
+            )
+            return False
+        self.controller.reset_encoder()
+        # Resuming reuses the files that are already there, so only ask about
+        # overwriting them when starting over.
+        stage = self.controller.find_resumable_stage(recording_file_path)
+        resume = stage is not None and self.confirm_resume(stage)
+        if not resume:
+            files_that_exist = self.controller.check_before_wreck()
+            if len(files_that_exist) > 0:
+                if not self.confirm_overwrite(files_that_exist):
+                    return False
 
-        if recording_file_path.endswith(".wav"):
-            self.controller.reset_encoder()
-            self.controller.start_encoder(recording_file_path)
-        else:
-            self.controller.skip_encoding = True
+        if not recording_file_path.endswith(".mp3"):
+            problems = self.run_preflight(recording_file_path)
+            if len(problems) > 0 and not self.confirm_problems(problems):
+                return False
+        self.controller.start_encoder(recording_file_path, resume=resume)
         self.controller.build_chapters()
         with open(self.MEMORY_FILE_PATH, "w") as mf:
             self.file_chooser_memory.write(mf)
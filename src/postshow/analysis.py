@@ -0,0 +1,509 @@
+"""Sample-level analysis of WAV files, using NumPy.
+
+NumPy is an optional dependency (``pip install postshow[analysis]``), so this
+module must only be imported once something actually needs it.
+"""
+
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+import wavfile
+
+# ITU-R BS.1770-4 / EBU R128 constants.
+SEGMENT_SECONDS = 0.1
+SEGMENTS_PER_BLOCK = 4
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+TRUE_PEAK_OVERSAMPLING = 4
+# Only the loudest segments can hold the true peak, since it can't be more
+# than a few dB above the sample peak.
+TRUE_PEAK_HEADROOM_DB = 3.5
+TRUE_PEAK_MAX_SEGMENTS = 256
+# How many 100 ms segments to analyze at once.
+SEGMENTS_PER_CHUNK = 600
+
+
+class LoudnessMeasurement(NamedTuple):
+    integrated_lufs: float
+    true_peak_dbtp: float
+
+    def gain_to(self, target_lufs: float, max_true_peak_dbtp: float) -> float:
+        """The gain (in dB) that reaches ``target_lufs`` without clipping.
+
+        If hitting the target would push the true peak past
+        ``max_true_peak_dbtp``, the gain is reduced instead of limiting.
+        """
+        if math.isinf(self.integrated_lufs):
+            # Silence.  There's nothing to normalize.
+            return 0.0
+        gain = target_lufs - self.integrated_lufs
+        if self.true_peak_dbtp + gain > max_true_peak_dbtp:
+            gain = max_true_peak_dbtp - self.true_peak_dbtp
+        return gain
+
+
+def to_float(block: bytes, wav: wavfile.WaveFile) -> np.ndarray:
+    """Convert raw sample data to floats in [-1, 1), shaped (frames, channels)."""
+    bits = wav.bits_per_sample
+    if wav.is_float:
+        samples = np.frombuffer(block, dtype="<f4" if bits == 32 else "<f8")
+        samples = samples.astype(np.float32)
+    elif bits == 8:
+        samples = (np.frombuffer(block, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif bits == 16:
+        samples = np.frombuffer(block, dtype="<i2").astype(np.float32) / 32768
+    elif bits == 24:
+        raw = np.frombuffer(block, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = (raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)
+        samples = samples.astype(np.float32) / 2147483648
+    elif bits == 32:
+        samples = np.frombuffer(block, dtype="<i4").astype(np.float32) / 2147483648
+    else:
+        raise ValueError("Unsupported bit depth: {}".format(bits))
+    return samples.reshape(-1, wav.channels)
+
+
+def to_pcm16(samples: np.ndarray) -> bytes:
+    """Convert floats back to 16-bit little-endian PCM, clipping if needed."""
+    scaled = np.rint(samples * 32768)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype("<i2").tobytes()
+
+
+def _biquad_power(b, a, omega: np.ndarray) -> np.ndarray:
+    """The squared magnitude response of a biquad at the given frequencies."""
+    z = np.exp(-1j * omega)
+    numerator = b[0] + b[1] * z + b[2] * z * z
+    denominator = a[0] + a[1] * z + a[2] * z * z
+    return np.abs(numerator) ** 2 / np.abs(denominator) ** 2
+
+
+def k_weighting_power(sample_rate: int, length: int) -> np.ndarray:
+    """The K-weighting filter's power response at each ``rfft`` bin.
+
+    The filter is the usual pair of biquads (a high shelf, then a high pass),
+    with the coefficients derived for ``sample_rate`` the same way
+    libebur128 does it.
+    """
+    omega = 2 * np.pi * np.fft.rfftfreq(length)
+    # Stage 1: high shelf
+    f0 = 1681.974450955533
+    gain_db = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh**0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0]
+    shelf_b.append((vh - vb * k / q + k * k) / a0)
+    shelf_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    # Stage 2: high pass
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass_b = [1.0, -2.0, 1.0]
+    highpass_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return _biquad_power(shelf_b, shelf_a, omega) * _biquad_power(
+        highpass_b, highpass_a, omega
+    )
+
+
+def _segment_energies(spectra: np.ndarray, weights: np.ndarray, length: int):
+    """Mean square of each segment, from its spectrum (Parseval's theorem)."""
+    power = np.abs(spectra) ** 2 * weights[np.newaxis, :, np.newaxis]
+    # rfft only returns half the spectrum; every bin but DC (and Nyquist, for
+    # even lengths) stands in for two.
+    total = 2 * power.sum(axis=1) - power[:, 0, :]
+    if length % 2 == 0:
+        total -= power[:, -1, :]
+    return total / (length * length)
+
+
+def _oversampled_peak(wav: wavfile.WaveFile, segment: int, length: int) -> float:
+    """Find the true peak of one segment by band-limited oversampling."""
+    # Include a segment on either side, so the edges don't ring.
+    start = max(0, (segment - 1) * length)
+    end = (segment + 2) * length
+    if wav.frame_count is not None:
+        end = min(wav.frame_count, end)
+    block = b"".join(wav.iter_blocks(start_frame=start, end_frame=end))
+    samples = to_float(block, wav).astype(np.float64)
+    count = samples.shape[0]
+    spectrum = np.fft.rfft(samples, axis=0)
+    upsampled = (
+        np.fft.irfft(spectrum, n=count * TRUE_PEAK_OVERSAMPLING, axis=0)
+        * TRUE_PEAK_OVERSAMPLING
+    )
+    middle = upsampled[
+        (segment * length - start) * TRUE_PEAK_OVERSAMPLING : (
+            (segment + 1) * length - start
+        )
+        * TRUE_PEAK_OVERSAMPLING
+    ]
+    return float(np.abs(middle).max(initial=0.0))
+
+
+def _fraction_read(done: int, wav: wavfile.WaveFile) -> float:
+    # A decoded recording's length might not be known until it has all been
+    # decoded.
+    return min(1.0, done / max(1, wav.frame_count or 0))
+
+
+def measure_loudness(wav: wavfile.WaveFile, progress=None) -> LoudnessMeasurement:
+    """Measure the integrated loudness and true peak of a WAV file.
+
+    The file is read once, in chunks of 100 ms segments.  Rather than running
+    the K-weighting filter sample by sample, each segment's energy is taken
+    from its spectrum, weighted by the filter's response, which gives the same
+    gating-block energies to well within the precision R128 asks for.
+
+    :param progress: An optional function that's called with the fraction of
+    the file that has been read.
+    """
+    length = max(1, int(round(wav.sample_rate * SEGMENT_SECONDS)))
+    weights = k_weighting_power(wav.sample_rate, length)
+    energies = []
+    peaks = []
+    chunk_bytes = SEGMENTS_PER_CHUNK * length * wav.block_align
+    done = 0
+    for block in wav.iter_blocks(block_size=chunk_bytes):
+        samples = to_float(block, wav)
+        usable = samples.shape[0] - samples.shape[0] % length
+        if usable > 0:
+            segments = samples[:usable].reshape(-1, length, wav.channels)
+            spectra = np.fft.rfft(segments, axis=1)
+            energies.append(_segment_energies(spectra, weights, length))
+            peaks.append(np.abs(segments).max(axis=(1, 2)))
+        done += samples.shape[0]
+        if progress is not None:
+            progress(_fraction_read(done, wav))
+    if len(energies) == 0:
+        return LoudnessMeasurement(-math.inf, -math.inf)
+    energies = np.concatenate(energies)
+    peaks = np.concatenate(peaks)
+    # 400 ms gating blocks, overlapping by 75%
+    if energies.shape[0] < SEGMENTS_PER_BLOCK:
+        blocks = energies.mean(axis=0, keepdims=True)
+    else:
+        cumulative = np.cumsum(
+            np.concatenate([np.zeros((1, wav.channels)), energies]), axis=0
+        )
+        blocks = (
+            cumulative[SEGMENTS_PER_BLOCK:] - cumulative[:-SEGMENTS_PER_BLOCK]
+        ) / SEGMENTS_PER_BLOCK
+    block_power = blocks.sum(axis=1)
+    with np.errstate(divide="ignore"):
+        block_loudness = -0.691 + 10 * np.log10(block_power)
+    gated = block_power[block_loudness > ABSOLUTE_GATE_LUFS]
+    if gated.shape[0] == 0:
+        integrated = -math.inf
+    else:
+        relative_gate = -0.691 + 10 * math.log10(gated.mean()) + RELATIVE_GATE_LU
+        gated = block_power[
+            (block_loudness > ABSOLUTE_GATE_LUFS) & (block_loudness > relative_gate)
+        ]
+        integrated = -0.691 + 10 * math.log10(gated.mean())
+    # True peak: oversample only the segments loud enough to matter.
+    sample_peak = float(peaks.max())
+    if sample_peak == 0:
+        return LoudnessMeasurement(integrated, -math.inf)
+    threshold = sample_peak * 10 ** (-TRUE_PEAK_HEADROOM_DB / 20)
+    candidates = np.nonzero(peaks >= threshold)[0]
+    if candidates.shape[0] > TRUE_PEAK_MAX_SEGMENTS:
+        loudest = np.argsort(peaks[candidates])[-TRUE_PEAK_MAX_SEGMENTS:]
+        candidates = candidates[loudest]
+    true_peak = sample_peak
+    for segment in candidates:
+        true_peak = max(true_peak, _oversampled_peak(wav, int(segment), length))
+    return LoudnessMeasurement(integrated, 20 * math.log10(true_peak))
+
+
+# Pre-flight QA thresholds
+QA_BLOCK_SECONDS = 1.0
+SILENCE_DBFS = -60.0
+DEAD_CHANNEL_DBFS = -70.0
+CLIP_LEVEL = 0.999
+# Clipping is only reported when this many full-scale samples are in a row,
+# since a single full-scale sample is just a loud peak.
+CLIP_RUN = 3
+MAX_SILENCE_SECONDS = 10.0
+MAX_DC_OFFSET = 0.01
+MIN_CORRELATION = -0.5
+# How far past the end of the audio a chapter may end, in milliseconds.
+CHAPTER_END_SLACK_MS = 1000
+# How much louder than the quietest one a frame boundary can be, and still be
+# good enough to snap a chapter to.
+SNAP_TOLERANCE_DB = 1.0
+
+
+def _dbfs(value):
+    with np.errstate(divide="ignore"):
+        return 20 * np.log10(value)
+
+
+class QAReport:
+    """The results of checking a recording before encoding it."""
+
+    def __init__(self, path: str, duration_ms: int, channels: int):
+        self.path = path
+        self.duration_ms = duration_ms
+        self.channels = channels
+        self.block_seconds = QA_BLOCK_SECONDS
+        self.block_peak_dbfs = None
+        self.block_rms_dbfs = None
+        self.peak_dbfs = None
+        self.rms_dbfs = None
+        self.clipped_samples = None
+        self.dc_offset = None
+        self.correlation = None
+        self.leading_silence_ms = 0
+        self.trailing_silence_ms = 0
+        self.problems = []
+
+    def as_dict(self) -> dict:
+        def rounded(values):
+            return [round(float(value), 1) for value in values]
+
+        return {
+            "path": self.path,
+            "duration_ms": self.duration_ms,
+            "channels": self.channels,
+            "peak_dbfs": rounded(self.peak_dbfs),
+            "rms_dbfs": rounded(self.rms_dbfs),
+            "clipped_samples": [int(count) for count in self.clipped_samples],
+            "dc_offset": [round(float(value), 5) for value in self.dc_offset],
+            "correlation": None
+            if self.correlation is None
+            else round(self.correlation, 3),
+            "leading_silence_ms": self.leading_silence_ms,
+            "trailing_silence_ms": self.trailing_silence_ms,
+            "problems": self.problems,
+            "block_seconds": self.block_seconds,
+            "block_peak_dbfs": [rounded(row) for row in self.block_peak_dbfs],
+            "block_rms_dbfs": [rounded(row) for row in self.block_rms_dbfs],
+        }
+
+
+def preflight(wav: wavfile.WaveFile, chapters=None, progress=None) -> QAReport:
+    """Check a recording for the mistakes that are embarrassing to publish.
+
+    The file is read once, in memory-mapped chunks, and every statistic is
+    collected per one-second block:
+    * peak and RMS level, for each channel
+    * full-scale (clipped) samples
+    * DC offset
+    * correlation between the first two channels
+    * silence at the start and end
+
+    :param chapters: If provided, the ``Chapter`` list is also checked against
+    the length of the recording.
+    :param progress: An optional function that's called with the fraction of
+    the file that has been read.
+    """
+    report = QAReport(wav.path, wav.duration_ms, wav.channels)
+    block_frames = max(1, int(round(wav.sample_rate * QA_BLOCK_SECONDS)))
+    chunk_bytes = 60 * block_frames * wav.block_align
+    peaks = []
+    squares = []
+    clipped = np.zeros(wav.channels, dtype=np.int64)
+    sums = np.zeros(wav.channels)
+    # Running sums for the correlation of the first two channels.
+    cross = 0.0
+    previous_tail = np.zeros((CLIP_RUN - 1, wav.channels), dtype=bool)
+    done = 0
+    for block in wav.iter_blocks(block_size=chunk_bytes):
+        samples = to_float(block, wav)
+        count = samples.shape[0]
+        done += count
+        if progress is not None:
+            progress(_fraction_read(done, wav))
+        # One row per channel, so every reduction runs over contiguous memory.
+        planar = np.ascontiguousarray(samples.T)
+        magnitudes = np.abs(planar)
+        # Chunks hold whole blocks, except (maybe) the last one.
+        whole = count - count % block_frames
+        edges = [(0, whole)] if whole > 0 else []
+        if whole < count:
+            edges.append((whole, count))
+        for start, end in edges:
+            length = block_frames if end - start >= block_frames else end - start
+            blocks = planar[:, start:end].reshape(wav.channels, -1, length)
+            peaks.append(
+                magnitudes[:, start:end].reshape(wav.channels, -1, length).max(axis=2).T
+            )
+            squares.append(np.einsum("ijk,ijk->ji", blocks, blocks) / length)
+        sums += planar.sum(axis=1)
+        if wav.channels > 1:
+            cross += float(np.dot(planar[0], planar[1]))
+        # Runs of full-scale samples, including runs that straddle chunks.
+        # Almost every chunk has none at all, so check for that first.
+        full_scale = (magnitudes >= CLIP_LEVEL).T
+        if not full_scale.any() and not previous_tail.any():
+            previous_tail = full_scale[-(CLIP_RUN - 1) :]
+            continue
+        full_scale = np.concatenate([previous_tail, full_scale])
+        run = full_scale[CLIP_RUN - 1 :].copy()
+        for offset in range(1, CLIP_RUN):
+            run &= full_scale[CLIP_RUN - 1 - offset : full_scale.shape[0] - offset]
+        clipped += run.sum(axis=0)
+        previous_tail = full_scale[-(CLIP_RUN - 1) :]
+    if len(peaks) == 0:
+        report.problems.append("The recording is empty.")
+        return report
+    block_peaks = np.concatenate(peaks)
+    block_squares = np.concatenate(squares)
+    report.block_peak_dbfs = _dbfs(block_peaks)
+    report.block_rms_dbfs = _dbfs(np.sqrt(block_squares))
+    report.peak_dbfs = _dbfs(block_peaks.max(axis=0))
+    mean_squares = block_squares.mean(axis=0)
+    report.rms_dbfs = _dbfs(np.sqrt(mean_squares))
+    report.clipped_samples = clipped
+    # Counted as it was read, since a decoded recording's length might not have
+    # been known up front.
+    if report.duration_ms is None:
+        report.duration_ms = int(round(done * 1000 / wav.sample_rate, 0))
+    report.dc_offset = sums / done
+    if wav.channels > 1:
+        # Pearson correlation, from the running sums.
+        mean = report.dc_offset
+        total = done
+        covariance = cross / total - mean[0] * mean[1]
+        variances = mean_squares[:2] - mean[:2] ** 2
+        if variances.min() > 0:
+            report.correlation = float(covariance / np.sqrt(variances.prod()))
+    # Silence at either end
+    loud = np.nonzero(report.block_rms_dbfs.max(axis=1) > SILENCE_DBFS)[0]
+    block_ms = int(QA_BLOCK_SECONDS * 1000)
+    if loud.shape[0] == 0:
+        report.leading_silence_ms = report.trailing_silence_ms = report.duration_ms
+    else:
+        report.leading_silence_ms = int(loud[0]) * block_ms
+        report.trailing_silence_ms = max(
+            0, report.duration_ms - (int(loud[-1]) + 1) * block_ms
+        )
+    _find_problems(report)
+    if chapters is not None:
+        _check_chapters(report, chapters)
+    return report
+
+
+def _find_problems(report: QAReport) -> None:
+    names = ["left", "right"] if report.channels == 2 else None
+    for channel in range(report.channels):
+        name = names[channel] if names else "channel {}".format(channel + 1)
+        if report.clipped_samples[channel] > 0:
+            report.problems.append(
+                "The {} channel clips ({} samples at full scale).".format(
+                    name, report.clipped_samples[channel]
+                )
+            )
+        if abs(report.dc_offset[channel]) > MAX_DC_OFFSET:
+            report.problems.append(
+                "The {} channel has a DC offset of {:.1f}%.".format(
+                    name, report.dc_offset[channel] * 100
+                )
+            )
+        others_live = any(
+            report.rms_dbfs[other] > DEAD_CHANNEL_DBFS
+            for other in range(report.channels)
+            if other != channel
+        )
+        if report.rms_dbfs[channel] < DEAD_CHANNEL_DBFS and others_live:
+            report.problems.append("The {} channel is silent.".format(name))
+    if report.correlation is not None and report.correlation < MIN_CORRELATION:
+        report.problems.append(
+            "The channels are out of phase (correlation {:.2f}).".format(
+                report.correlation
+            )
+        )
+    if report.leading_silence_ms == report.duration_ms:
+        report.problems.append("The whole recording is silent.")
+        return
+    for where, silence_ms in (
+        ("start", report.leading_silence_ms),
+        ("end", report.trailing_silence_ms),
+    ):
+        if silence_ms > MAX_SILENCE_SECONDS * 1000:
+            report.problems.append(
+                "There are {} of silence at the {}.".format(
+                    _format_ms(silence_ms), where
+                )
+            )
+
+
+def _check_chapters(report: QAReport, chapters) -> None:
+    previous_start = None
+    for chapter in chapters:
+        if chapter.start >= report.duration_ms:
+            report.problems.append(
+                'Chapter "{}" starts at {}, after the recording ends ({}).'.format(
+                    chapter.text,
+                    _format_ms(chapter.start),
+                    _format_ms(report.duration_ms),
+                )
+            )
+        elif chapter.end > report.duration_ms + CHAPTER_END_SLACK_MS:
+            report.problems.append(
+                'Chapter "{}" ends at {}, after the recording ends ({}).'.format(
+                    chapter.text,
+                    _format_ms(chapter.end),
+                    _format_ms(report.duration_ms),
+                )
+            )
+        if previous_start is not None and chapter.start < previous_start:
+            report.problems.append(
+                'Chapter "{}" starts before the chapter ahead of it.'.format(
+                    chapter.text
+                )
+            )
+        previous_start = chapter.start
+
+
+def _format_ms(ms: int) -> str:
+    seconds = ms // 1000
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def quietest_frame_boundary(
+    wav: wavfile.WaveFile,
+    frame: int,
+    window: int,
+    frame_samples: int,
+    delay: int,
+    sample_rate: int,
+) -> int:
+    """Find the quietest MP3 frame boundary within ``window`` frames of ``frame``.
+
+    The loudness of a boundary is the energy of the frames on either side of
+    it.  Boundaries within ``SNAP_TOLERANCE_DB`` of the quietest count as a tie,
+    and the one closest to ``frame`` wins, so chapters in steady audio (or
+    true silence) stay put.
+
+    :param frame_samples: The number of samples in each MP3 frame.
+    :param delay: How far the encoder shifts the audio, in samples, so frame
+    ``k`` holds the recording from sample ``k * frame_samples - delay``.
+    :param sample_rate: The MP3's sample rate, which may not be the WAV's.
+    """
+    first = max(1, frame - window)
+    last = frame + window
+    # The edges of frames first - 1 through last, in WAV samples.
+    edges = np.arange(first - 1, last + 2) * frame_samples - delay
+    edges = np.rint(edges * wav.sample_rate / sample_rate).astype(np.int64)
+    start = int(edges[0])
+    count = int(edges[-1]) - start
+    block = b"".join(
+        wav.iter_blocks(start_frame=max(0, start), end_frame=start + count)
+    )
+    samples = np.zeros((count, wav.channels), dtype=np.float32)
+    read = to_float(block, wav)
+    offset = max(0, -start)
+    samples[offset : offset + read.shape[0]] = read
+    power = (samples**2).sum(axis=1)
+    energies = np.add.reduceat(power, edges[:-1] - start) / np.diff(edges)
+    costs = energies[:-1] + energies[1:]
+    boundaries = np.arange(first, last + 1)
+    quietest = boundaries[costs <= costs.min() * 10 ** (SNAP_TOLERANCE_DB / 10)]
+    return int(quietest[np.abs(quietest - frame).argmin()])
@@ -1,4 +1,5 @@
 import configparser
+import importlib.util
 from model import PostShowError
 import os.path
 
@@ -16,6 +17,36 @@ REQUIRED_TEXT_KEYS = [
 ]
 # These keys must be in the configuration file, with boolean values
 REQUIRED_BOOL_KEYS = ["write_date", "write_trackno", "lyrics_equals_comment"]
+# These keys are optional, but must have boolean values if they're present
+OPTIONAL_BOOL_KEYS = [
+    "preflight_qa",
+    "snap_chapters",
+    "seek_index",
+    "split_chapters",
+    "trace",
+    "profile_stages",
+    "record_history",
+]
+# These keys are optional, but must have numeric values if they're present
+OPTIONAL_FLOAT_KEYS = [
+    "target_lufs",
+    "max_true_peak",
+    "snap_window_ms",
+    "vbr_quality",
+    "segment_seconds",
+]
+# These keys are optional, but must have one of these values if they're present
+OPTIONAL_CHOICE_KEYS = {"bitrate_mode": ["cbr", "abr", "vbr"]}
+# These keys are optional, but must be paths to existing files if present
+BUMPER_KEYS = ["intro_bumper", "outro_bumper"]
+# These keys are optional, but need NumPy if they're present
+NUMPY_KEYS = ["target_lufs", "snap_window_ms"]
+
+
+def encode_workers(section) -> list:
+    """The addresses in a profile's comma-separated ``encode_workers`` list."""
+    text = section.get("encode_workers", fallback="")
+    return [address.strip() for address in text.split(",") if address.strip()]
 
 
 def check_config(path: str) -> configparser.ConfigParser:
@@ -54,8 +85,67 @@ def check_config(path: str) -> configparser.ConfigParser:
                         'values ("True" or "False") for the key '
                         '"{key}"'.format(section=section, key=key)
                     )
+        for key in OPTIONAL_BOOL_KEYS:
+            if key in so.keys() and so[key] not in ["True", "False"]:
+                errors.append(
+                    "[{section}] must use Python boolean "
+                    'values ("True" or "False") for the key '
+                    '"{key}"'.format(section=section, key=key)
+                )
+        for key in OPTIONAL_FLOAT_KEYS:
+            if key in so.keys():
+                try:
+                    so.getfloat(key)
+                except ValueError:
+                    errors.append(
+                        '[{section}] must use a number for the key "{key}"'.format(
+                            section=section, key=key
+                        )
+                    )
+        for key, choices in OPTIONAL_CHOICE_KEYS.items():
+            if key in so.keys() and so[key] not in choices:
+                errors.append(
+                    '[{section}] must use one of {choices} for the key "{key}"'.format(
+                        section=section, choices=", ".join(choices), key=key
+                    )
+                )
+        if "vbr_quality" in so.keys():
+            try:
+                if not 0 <= so.getfloat("vbr_quality") <= 9:
+                    errors.append(
+                        '[{section}] "vbr_quality" must be between 0 and 9'.format(
+                            section=section
+                        )
+                    )
+            except ValueError:
+                # Already reported
+                pass
+        if "encode_workers" in so.keys():
+            for address in encode_workers(so):
+                if not address.rpartition(":")[2].isdigit():
+                    errors.append(
+                        '[{section}] "encode_workers" must be a list of host:port '
+                        'addresses, not "{address}"'.format(
+                            section=section, address=address
+                        )
+                    )
+        for key in NUMPY_KEYS:
+            if key in so.keys() and importlib.util.find_spec("numpy") is None:
+                errors.append(
+                    '[{section}] uses "{key}", which needs NumPy to be '
+                    "installed".format(section=section, key=key)
+                )
         if "cover_art" in so.keys():
             so["cover_art"] = os.path.expandvars(so["cover_art"])
+        for key in BUMPER_KEYS:
+            if key in so.keys():
+                so[key] = os.path.expandvars(so[key])
+                if not os.path.exists(so[key]):
+                    errors.append(
+                        '[{section}] "{key}" doesn\'t exist: {path}'.format(
+                            section=section, key=key, path=so[key]
+                        )
+                    )
     if len(errors) > 0:
         raise PostShowError(";\n".join(errors))
     return config
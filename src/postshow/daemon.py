@@ -0,0 +1,417 @@
+import concurrent.futures
+import json
+import os
+import os.path
+import re
+import string
+import threading
+import time
+import traceback
+import uuid
+
+from PySide6.QtCore import Qt
+
+import finalize
+import history
+from model import PostShowError
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def build_file_name_matcher(config_data, profile: str, ext: str):
+    """Turn a profile's ``filename`` pattern into a regex for incoming files.
+
+    This follows the same rules as ``Controller.build_output_file_path``: the
+    slug is lowercased, and the episode number can be anything.  The regex has
+    one group, ``epnum``.
+    """
+    pattern = config_data.get(profile, "filename")
+    regex = ""
+    for literal, field, _spec, _conversion in string.Formatter().parse(pattern):
+        regex += re.escape(literal)
+        if field is None:
+            continue
+        if field == "slug":
+            regex += re.escape(config_data.get(profile, "slug").lower())
+        elif field == "epnum":
+            regex += "(?P<epnum>.+?)"
+        elif field == "ext":
+            regex += re.escape(ext)
+        else:
+            raise PostShowError(
+                "[{}] uses an unknown field in its filename: {}".format(profile, field)
+            )
+    return re.compile("^" + regex + "$")
+
+
+class Job:
+    """One episode, waiting to go through the pipeline (or already through it)."""
+
+    def __init__(self, profile, wav_path, markers_path, number, name, outdir):
+        self.id = uuid.uuid4().hex[:12]
+        self.profile = profile
+        self.wav_path = wav_path
+        self.markers_path = markers_path
+        self.number = number
+        self.name = name
+        self.outdir = outdir
+        self.state = QUEUED
+        self.progress = 0
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stage_times = {}
+        # How long the run history says this job will take, if it knows
+        self.predicted_seconds = None
+        self.output_files = []
+        self.controller = None
+        self.future = None
+
+    def set_progress(self, value):
+        self.progress = value
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "profile": self.profile,
+            "wav_path": self.wav_path,
+            "markers_path": self.markers_path,
+            "number": self.number,
+            "name": self.name,
+            "outdir": self.outdir,
+            "state": self.state,
+            "progress": self.progress,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stage_times": self.stage_times,
+            "predicted_seconds": self.predicted_seconds,
+            "output_files": self.output_files,
+        }
+
+
+class JobRunner:
+    """Run jobs through the pipeline on a bounded pool of worker threads.
+
+    Each job gets its own ``Controller``.  The heavy lifting happens in LAME,
+    which is a separate process, so threads are plenty.
+    """
+
+    def __init__(self, controller_factory, workers: int = 2, metrics=None):
+        """
+        :param controller_factory: A function that makes a new ``Controller``.
+        :param workers: How many episodes to process at the same time.
+        :param metrics: The ``metrics.Metrics`` to count finished and failed
+        jobs in, if any.
+        """
+        self.controller_factory = controller_factory
+        self.metrics = metrics
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="postshow-worker"
+        )
+        self.workers = workers
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, job: Job) -> Job:
+        job.predicted_seconds = self.predict(job)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self._run, job)
+        message = "Queued job {} ({} {})".format(job.id, job.profile, job.number)
+        if job.predicted_seconds is not None:
+            message += "; it should take about {}, and the queue about {}".format(
+                history.format_seconds(job.predicted_seconds),
+                history.format_seconds(self.estimated_queue_seconds()),
+            )
+        print(message)
+        return job
+
+    def predict(self, job: Job):
+        """Predict how long a job will take, from the run history."""
+        controller = self.controller_factory()
+        try:
+            controller.set_profile(job.profile)
+            duration_ms = controller.input_duration_ms(job.wav_path)
+            prediction = controller.predict_seconds(duration_ms)
+        except (PostShowError, OSError) as e:
+            print("Can't predict how long job {} will take: {}".format(job.id, e))
+            return None
+        if prediction is None:
+            return None
+        return sum(prediction.values())
+
+    def estimated_queue_seconds(self) -> float:
+        """How long until every job that's queued or running is done.
+
+        Jobs that the history can't predict aren't counted.
+        """
+        now = time.time()
+        work = 0.0
+        with self.lock:
+            for job in self.jobs.values():
+                if job.predicted_seconds is None:
+                    continue
+                if job.state == QUEUED:
+                    work += job.predicted_seconds
+                elif job.state == RUNNING:
+                    work += max(0.0, job.predicted_seconds - (now - job.started_at))
+        return work / self.workers
+
+    def _run(self, job: Job) -> None:
+        # Under the lock, so that a cancel can't land between the check and
+        # the job starting, and be forgotten.
+        with self.lock:
+            if job.state == CANCELLED:
+                return
+            job.started_at = time.time()
+            job.state = RUNNING
+        controller = None
+        try:
+            controller = self.controller_factory()
+            controller.set_profile(job.profile)
+            controller.outdir = job.outdir
+            # The signal is emitted from the encoder and tagger threads, and
+            # there's no event loop to deliver it anywhere else.
+            controller.encoder_progress_signal.progressed.connect(
+                job.set_progress, Qt.DirectConnection
+            )
+            with self.lock:
+                job.controller = controller
+                cancelled = job.state == CANCELLED
+            if cancelled:
+                raise PostShowError("The job was cancelled before it started.")
+            controller.process_episode(
+                job.wav_path, job.markers_path, job.number, job.name
+            )
+            job.state = DONE
+            if self.metrics is not None:
+                self.metrics.episode_finished(controller)
+        except (PostShowError, OSError) as e:
+            job.state = CANCELLED if job.state == CANCELLED else FAILED
+            job.error = str(e)
+            traceback.print_exc()
+            if self.metrics is not None and job.state == FAILED:
+                self.metrics.stage_failed(
+                    job.profile,
+                    (controller.current_stage if controller else None) or "setup",
+                )
+        finally:
+            if controller is not None:
+                job.stage_times = dict(controller.stage_times)
+                job.output_files = list(controller.output_files)
+            job.finished_at = time.time()
+            job.controller = None
+        print(
+            "Job {} {} in {:.1f}s {}".format(
+                job.id,
+                job.state,
+                job.finished_at - job.started_at,
+                json.dumps(job.stage_times),
+            )
+        )
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job, stopping the encoder if it's already running.
+
+        :return: False if there's no such job, or it has already finished.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in (QUEUED, RUNNING):
+                return False
+            was_running = job.state == RUNNING
+            job.state = CANCELLED
+        if not was_running:
+            job.future.cancel()
+            job.finished_at = time.time()
+        elif job.controller is not None:
+            job.controller.exit_handler()
+        return True
+
+    def queue_depth(self) -> int:
+        """The number of jobs waiting for a worker."""
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.state == QUEUED)
+
+    def running_count(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.state == RUNNING)
+
+    def write_metrics(self, path: str) -> None:
+        """Bring the queue gauges up to date, and write the metrics textfile."""
+        self.metrics.set_queue(self.queue_depth(), self.running_count())
+        self.metrics.write(path)
+
+    def status(self) -> dict:
+        with self.lock:
+            jobs = [job.as_dict() for job in self.jobs.values()]
+        return {
+            "workers": self.workers,
+            "queue_depth": sum(1 for job in jobs if job["state"] == QUEUED),
+            "running": sum(1 for job in jobs if job["state"] == RUNNING),
+            "estimated_queue_seconds": self.estimated_queue_seconds(),
+            "jobs": jobs,
+        }
+
+    def shutdown(self) -> None:
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.state == QUEUED:
+                job.state = CANCELLED
+            elif job.controller is not None:
+                job.controller.exit_handler()
+        self.executor.shutdown(wait=True)
+
+
+class WatchFolder:
+    """Look for finished recordings dropped in a folder.
+
+    A recording is picked up once ``{slug}-{epnum}.wav``, its Audacity labels
+    (``.txt``) and a JSON sidecar with the episode title (``.json``) are all
+    present, and none of them have changed for ``settle_seconds``, so files
+    that are still being copied in are left alone.
+    """
+
+    def __init__(self, config_data, profile, folder, outdir, settle_seconds=10.0):
+        self.config_data = config_data
+        self.profile = profile
+        self.folder = folder
+        self.outdir = outdir
+        self.settle_seconds = settle_seconds
+        self.matcher = build_file_name_matcher(config_data, profile, "wav")
+        self.last_seen = {}
+        self.submitted = set()
+
+    def _stable(self, path: str, now: float) -> bool:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.last_seen.pop(path, None)
+            return False
+        signature = (stat.st_size, stat.st_mtime_ns)
+        seen = self.last_seen.get(path)
+        if seen is None or seen[0] != signature:
+            self.last_seen[path] = (signature, now)
+            return False
+        return now - seen[1] >= self.settle_seconds
+
+    def _already_done(self, epnum: str) -> bool:
+        manifest_name = self.config_data.get(self.profile, "filename").format(
+            slug=self.config_data.get(self.profile, "slug").lower(),
+            epnum=epnum,
+            ext="manifest.json",
+        )
+        return os.path.exists(os.path.join(self.outdir, manifest_name))
+
+    def scan(self):
+        """Return a new ``Job`` for every recording that's ready to go."""
+        now = time.monotonic()
+        jobs = []
+        try:
+            names = os.listdir(self.folder)
+        except OSError as e:
+            print("Can't read watch folder {}: {}".format(self.folder, e))
+            return jobs
+        for name in sorted(names):
+            match = self.matcher.match(name)
+            if match is None:
+                continue
+            wav_path = os.path.join(self.folder, name)
+            if wav_path in self.submitted:
+                continue
+            base = wav_path[: -len(".wav")]
+            markers_path = base + ".txt"
+            sidecar_path = base + ".json"
+            # Check all three, so that each one's settle timer starts right away.
+            ready = [
+                self._stable(path, now)
+                for path in (wav_path, markers_path, sidecar_path)
+            ]
+            if not all(ready):
+                continue
+            epnum = match.group("epnum")
+            self.submitted.add(wav_path)
+            if self._already_done(epnum):
+                continue
+            try:
+                with open(sidecar_path, "r", encoding="utf-8") as fp:
+                    sidecar = json.load(fp)
+                title = sidecar["title"]
+            except (OSError, ValueError, KeyError) as e:
+                print("Skipping {}: bad sidecar {}: {}".format(name, sidecar_path, e))
+                continue
+            jobs.append(
+                Job(
+                    self.profile,
+                    wav_path,
+                    markers_path,
+                    str(sidecar.get("number", epnum)),
+                    title,
+                    self.outdir,
+                )
+            )
+        return jobs
+
+
+def write_status(path: str, status: dict) -> None:
+    partial = finalize.staging_path_for(path, "partial")
+    with open(partial, "w", encoding="utf-8") as fp:
+        json.dump(status, fp, indent=2)
+    os.replace(partial, path)
+
+
+def watch_folders_from_config(config_data, settle_seconds):
+    """Make a ``WatchFolder`` for every profile with a ``watch_folder`` key."""
+    folders = []
+    for section in config_data:
+        if section == "DEFAULT" or "watch_folder" not in config_data[section]:
+            continue
+        folder = config_data.get(section, "watch_folder")
+        # Not the watch folder itself, because the .txt chapter list that's
+        # written would replace the Audacity labels file.
+        outdir = config_data.get(
+            section, "watch_output_folder", fallback=os.path.join(folder, "output")
+        )
+        os.makedirs(outdir, exist_ok=True)
+        folders.append(
+            WatchFolder(config_data, section, folder, outdir, settle_seconds)
+        )
+    return folders
+
+
+def run(
+    runner: JobRunner, folders, poll_interval=5.0, status_path=None, metrics_path=None
+):
+    """Feed recordings from the watch folders to ``runner`` until interrupted.
+
+    With no folders, this just keeps the status and metrics files up to date,
+    which is what the job submission service needs.
+    """
+    for folder in folders:
+        print("Watching {} for [{}]".format(folder.folder, folder.profile))
+    try:
+        while True:
+            for folder in folders:
+                for job in folder.scan():
+                    runner.submit(job)
+            if status_path is not None:
+                write_status(status_path, runner.status())
+            if metrics_path is not None and runner.metrics is not None:
+                runner.write_metrics(metrics_path)
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopping; waiting for running jobs to stop...")
+    finally:
+        runner.shutdown()
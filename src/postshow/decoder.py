@@ -0,0 +1,280 @@
+import json
+import os
+import os.path
+import shutil
+import subprocess
+
+import mp3frames
+import wavfile
+from model import PostShowError
+
+# Ogg pages start with this, and the granule position (the number of samples
+# decoded by the end of the page) is at this offset into the page.
+OGG_CAPTURE = b"OggS"
+OGG_GRANULE_OFFSET = 6
+# How much of the end of an Ogg file to search for the last page
+OGG_TAIL_SIZE = 128 * 1024
+# Opus always decodes at 48 kHz, whatever the recording was made at.
+OPUS_SAMPLE_RATE = 48000
+
+
+def find_tool(name: str):
+    """Find a decoder program.
+
+    The ``POSTSHOW_<NAME>`` environment variable wins, then a copy bundled in
+    ``vendor`` (like LAME), then whatever's on the ``PATH``.
+
+    :return: The path to the program, or None if it isn't anywhere.
+    """
+    variable = "POSTSHOW_" + name.upper()
+    if variable in os.environ.keys():
+        return os.environ[variable]
+    basedir = os.path.dirname(__file__)
+    vendored = os.path.join(basedir, "vendor", name)
+    if "DEBUG" in os.environ.keys():
+        vendored = os.path.join(basedir, "..", "..", "vendor", name)
+    for candidate in (vendored, vendored + ".exe"):
+        if os.path.exists(candidate):
+            return candidate
+    return shutil.which(name)
+
+
+def sniff(path: str):
+    """Work out what kind of compressed audio a file holds, from its header.
+
+    :return: ``"flac"``, ``"ogg"`` or ``"mp4"``, or None for anything else
+    (which might be a WAV or AIFF file).
+    """
+    with open(path, "rb") as fp:
+        # FLAC files sometimes start with an ID3v2 tag.
+        start = mp3frames.id3v2_size(fp)
+        fp.seek(start)
+        header = fp.read(12)
+    if header[:4] == b"fLaC":
+        return "flac"
+    if header[:4] == OGG_CAPTURE:
+        return "ogg"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    return None
+
+
+def open_audio(path: str):
+    """Open a recording, to read its samples as PCM.
+
+    WAV (in all its forms) and AIFF files are read directly; FLAC, Ogg (Opus
+    or Vorbis) and M4A files are decoded as they're read.
+
+    :return: A ``wavfile.WaveFile`` or a ``DecodedAudio``, which work the same.
+    """
+    kind = sniff(path)
+    if kind is None:
+        return wavfile.WaveFile(path)
+    return DecodedAudio(path, kind)
+
+
+class DecodedAudio:
+    """A compressed recording, decoded to PCM as it's read.
+
+    It works like a ``wavfile.WaveFile`` of 16- or 24-bit PCM to everything
+    that reads it.  Nothing is decoded to disk: every pass over the audio runs
+    the decoder (``flac`` for FLAC files, if it's installed, otherwise
+    ``ffmpeg``) again, and the samples come straight out of its pipe.
+
+    The length comes from the file's header, and is exact for FLAC and Ogg
+    files.  For M4A files it comes from ``ffprobe``, and could be a little out,
+    so once the whole file has been decoded, ``frame_count`` is updated with
+    the number of samples that actually came out.
+    """
+
+    format_tag = wavfile.WAVE_FORMAT_PCM
+    is_float = False
+
+    def __init__(self, path: str, kind: str):
+        self.path = path
+        self.kind = kind
+        self.channels = None
+        self.sample_rate = None
+        self.source_bits = None
+        self.frame_count = None
+        if kind == "flac":
+            self._read_flac_header()
+        elif kind == "ogg":
+            self._read_ogg_header()
+        else:
+            self._probe()
+        self.bits_per_sample = 24 if self.source_bits and self.source_bits > 16 else 16
+        self.block_align = self.bits_per_sample // 8 * self.channels
+
+    def _read_flac_header(self) -> None:
+        with open(self.path, "rb") as fp:
+            fp.seek(mp3frames.id3v2_size(fp) + 4)
+            block = fp.read(4 + 34)
+        # STREAMINFO is always the first metadata block.
+        if len(block) < 38 or block[0] & 0x7F != 0:
+            raise PostShowError("{} is missing its STREAMINFO.".format(self.path))
+        packed = int.from_bytes(block[14:22], "big")
+        self.sample_rate = packed >> 44
+        self.channels = ((packed >> 41) & 0x07) + 1
+        self.source_bits = ((packed >> 36) & 0x1F) + 1
+        # Zero means the encoder didn't know.
+        self.frame_count = (packed & 0xFFFFFFFFF) or None
+
+    def _read_ogg_header(self) -> None:
+        with open(self.path, "rb") as fp:
+            first_page = fp.read(OGG_TAIL_SIZE)
+            fp.seek(0, 2)
+            fp.seek(max(0, fp.tell() - OGG_TAIL_SIZE))
+            tail = fp.read()
+        # The first packet starts after the page header and segment table.
+        segments = first_page[26]
+        packet = first_page[27 + segments :]
+        pre_skip = 0
+        if packet[:8] == b"OpusHead":
+            self.channels = packet[9]
+            pre_skip = int.from_bytes(packet[10:12], "little")
+            self.sample_rate = OPUS_SAMPLE_RATE
+        elif packet[:7] == b"\x01vorbis":
+            self.channels = packet[11]
+            self.sample_rate = int.from_bytes(packet[12:16], "little")
+        else:
+            raise PostShowError(
+                "{} isn't Opus or Vorbis audio, which is all the Ogg files that "
+                "can be read.".format(self.path)
+            )
+        last_page = tail.rfind(OGG_CAPTURE)
+        if last_page != -1:
+            granule = tail[
+                last_page + OGG_GRANULE_OFFSET : last_page + OGG_GRANULE_OFFSET + 8
+            ]
+            if len(granule) == 8:
+                self.frame_count = max(
+                    0, int.from_bytes(granule, "little", signed=True) - pre_skip
+                )
+
+    def _probe(self) -> None:
+        ffprobe = find_tool("ffprobe")
+        if ffprobe is None:
+            raise PostShowError(
+                "Reading {} needs ffmpeg (and ffprobe), which isn't installed.".format(
+                    self.path
+                )
+            )
+        result = subprocess.run(
+            [ffprobe, "-v", "error", "-select_streams", "a:0"]
+            + [
+                "-show_entries",
+                "stream=sample_rate,channels,duration,bits_per_raw_sample",
+            ]
+            + ["-of", "json", self.path],
+            capture_output=True,
+            check=False,
+        )
+        try:
+            stream = json.loads(result.stdout)["streams"][0]
+            self.sample_rate = int(stream["sample_rate"])
+            self.channels = int(stream["channels"])
+        except (ValueError, KeyError, IndexError):
+            raise PostShowError(
+                "ffprobe couldn't find any audio in {}: {}".format(
+                    self.path, result.stderr.decode("utf-8", errors="replace")
+                )
+            )
+        if "duration" in stream:
+            self.frame_count = int(round(float(stream["duration"]) * self.sample_rate))
+        if stream.get("bits_per_raw_sample", "").isdigit():
+            self.source_bits = int(stream["bits_per_raw_sample"])
+
+    @property
+    def duration_ms(self):
+        if self.frame_count is None:
+            return None
+        return int(round(self.frame_count * 1000 / self.sample_rate, 0))
+
+    def _command(self, start_frame: int, end_frame):
+        """The command that decodes the audio from ``start_frame`` on."""
+        flac = find_tool("flac") if self.kind == "flac" else None
+        if flac is not None and self.source_bits in (16, 24):
+            command = [flac, "-d", "-c", "-s", "--force-raw-format"]
+            command += ["--endian=little", "--sign=signed"]
+            if start_frame > 0:
+                command.append("--skip={}".format(start_frame))
+            if end_frame is not None:
+                command.append("--until={}".format(end_frame))
+            return command + [self.path]
+        ffmpeg = find_tool("ffmpeg")
+        if ffmpeg is None:
+            raise PostShowError(
+                "Decoding {} needs ffmpeg, which isn't installed.".format(self.path)
+            )
+        sample_format = "s{}le".format(self.bits_per_sample)
+        command = [ffmpeg, "-v", "error", "-nostdin"]
+        if start_frame > 0:
+            command += ["-ss", "{:.6f}".format(start_frame / self.sample_rate)]
+        return command + [
+            "-i",
+            self.path,
+            "-map",
+            "0:a:0",
+            "-f",
+            sample_format,
+            "-acodec",
+            "pcm_" + sample_format,
+            "-ac",
+            str(self.channels),
+            "-ar",
+            str(self.sample_rate),
+            "-",
+        ]
+
+    def iter_blocks(
+        self, block_size: int = wavfile.BLOCK_SIZE, start_frame=0, end_frame=None
+    ):
+        """Decode the sample data, in blocks of whole sample frames.
+
+        Seeking is left to the decoder, so reading from the middle of a long
+        recording doesn't mean decoding everything before it.
+
+        :param block_size: The approximate size of each block, in bytes.
+        :param start_frame: The first sample frame to read.
+        :param end_frame: The sample frame to stop before (default: the end).
+        """
+        block_length = max(1, block_size // self.block_align) * self.block_align
+        remaining = None
+        if end_frame is not None:
+            remaining = max(0, end_frame - start_frame) * self.block_align
+        process = subprocess.Popen(
+            self._command(start_frame, end_frame),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        frames = 0
+        ended = False
+        try:
+            while remaining is None or remaining > 0:
+                length = (
+                    block_length if remaining is None else min(block_length, remaining)
+                )
+                # Reading a pipe only comes up short at the end of the audio.
+                block = process.stdout.read(length)
+                block = block[: len(block) - len(block) % self.block_align]
+                if len(block) == 0:
+                    ended = True
+                    break
+                frames += len(block) // self.block_align
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block
+        finally:
+            if not ended:
+                # Stopped early, by the caller or at end_frame.
+                process.kill()
+            process.stdout.close()
+            errors = process.stderr.read().decode("utf-8", errors="replace").strip()
+            process.stderr.close()
+            process.wait()
+        if ended and process.returncode != 0:
+            raise PostShowError("Couldn't decode {}: {}".format(self.path, errors))
+        if ended and start_frame == 0:
+            self.frame_count = frames
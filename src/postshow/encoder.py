@@ -0,0 +1,633 @@
+import importlib.util
+import os.path
+import re
+import subprocess
+import threading
+
+import history
+import mp3frames
+import profiling
+import tracing
+from model import PostShowError
+
+
+class MP3Encoder(threading.Thread):
+    """Shell out to LAME to encode the WAV file as an MP3.
+
+    VBR and ABR MP3s get a Xing tag, with a table of contents for seeking.
+    """
+
+    # When normalizing loudness, the share of the progress bar that the
+    # analysis pass gets.
+    ANALYSIS_PERCENT = 10
+    # How much of LAME's output to read at a time.
+    OUTPUT_BLOCK_SIZE = 64 * 1024
+    # LAME's own default VBR quality
+    DEFAULT_VBR_QUALITY = 4
+
+    def __init__(
+        self,
+        infile: str,
+        outfile: str,
+        bitrate: str,
+        progress_updater,
+        target_lufs=None,
+        max_true_peak=-1.0,
+        bitrate_mode="cbr",
+        vbr_quality=None,
+        workers=None,
+        segment_seconds=None,
+        frame_range=None,
+    ):
+        """
+        :param infile: Path to the recording: a WAV file (including RF64 and
+        Wave64), an AIFF, FLAC, Ogg or M4A file, or an MP3 to re-encode.
+        :param outfile: Path to create MP3 file at.
+        :param bitrate: The bitrate, in Kbps: constant for CBR, the average for
+        ABR, and the most any frame can use for VBR.
+        :param target_lufs: If provided, the integrated loudness to normalize the
+        audio to, in LUFS.  This needs NumPy.
+        :param max_true_peak: When normalizing, the highest true peak that the
+        gain is allowed to cause, in dBTP.
+        :param bitrate_mode: ``"cbr"``, ``"abr"`` or ``"vbr"``.
+        :param vbr_quality: For VBR, LAME's quality setting (``-V``), from 0
+        (best) to 9 (smallest).
+        :param workers: The ``host:port`` of each encode worker to share the
+        encoding with, if any (see ``farm``).
+        :param segment_seconds: When sharing the encoding, the longest segment
+        to send a worker.
+        :param frame_range: A ``(start, end)`` tuple of the sample frames to
+        encode, if it isn't the whole recording.
+        """
+        super().__init__()
+        self.infile = infile
+        self.outfile = outfile
+        self.bitrate = bitrate
+        self.progress_updater = progress_updater
+        self.target_lufs = target_lufs
+        self.max_true_peak = max_true_peak
+        self.bitrate_mode = bitrate_mode
+        self.vbr_quality = (
+            vbr_quality if vbr_quality is not None else self.DEFAULT_VBR_QUALITY
+        )
+        self.workers = workers or []
+        self.segment_seconds = segment_seconds
+        self.frame_range = frame_range
+        # The header of the Xing tag frame in front of VBR audio, once it's
+        # been written
+        self.info_header = None
+        self.matcher = re.compile(r"\(([0-9]?[0-9 ][0-9])%\)")
+        self.p = None
+        self.percent = 0
+        self.started = False
+        self.finished = False
+        self.stop_requested = False
+        self.error = None
+        self.loudness = None
+        self.gain_db = None
+        # Where every frame of the MP3 is, found as LAME writes them.
+        self.frame_index = None
+        self.output_error = None
+        # How long the encode took, once it's done: (wall, CPU) seconds
+        self.stopwatch = None
+        self.usage = None
+        self.tracer = tracing.NULL_TRACER
+        self.profiler = profiling.NULL_PROFILER
+        # The length of the input, so nobody has to measure the MP3 afterwards.
+        self.wav = None
+        self.sample_count = None
+        self.sample_rate = None
+        if not infile.endswith(".mp3"):
+            import decoder
+
+            try:
+                self.wav = decoder.open_audio(infile)
+                self.sample_count = self.wav.frame_count
+                self.sample_rate = self.wav.sample_rate
+                if frame_range is not None:
+                    start, end = frame_range
+                    if self.sample_count is not None:
+                        end = min(end, self.sample_count)
+                    self.frame_range = (start, end)
+                    self.sample_count = max(0, end - start)
+            except PostShowError as pse:
+                print(
+                    "Couldn't read the recording's header, LAME will have to cope:", pse
+                )
+
+    @property
+    def duration_ms(self):
+        """The exact length of the input, or None if it isn't known."""
+        if self.sample_count is None:
+            return None
+        return int(round(self.sample_count * 1000 / self.sample_rate, 0))
+
+    @staticmethod
+    def find_lame() -> str:
+        # For running without the bundled LAME, e.g. with the benchmarks'
+        # stand-in encoder.
+        if "POSTSHOW_LAME" in os.environ.keys():
+            return os.environ["POSTSHOW_LAME"]
+        basedir = os.path.dirname(__file__)
+        lame_path = os.path.join(basedir, "vendor", "lame")
+        if "DEBUG" in os.environ.keys():
+            lame_path = os.path.join(basedir, "..", "..", "vendor", "lame")
+        return lame_path
+
+    def rate_options(self) -> list:
+        """LAME's options for the bitrate."""
+        return self.lame_rate_options(self.bitrate, self.bitrate_mode, self.vbr_quality)
+
+    @staticmethod
+    def lame_rate_options(bitrate: str, bitrate_mode: str, vbr_quality) -> list:
+        if bitrate_mode == "abr":
+            return ["--abr", bitrate]
+        if bitrate_mode == "vbr":
+            return ["-V", "{:g}".format(vbr_quality), "-B", bitrate]
+        return ["-b", bitrate, "--cbr"]
+
+    @tracing.traced("encode")
+    @profiling.profiled("encode")
+    def run(self):
+        self.started = True
+        self.stopwatch = history.Stopwatch()
+        self.tracer.count_file_in(self.infile)
+        try:
+            if self.frame_range is not None and (
+                self.wav is None
+                or (self.wav.is_float and importlib.util.find_spec("numpy") is None)
+            ):
+                raise PostShowError(
+                    "Part of {} can only be encoded if PostShow can read it "
+                    "itself.".format(self.infile)
+                )
+            if self.wav is not None and self.wav.channels > 2:
+                # LAME would take the interleaved samples for stereo, and
+                # encode noise.
+                raise PostShowError(
+                    "{} has {} channels, but MP3s can only have one or two; "
+                    "mix it down to stereo first.".format(
+                        self.infile, self.wav.channels
+                    )
+                )
+            if self.wav is None:
+                if self.target_lufs is not None:
+                    print("Only WAV files can be normalized; encoding as it is")
+                self._encode_file()
+            elif self.target_lufs is not None:
+                self._encode_normalized()
+            elif self.wav.is_float and importlib.util.find_spec("numpy") is None:
+                # Converting floating-point samples needs NumPy.
+                self._encode_file()
+            else:
+                self._encode_pcm()
+            if self.p.returncode == 0 and not self.stop_requested:
+                self._write_xing_tag()
+        except (PostShowError, OSError, subprocess.SubprocessError) as e:
+            # Nobody is going to join this thread and look for an exception, so
+            # record it and let the controller find it.
+            self.error = e
+            print("The encoder failed:", e)
+        self.tracer.count_file_out(self.outfile)
+        self.usage = self.stopwatch.read()
+        self.finished = True
+        self.progress_updater.set_finished()
+
+    def _set_progress(self, percent: int) -> None:
+        if percent != self.percent:
+            self.percent = percent
+            self.progress_updater.set_progress(percent)
+
+    def _encode_file(self):
+        """Have LAME read the input file itself, and follow its progress output."""
+        input_options = ["--mp3input"] if self.infile.endswith(".mp3") else []
+        p = subprocess.Popen(
+            [self.find_lame(), "-t"]
+            + input_options
+            + self.rate_options()
+            + [self.infile, "-"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.p = p
+        if not p:
+            raise PostShowError("failed to start encoder")
+        writer = self._start_output_writer(p)
+        stderr = p.stderr
+        if stderr is None:
+            raise PostShowError("this shouldn't happen")
+        for block in iter(lambda: stderr.read(1024), ""):
+            # Stop when the process terminates.
+            if p.poll() is not None:
+                break
+            text = block.decode("utf-8")
+            groups = self.matcher.findall(text)
+            if len(groups) < 1:
+                continue
+            percent = int(groups[-1])
+            self._set_progress(percent)
+            if percent == 100 and p.poll() is not None:
+                break
+        p.wait()
+        self._finish_output_writer(writer)
+
+    def _encode_normalized(self):
+        """Measure the loudness, then stream the PCM to LAME with the gain applied.
+
+        Nothing is written to disk except the MP3.
+        """
+        import analysis
+
+        if self.wav is None:
+            raise PostShowError("Loudness normalization needs a readable WAV file.")
+        self.loudness = analysis.measure_loudness(
+            self.wav,
+            lambda fraction: self._set_progress(int(fraction * self.ANALYSIS_PERCENT)),
+        )
+        self.gain_db = self.loudness.gain_to(self.target_lufs, self.max_true_peak)
+        print(
+            "Measured {:.1f} LUFS, {:.1f} dBTP; applying {:+.1f} dB".format(
+                self.loudness.integrated_lufs,
+                self.loudness.true_peak_dbtp,
+                self.gain_db,
+            )
+        )
+        self._encode_pcm(10 ** (self.gain_db / 20), self.ANALYSIS_PERCENT)
+
+    def _encode_pcm(self, gain=None, progress_start=0):
+        """Stream the recording's samples to LAME as raw PCM, on its standard
+        input.
+
+        LAME never sees the file itself, so RF64 and Wave64 files of any size
+        work, and so do compressed recordings, which are decoded as they're
+        streamed.  Progress comes from the number of samples sent.  Integer
+        samples are passed on untouched; floating-point samples, or any gain,
+        need converting to 16-bit with NumPy.
+
+        :param gain: The linear gain to apply, if any.
+        :param progress_start: Where the progress bar starts, in percent.
+        """
+        wav = self.wav
+        convert = gain is not None or wav.is_float
+        if self.workers and self.sample_count:
+            import farm
+
+            if farm.samples_per_frame(wav.sample_rate) is not None:
+                self._encode_segments(convert, gain, progress_start)
+                return
+            print("MP3s can't be {} Hz, so encoding here".format(wav.sample_rate))
+        width = self._pcm_bitwidth(convert)
+        # 8-bit WAV samples are the only unsigned ones.
+        signedness = "--unsigned" if width == 8 else "--signed"
+        p = subprocess.Popen(
+            [self.find_lame(), "-t", "--quiet", "-r"]
+            + ["-s", "{:g}".format(wav.sample_rate / 1000)]
+            + ["--bitwidth", str(width), signedness]
+            + ["--little-endian", "-m", "m" if wav.channels == 1 else "j"]
+            + self.rate_options()
+            + ["-", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.p = p
+        writer = self._start_output_writer(p)
+        block_align = width // 8 * wav.channels
+        frames_done = 0
+        try:
+            for block in self._pcm_blocks(convert, gain):
+                if self.stop_requested:
+                    break
+                frames_done += len(block) // block_align
+                p.stdin.write(block)
+                self._report_frames(frames_done, progress_start)
+            p.stdin.close()
+        except BrokenPipeError:
+            # LAME went away; its exit status says why.
+            pass
+        errors = p.stderr.read().decode("utf-8", errors="replace").strip()
+        p.wait()
+        self._finish_output_writer(writer)
+        if p.returncode != 0 and not self.stop_requested:
+            raise PostShowError("LAME failed: {}".format(errors))
+        if not self.stop_requested:
+            self.sample_count = frames_done
+            self._set_progress(100)
+
+    def _encode_segments(self, convert: bool, gain, progress_start: int):
+        """Have encode workers encode the recording in segments, in parallel.
+
+        The segments' frames are joined as they come back, and written out
+        like LAME's would be.
+        """
+        import farm
+
+        wav = self.wav
+        width = self._pcm_bitwidth(convert)
+        p = farm.SegmentedEncode(
+            self.workers,
+            {
+                "sample_rate": wav.sample_rate,
+                "channels": wav.channels,
+                "bitwidth": width,
+                "bitrate": self.bitrate,
+                "bitrate_mode": self.bitrate_mode,
+                "vbr_quality": self.vbr_quality,
+            },
+            lambda start, end: self._pcm_blocks(convert, gain, start, end),
+            self.sample_count,
+            lambda frames_done: self._report_frames(frames_done, progress_start),
+            self.segment_seconds or farm.DEFAULT_SEGMENT_SECONDS,
+        )
+        self.p = p
+        writer = self._start_output_writer(p)
+        p.start()
+        p.wait()
+        self._finish_output_writer(writer)
+        if p.returncode != 0 and not self.stop_requested:
+            raise PostShowError("Encoding in segments failed: {}".format(p.error))
+        if not self.stop_requested:
+            self.sample_count = p.frames_read
+            self._set_progress(100)
+
+    def _pcm_bitwidth(self, convert: bool) -> int:
+        """The width of the samples LAME is sent."""
+        if convert:
+            return 16
+        return self.wav.block_align // self.wav.channels * 8
+
+    def _pcm_blocks(self, convert: bool, gain, start_frame=0, end_frame=None):
+        """The recording's samples, converted to 16-bit if they need to be.
+
+        Frames count from the start of ``frame_range``, if there is one.
+        """
+        if self.frame_range is not None:
+            first, last = self.frame_range
+            start_frame += first
+            end_frame = last if end_frame is None else min(last, first + end_frame)
+        if convert:
+            import analysis
+
+            if gain is None:
+                gain = 1.0
+        for block in self.wav.iter_blocks(start_frame=start_frame, end_frame=end_frame):
+            if convert:
+                samples = analysis.to_float(block, self.wav)
+                block = analysis.to_pcm16(samples * gain)
+            yield block
+
+    def _report_frames(self, frames_done: int, progress_start: int) -> None:
+        # A decoded recording's length might only be approximate until it has
+        # all been decoded.
+        self._set_progress(
+            min(
+                99,
+                progress_start
+                + (100 - progress_start)
+                * frames_done
+                // max(1, self.sample_count or 0),
+            )
+        )
+
+    def _start_output_writer(self, p) -> threading.Thread:
+        """Save LAME's output to the MP3 file on another thread.
+
+        LAME writes to a pipe rather than the file, so that every frame can be
+        indexed as it's written, without reading the file back afterwards.
+        """
+        self.frame_index = mp3frames.FrameIndex()
+        writer = threading.Thread(target=self._write_output, args=(p.stdout,))
+        writer.start()
+        return writer
+
+    def _write_output(self, stdout) -> None:
+        # VBR audio gets a Xing tag in front, which is held back until LAME's
+        # first frame header is there to copy.
+        pending = b"" if self.bitrate_mode != "cbr" else None
+        try:
+            with open(self.outfile, "wb") as fp:
+                for block in iter(lambda: stdout.read(self.OUTPUT_BLOCK_SIZE), b""):
+                    if pending is not None:
+                        pending += block
+                        if len(pending) < 4:
+                            continue
+                        block, pending = pending, None
+                        self._write_info_placeholder(fp, block[:4])
+                    fp.write(block)
+                    self.frame_index.feed(block)
+                if pending:
+                    fp.write(pending)
+                    self.frame_index.feed(pending)
+        except OSError as e:
+            self.output_error = e
+            # Don't leave LAME blocked on a pipe that nobody's reading.
+            self.p.terminate()
+
+    def _write_info_placeholder(self, fp, first_header: bytes) -> None:
+        """Make room for the Xing tag, which is filled in once LAME is done.
+
+        LAME writes to a pipe, so it can't go back and write the tag itself
+        (and ``-t`` tells it not to try).
+        """
+        if mp3frames.parse_header(first_header) is None:
+            return
+        info_header = mp3frames.info_frame_header(first_header)
+        placeholder = mp3frames.build_info_frame(
+            info_header, 0, 0, 0, toc=bytes(100), method=self.bitrate_mode
+        )
+        if placeholder is None:
+            return
+        fp.write(placeholder)
+        self.frame_index.feed(placeholder)
+        self.info_header = info_header
+
+    def _write_xing_tag(self) -> None:
+        """Fill in the Xing tag in front of VBR audio, now every frame is known.
+
+        Its table of contents comes from the frame index, so it's as accurate
+        as 100 entries can be, and the LAME extension has the exact padding, so
+        the audio stays gapless.
+        """
+        index = self.frame_index
+        if self.info_header is None or index is None:
+            return
+        total = len(index) * index.samples_per_frame
+        if self.sample_count is not None:
+            # LAME may have resampled the audio.
+            samples = round(self.sample_count * index.sample_rate / self.sample_rate)
+        else:
+            # Assume every sample but the delay is real audio.
+            samples = total - mp3frames.ENCODER_DELAY
+        padding = min(0xFFF, max(0, total - mp3frames.LAME_DELAY - samples))
+        frame = mp3frames.build_info_frame(
+            self.info_header,
+            len(index),
+            index.audio_length,
+            padding,
+            toc=mp3frames.build_toc(index),
+            method=self.bitrate_mode,
+        )
+        with open(self.outfile, "r+b") as fp:
+            fp.write(frame)
+        index.encoder_delay = mp3frames.LAME_DELAY
+        index.encoder_padding = padding
+
+    def _finish_output_writer(self, writer: threading.Thread) -> None:
+        writer.join()
+        if self.output_error is not None:
+            raise PostShowError(
+                "Couldn't write {}: {}".format(self.outfile, self.output_error)
+            )
+        if not self.frame_index.valid:
+            print("LAME wrote something that isn't a frame; not using the index")
+            self.frame_index = None
+
+    @property
+    def succeeded(self) -> bool:
+        """Whether LAME finished encoding the whole file."""
+        return (
+            self.finished
+            and self.error is None
+            and self.p is not None
+            and self.p.returncode == 0
+        )
+
+    def request_stop(self):
+        self.stop_requested = True
+        if self.started and self.p is not None:
+            self.p.terminate()
+
+
+class MP3Passthrough(threading.Thread):
+    """Copy the audio out of an MP3 that's already encoded the way it should be.
+
+    Only the frames are copied; ID3v2, APE, Lyrics3 and ID3v1 tags are left
+    behind, since the tagger writes a new tag anyway.  This has the same
+    interface as ``MP3Encoder``.
+    """
+
+    COPY_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, infile: str, outfile: str, progress_updater):
+        super().__init__()
+        self.infile = infile
+        self.outfile = outfile
+        self.progress_updater = progress_updater
+        self.percent = 0
+        self.started = False
+        self.finished = False
+        self.stop_requested = False
+        self.error = None
+        self.frame_index = None
+        self.sample_count = None
+        self.sample_rate = None
+        self.tracer = tracing.NULL_TRACER
+        self.profiler = profiling.NULL_PROFILER
+        self.stopwatch = None
+        self.usage = None
+
+    @staticmethod
+    def audio_range(fp):
+        """Find where the frames are, between the tags at either end.
+
+        :return: A ``(start, end)`` tuple of byte offsets.
+        """
+        fp.seek(0)
+        start = mp3frames.id3v2_size(fp)
+        fp.seek(0, 2)
+        end = fp.tell()
+        if end - start >= 128:
+            fp.seek(end - 128)
+            if fp.read(3) == b"TAG":
+                end -= 128
+        if end - start >= 15:
+            fp.seek(end - 15)
+            trailer = fp.read(15)
+            if trailer[6:] == b"LYRICS200" and trailer[:6].isdigit():
+                end -= int(trailer[:6]) + 15
+        if end - start >= 32:
+            fp.seek(end - 32)
+            footer = fp.read(32)
+            if footer[:8] == b"APETAGEX":
+                size = int.from_bytes(footer[12:16], "little")
+                flags = int.from_bytes(footer[20:24], "little")
+                # The size doesn't count the header, if there is one.
+                end -= size + (32 if flags & 0x80000000 else 0)
+        return start, max(start, end)
+
+    @classmethod
+    def matches(cls, path: str, bitrate: str) -> bool:
+        """Check whether an MP3 can be published as it is.
+
+        It has to be constant bitrate, at the profile's bitrate.
+        """
+        with open(path, "rb") as fp:
+            start, _ = cls.audio_range(fp)
+            fp.seek(start)
+            first = fp.read(4)
+            header = mp3frames.parse_header(first)
+            if header is None:
+                return False
+            frame = first + fp.read(header.length - 4)
+        position = 4 + mp3frames.side_info_size(header)
+        if frame[position : position + 4] == b"Xing":
+            # A Xing tag (rather than Info) means variable bitrate.
+            return False
+        return str(header.bitrate) == bitrate.strip()
+
+    @property
+    def duration_ms(self):
+        if self.sample_count is None:
+            return None
+        return int(round(self.sample_count * 1000 / self.sample_rate, 0))
+
+    @tracing.traced("encode")
+    @profiling.profiled("encode")
+    def run(self):
+        self.started = True
+        self.stopwatch = history.Stopwatch()
+        self.tracer.count_file_in(self.infile)
+        try:
+            self._copy_frames()
+        except (PostShowError, OSError) as e:
+            self.error = e
+            print("Copying the MP3 failed:", e)
+        self.tracer.count_file_out(self.outfile)
+        self.usage = self.stopwatch.read()
+        self.finished = True
+        self.progress_updater.set_finished()
+
+    def _copy_frames(self):
+        self.frame_index = mp3frames.FrameIndex()
+        with open(self.infile, "rb") as src, open(self.outfile, "wb") as dst:
+            start, end = self.audio_range(src)
+            src.seek(start)
+            remaining = end - start
+            while remaining > 0 and not self.stop_requested:
+                block = src.read(min(remaining, self.COPY_BLOCK_SIZE))
+                if not block:
+                    break
+                dst.write(block)
+                self.frame_index.feed(block)
+                remaining -= len(block)
+                percent = 100 * (end - start - remaining) // (end - start)
+                if percent != self.percent:
+                    self.percent = percent
+                    self.progress_updater.set_progress(percent)
+        if not self.frame_index.valid or len(self.frame_index) == 0:
+            raise PostShowError("{} isn't a clean MP3.".format(self.infile))
+        index = self.frame_index
+        self.sample_rate = index.sample_rate
+        self.sample_count = len(index) * index.samples_per_frame
+        if index.encoder_padding is not None:
+            self.sample_count -= index.encoder_delay + index.encoder_padding
+        else:
+            # Without a LAME tag, assume LAME's delay and no padding.
+            self.sample_count -= mp3frames.LAME_DELAY
+
+    @property
+    def succeeded(self) -> bool:
+        return self.finished and self.error is None and not self.stop_requested
+
+    def request_stop(self):
+        self.stop_requested = True
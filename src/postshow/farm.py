@@ -0,0 +1,613 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import subprocess
+import threading
+from typing import List, NamedTuple
+
+import mp3frames
+from model import PostShowError
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 8766
+# Each segment starts this many frames early, so that LAME's psychoacoustic
+# model has settled by the first frame that's kept.
+PREROLL_FRAMES = 8
+# And runs this many frames late, so that its last kept frame is complete.
+POSTROLL_FRAMES = 2
+DEFAULT_SEGMENT_SECONDS = 60
+# Segments shorter than this spend too much of their time on pre-roll.
+MIN_SEGMENT_FRAMES = 4 * PREROLL_FRAMES
+# A message header bigger than this isn't from PostShow.
+MAX_HEADER_SIZE = 64 * 1024
+CONNECT_TIMEOUT = 10
+PCM_BLOCK_SIZE = 1024 * 1024
+
+
+def parse_address(text: str, default_host: str = "localhost"):
+    """Parse a ``host:port`` address; on its own, a port is on ``default_host``.
+
+    :return: A ``(host, port)`` tuple.
+    """
+    host, separator, port = text.strip().rpartition(":")
+    try:
+        return (host if separator and host else default_host), int(port)
+    except ValueError:
+        raise PostShowError('"{}" isn\'t a host:port address.'.format(text))
+
+
+def samples_per_frame(sample_rate: int):
+    """The samples in each MP3 frame at ``sample_rate``, or None if MP3s can't
+    be that sample rate."""
+    for version, rates in mp3frames.SAMPLE_RATES.items():
+        if sample_rate in rates:
+            return 1152 if version == 3 else 576
+    return None
+
+
+def send_message(sock, header: dict, payload: bytes = b"") -> None:
+    """Send a message: the length of its JSON header, the header, and then the
+    payload, whose length is in the header."""
+    data = json.dumps(dict(header, length=len(payload))).encode("utf-8")
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+    if payload:
+        sock.sendall(payload)
+
+
+def _read_exactly(fp, size: int) -> bytes:
+    data = fp.read(size)
+    if len(data) < size:
+        raise ConnectionError("The connection closed in the middle of a message.")
+    return data
+
+
+def read_message(fp):
+    """Read a message sent by ``send_message`` from a socket's file.
+
+    :return: A ``(header, payload)`` tuple.
+    """
+    size = int.from_bytes(_read_exactly(fp, 4), "big")
+    if size > MAX_HEADER_SIZE:
+        raise ConnectionError("That isn't a PostShow encode worker.")
+    header = json.loads(_read_exactly(fp, size))
+    length = header.get("length", 0)
+    return header, _read_exactly(fp, length) if length else b""
+
+
+def lame_command(request: dict) -> list:
+    """Build the LAME command to encode a segment.
+
+    Requests come from the network, so the command is built from checked
+    settings; nothing in the request goes on the command line as it is.  The
+    bit reservoir is turned off, so that every frame can be decoded without
+    the one before it, which means the pre-roll frames can be dropped.  The
+    sample rate is pinned, so that every segment is cut on the same frames.
+    """
+    from encoder import MP3Encoder
+
+    sample_rate = int(request["sample_rate"])
+    channels = int(request["channels"])
+    bitwidth = int(request["bitwidth"])
+    bitrate = str(int(request["bitrate"]))
+    mode = request["bitrate_mode"]
+    quality = float(request.get("vbr_quality") or MP3Encoder.DEFAULT_VBR_QUALITY)
+    if (
+        samples_per_frame(sample_rate) is None
+        or channels not in (1, 2)
+        or bitwidth not in (8, 16, 24, 32)
+        or mode not in ("cbr", "abr", "vbr")
+        or not 0 <= quality <= 9
+    ):
+        raise ValueError("unsupported settings")
+    khz = "{:g}".format(sample_rate / 1000)
+    return (
+        [MP3Encoder.find_lame(), "-t", "--quiet", "-r", "-s", khz, "--resample", khz]
+        + ["--bitwidth", str(bitwidth), "--unsigned" if bitwidth == 8 else "--signed"]
+        + ["--little-endian", "-m", "m" if channels == 1 else "j", "--nores"]
+        + MP3Encoder.lame_rate_options(bitrate, mode, quality)
+        + ["-", "-"]
+    )
+
+
+class SegmentRequestHandler(socketserver.StreamRequestHandler):
+    """Encode segments for another PostShow, one after another.
+
+    * The worker starts with a ``hello`` message, saying how many segments it
+      can encode at once.
+    * Each segment is an ``encode`` message with the audio's format and the
+      profile's bitrate settings, then ``pcm`` messages with the samples, then
+      an ``end`` message.
+    * The worker sends a ``progress`` message with the number of sample frames
+      LAME has been given after each ``pcm`` message, then an ``mp3`` message
+      with the encoded frames, or an ``error`` message.  An error says
+      ``"settings": true`` if the segment's settings aren't valid, which no
+      other worker would accept either.
+    """
+
+    # Set by ``serve``.
+    slots: threading.Semaphore = None
+    slot_count = 1
+
+    def handle(self):
+        send_message(
+            self.connection,
+            {"type": "hello", "version": PROTOCOL_VERSION, "slots": self.slot_count},
+        )
+        while True:
+            try:
+                request, _ = read_message(self.rfile)
+            except (ConnectionError, ValueError):
+                return
+            if request.get("type") != "encode":
+                return
+            with self.slots:
+                if not self._encode(request):
+                    return
+
+    def _encode(self, request: dict) -> bool:
+        """Encode one segment.
+
+        :return: False if the connection is finished with.
+        """
+        process = None
+        # The error to send instead of frames, if LAME can't be run
+        problem = None
+        try:
+            command = lame_command(request)
+            block_align = int(request["bitwidth"]) // 8 * int(request["channels"])
+        except (KeyError, TypeError, ValueError):
+            problem = {
+                "type": "error",
+                "settings": True,
+                "message": "The segment's settings aren't valid.",
+            }
+        output = []
+        reader = None
+        if problem is None:
+            try:
+                process = subprocess.Popen(
+                    command,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+            except OSError as e:
+                print("Couldn't start LAME: {}".format(e))
+                problem = {
+                    "type": "error",
+                    "message": "Couldn't start LAME: {}".format(e),
+                }
+        if process is not None:
+            reader = threading.Thread(
+                target=lambda: output.extend(
+                    (process.stdout.read(), process.stderr.read())
+                )
+            )
+            reader.start()
+        frames = 0
+        try:
+            while True:
+                header, payload = read_message(self.rfile)
+                if header.get("type") != "pcm":
+                    break
+                if process is None:
+                    # Keep reading, so the connection stays in step.
+                    continue
+                try:
+                    process.stdin.write(payload)
+                except BrokenPipeError:
+                    # LAME went away; its exit status says why.
+                    pass
+                frames += len(payload) // block_align
+                send_message(self.connection, {"type": "progress", "frames": frames})
+        except (ConnectionError, ValueError):
+            if process is not None:
+                process.kill()
+                reader.join()
+                process.wait()
+            return False
+        if process is None:
+            send_message(self.connection, problem)
+            return True
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        reader.join()
+        process.wait()
+        if process.returncode != 0:
+            errors = output[1].decode("utf-8", errors="replace").strip()
+            send_message(
+                self.connection,
+                {"type": "error", "message": "LAME failed: {}".format(errors)},
+            )
+        else:
+            send_message(self.connection, {"type": "mp3"}, output[0])
+        return True
+
+
+def serve(address: str, slots=None) -> None:
+    """Encode segments for other PostShows until interrupted.
+
+    There's no authentication, so only listen on a network you trust.
+
+    :param address: ``host:port`` to listen on; on its own, a port is on
+    localhost.
+    :param slots: How many segments to encode at once (default: one per CPU).
+    """
+    host, port = parse_address(address, default_host="127.0.0.1")
+    if slots is None:
+        slots = os.cpu_count() or 1
+    handler = type(
+        "BoundSegmentRequestHandler",
+        (SegmentRequestHandler,),
+        {"slots": threading.Semaphore(slots), "slot_count": slots},
+    )
+    server = socketserver.ThreadingTCPServer((host, port), handler)
+    server.daemon_threads = True
+    print(
+        "Encoding segments on {}:{}, {} at a time".format(
+            host, server.server_address[1], slots
+        )
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class Segment(NamedTuple):
+    """A stretch of the recording, encoded on its own."""
+
+    number: int
+    # The sample frames that belong to this segment; ``end`` is None for the
+    # last one.  Both are on MP3 frame boundaries.
+    start: int
+    end: int
+    # The sample frames sent to the worker, pre- and post-roll included.
+    read_start: int
+    read_end: int
+    # The MP3 frames of pre-roll to drop, and how many to keep after them
+    # (None for the rest).
+    skip_frames: int
+    keep_frames: int
+
+
+def plan_segments(sample_count: int, frame_samples: int, count: int) -> List[Segment]:
+    """Cut a recording into about ``count`` segments, on MP3 frame boundaries.
+
+    LAME delays its output by the same amount for every segment, so when a
+    segment starts on a frame boundary, its frames line up with the ones an
+    encode of the whole recording would have made.
+    """
+    total_frames = -(-sample_count // frame_samples)
+    per_segment = max(MIN_SEGMENT_FRAMES, -(-total_frames // max(1, count)))
+    segments = []
+    first = 0
+    while first < total_frames or not segments:
+        end = first + per_segment
+        skip = min(first, PREROLL_FRAMES)
+        if end >= total_frames:
+            end_sample = read_end = keep = None
+        else:
+            end_sample = end * frame_samples
+            read_end = min(sample_count, (end + POSTROLL_FRAMES) * frame_samples)
+            keep = per_segment
+        segments.append(
+            Segment(
+                len(segments),
+                first * frame_samples,
+                end_sample,
+                (first - skip) * frame_samples,
+                read_end,
+                skip,
+                keep,
+            )
+        )
+        first = end
+    return segments
+
+
+def trim_frames(data: bytes, skip: int, keep) -> bytes:
+    """Drop a segment's pre- and post-roll frames."""
+    index = mp3frames.FrameIndex()
+    index.feed(data)
+    if not index.valid or len(index) < skip + (keep or 0):
+        raise PostShowError("An encode worker sent back a broken segment.")
+    end = index.audio_length if keep is None else index.offset_of(skip + keep)
+    return data[index.offset_of(skip) : end]
+
+
+class SegmentFailed(Exception):
+    """A worker couldn't encode a segment, and nor will any other."""
+
+
+class WorkerFailed(Exception):
+    """A worker couldn't encode a segment, but another one might."""
+
+
+class SegmentedEncode:
+    """Encode a recording in segments on PostShow workers, and join them up.
+
+    Every connection to a worker takes the next segment from a shared queue,
+    so each worker ends up with as many as it can get through, and adding
+    workers speeds things up about linearly.  If a worker can't be reached or
+    goes away, its segment goes back in the queue for another one.
+
+    This stands in for LAME's process in ``MP3Encoder``: the joined frames come
+    out of ``stdout``, in order, as soon as each segment and the ones before it
+    are done, and it can be waited on and terminated.
+    """
+
+    def __init__(
+        self,
+        workers: List[str],
+        request: dict,
+        read_segment,
+        sample_count: int,
+        on_progress,
+        segment_seconds: float = DEFAULT_SEGMENT_SECONDS,
+    ):
+        """
+        :param workers: The ``host:port`` of each worker.
+        :param request: The audio's format (``sample_rate``, ``channels`` and
+        ``bitwidth``) and the profile's ``bitrate``, ``bitrate_mode`` and
+        ``vbr_quality``.
+        :param read_segment: A function that gives the PCM blocks from one
+        sample frame to another (None for the end), in the request's format.
+        :param on_progress: Called with the number of the recording's sample
+        frames that have been encoded so far.
+        """
+        self.workers = workers
+        self.request = dict(request, type="encode")
+        self.read_segment = read_segment
+        self.sample_count = sample_count
+        self.on_progress = on_progress
+        self.segment_seconds = segment_seconds
+        self.frame_samples = samples_per_frame(request["sample_rate"])
+        self.block_align = request["bitwidth"] // 8 * request["channels"]
+        self.returncode = None
+        self.error = None
+        # The number of the recording's sample frames that were read, once
+        # it's done
+        self.frames_read = None
+        read_fd, self._write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, "rb")
+        self.segments = []
+        self._queue = queue.Queue()
+        self._lock = threading.Condition()
+        self._results = {}
+        self._progress = {}
+        self._read = {}
+        self._sockets = []
+        self._running = 0
+        self._in_flight = 0
+        self._stopping = False
+        self._assembler = None
+        # Why the last worker to go away went, to explain it if they all do
+        self._worker_error = None
+
+    def _connect(self, address: str):
+        host, port = parse_address(address)
+        sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        # Segments can take a while to encode.
+        sock.settimeout(None)
+        fp = sock.makefile("rb")
+        hello, _ = read_message(fp)
+        if hello.get("version") != PROTOCOL_VERSION:
+            sock.close()
+            raise ConnectionError("It speaks a different version of the protocol.")
+        return sock, fp, max(1, int(hello.get("slots", 1)))
+
+    def start(self) -> None:
+        """Connect to the workers, and start sending them segments."""
+        connections = []
+        for address in self.workers:
+            try:
+                sock, fp, slots = self._connect(address)
+                connections.append((address, sock, fp))
+                for ignored in range(slots - 1):
+                    sock, fp, _ = self._connect(address)
+                    connections.append((address, sock, fp))
+            except (OSError, ValueError) as e:
+                print("Couldn't use the encode worker at {}: {}".format(address, e))
+        if len(connections) == 0:
+            os.close(self._write_fd)
+            self.returncode = 1
+            self.error = PostShowError("None of the encode workers could be reached.")
+            return
+        seconds = self.sample_count / self.request["sample_rate"]
+        count = max(len(connections), int(-(-seconds // self.segment_seconds)))
+        self.segments = plan_segments(self.sample_count, self.frame_samples, count)
+        print(
+            "Encoding {} segments on {} connections to {} workers".format(
+                len(self.segments),
+                len(connections),
+                len({address for address, sock, fp in connections}),
+            )
+        )
+        for segment in self.segments:
+            self._queue.put(segment)
+        self._running = len(connections)
+        for address, sock, fp in connections:
+            self._sockets.append(sock)
+            threading.Thread(
+                target=self._work, args=(address, sock, fp), daemon=True
+            ).start()
+        self._assembler = threading.Thread(target=self._assemble, daemon=True)
+        self._assembler.start()
+
+    def _next_segment(self):
+        """Take the next segment from the queue.
+
+        While other connections are still encoding, wait rather than give up:
+        if their worker goes away, their segment comes back.
+
+        :return: The segment, or None if there's nothing left to do.
+        """
+        with self._lock:
+            while not self._stopping and self.error is None:
+                try:
+                    segment = self._queue.get_nowait()
+                except queue.Empty:
+                    if self._in_flight == 0:
+                        return None
+                    self._lock.wait()
+                    continue
+                self._in_flight += 1
+                return segment
+        return None
+
+    def _work(self, address: str, sock, fp) -> None:
+        """Encode segments on one connection until there are none left."""
+        try:
+            while True:
+                segment = self._next_segment()
+                if segment is None:
+                    break
+                try:
+                    data = self._encode(sock, fp, segment)
+                except (OSError, ValueError, WorkerFailed) as e:
+                    # Retire this connection, rather than send it more segments
+                    # to fail.
+                    if not self._stopping:
+                        print(
+                            "Lost the encode worker at {}: {}; segment {} goes to "
+                            "another one".format(address, e, segment.number)
+                        )
+                        self._worker_error = e
+                    with self._lock:
+                        self._queue.put(segment)
+                        self._in_flight -= 1
+                        self._lock.notify_all()
+                    break
+                except (SegmentFailed, PostShowError) as e:
+                    with self._lock:
+                        self._in_flight -= 1
+                    self._fail(e)
+                    break
+                with self._lock:
+                    self._results[segment.number] = data
+                    self._in_flight -= 1
+                    self._lock.notify_all()
+        finally:
+            sock.close()
+            with self._lock:
+                self._running -= 1
+                self._lock.notify_all()
+
+    def _encode(self, sock, fp, segment: Segment) -> bytes:
+        """Send one segment to a worker, and wait for its frames."""
+        reply = {}
+        receiver = threading.Thread(
+            target=self._receive, args=(fp, segment, reply), daemon=True
+        )
+        receiver.start()
+        send_message(sock, self.request)
+        read = 0
+        for block in self.read_segment(segment.read_start, segment.read_end):
+            if self._stopping:
+                raise ConnectionAbortedError("Stopped")
+            for start in range(0, len(block), PCM_BLOCK_SIZE):
+                send_message(
+                    sock, {"type": "pcm"}, block[start : start + PCM_BLOCK_SIZE]
+                )
+            read += len(block) // self.block_align
+        send_message(sock, {"type": "end"})
+        receiver.join()
+        if "exception" in reply:
+            raise reply["exception"]
+        if reply.get("type") != "mp3":
+            message = reply.get("message", "The encode worker failed.")
+            if reply.get("settings"):
+                raise SegmentFailed(message)
+            raise WorkerFailed(message)
+        # The sample frames of the recording that belong to this segment
+        own = read - (segment.start - segment.read_start)
+        if segment.end is not None:
+            own = min(own, segment.end - segment.start)
+        with self._lock:
+            self._read[segment.number] = max(0, own)
+        return trim_frames(reply["payload"], segment.skip_frames, segment.keep_frames)
+
+    def _receive(self, fp, segment: Segment, reply: dict) -> None:
+        try:
+            while True:
+                header, payload = read_message(fp)
+                if header.get("type") != "progress":
+                    reply.update(header, payload=payload)
+                    return
+                self._report(segment, header.get("frames", 0))
+        except (OSError, ValueError) as e:
+            reply["exception"] = e
+
+    def _report(self, segment: Segment, frames: int) -> None:
+        own = frames - (segment.start - segment.read_start)
+        if segment.end is not None:
+            own = min(own, segment.end - segment.start)
+        with self._lock:
+            self._progress[segment.number] = max(0, own)
+            self.on_progress(sum(self._progress.values()))
+
+    def _assemble(self) -> None:
+        """Write each segment's frames out as soon as the ones before it are."""
+        try:
+            with os.fdopen(self._write_fd, "wb") as out:
+                for segment in self.segments:
+                    with self._lock:
+                        while (
+                            segment.number not in self._results
+                            and self.error is None
+                            and not self._stopping
+                            and self._running > 0
+                        ):
+                            self._lock.wait()
+                        data = self._results.pop(segment.number, None)
+                    if data is None:
+                        if self.error is None and not self._stopping:
+                            self.error = PostShowError(
+                                "The encode workers all went away before the "
+                                "recording was encoded (the last one: {}).".format(
+                                    self._worker_error
+                                )
+                            )
+                        break
+                    out.write(data)
+        except OSError as e:
+            # Nobody's reading the frames any more.
+            if self.error is None and not self._stopping:
+                self.error = e
+        with self._lock:
+            if self.error is None and not self._stopping:
+                self.frames_read = sum(self._read.values())
+                self.returncode = 0
+            else:
+                self.returncode = 1
+
+    def _fail(self, error: Exception) -> None:
+        with self._lock:
+            if self.error is None:
+                self.error = error
+            self._lock.notify_all()
+        self.terminate()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self._assembler is not None:
+            self._assembler.join()
+        return self.returncode
+
+    def terminate(self) -> None:
+        """Stop encoding, and hang up on the workers."""
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        for sock in self._sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
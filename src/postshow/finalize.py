@@ -0,0 +1,71 @@
+import hashlib
+import os.path
+from typing import NamedTuple
+
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+class FileDigest(NamedTuple):
+    """The length and checksum of a finished output file."""
+
+    path: str
+    length: int
+    sha256: str
+
+
+class DigestWriter:
+    """Write to a file while keeping track of its length and checksum."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+
+    def write(self, data) -> None:
+        self.fp.write(data)
+        self.sha256.update(data)
+        self.length += len(data)
+
+    def copy_from(self, src, start: int = 0, length=None) -> None:
+        """Copy ``length`` bytes (or everything) from ``src``, starting at ``start``."""
+        src.seek(start)
+        buffer = bytearray(DIGEST_BLOCK_SIZE)
+        view = memoryview(buffer)
+        remaining = length
+        while remaining is None or remaining > 0:
+            want = (
+                DIGEST_BLOCK_SIZE
+                if remaining is None
+                else min(remaining, DIGEST_BLOCK_SIZE)
+            )
+            count = src.readinto(view[:want])
+            if not count:
+                break
+            self.write(view[:count])
+            if remaining is not None:
+                remaining -= count
+
+    def result(self, path: str) -> FileDigest:
+        return FileDigest(path, self.length, self.sha256.hexdigest())
+
+
+def digest_file(path: str) -> FileDigest:
+    """Compute the digest of a file that was written without a DigestWriter."""
+    sha256 = hashlib.sha256()
+    length = 0
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(DIGEST_BLOCK_SIZE), b""):
+            sha256.update(block)
+            length += len(block)
+    return FileDigest(path, length, sha256.hexdigest())
+
+
+def staging_path_for(final_path: str, ext: str) -> str:
+    """Return the hidden staging path that sits next to ``final_path``.
+
+    Keeping the staging file in the same directory as the final file means
+    that finishing it is an atomic rename, so the final file is never seen
+    half-written.
+    """
+    directory, name = os.path.split(final_path)
+    return os.path.join(directory, ".{}.encoding.{}".format(name, ext))
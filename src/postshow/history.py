@@ -0,0 +1,197 @@
+import os
+import platform
+import sqlite3
+import statistics
+import time
+
+SCHEMA_VERSION = 1
+# How many recent runs the predictions are based on
+RECENT_RUNS = 20
+SCHEMA = """
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY,
+    finished_at REAL NOT NULL,
+    host TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    bitrate TEXT NOT NULL,
+    input_path TEXT,
+    input_bytes INTEGER,
+    duration_ms INTEGER NOT NULL
+);
+CREATE TABLE stages (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    wall_seconds REAL NOT NULL,
+    cpu_seconds REAL NOT NULL,
+    PRIMARY KEY (run_id, stage)
+);
+CREATE INDEX runs_by_host ON runs (host, bitrate, finished_at);
+"""
+
+
+def cpu_time() -> float:
+    """CPU time used by this process, and by the children it has waited for.
+
+    LAME's time only counts once it has exited.  This is for the whole
+    process, so jobs running at the same time are counted together.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class Stopwatch:
+    """Measures the wall-clock and CPU time of a stage."""
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = cpu_time()
+
+    def read(self):
+        """:return: A ``(wall_seconds, cpu_seconds)`` tuple."""
+        return time.perf_counter() - self.wall, cpu_time() - self.cpu
+
+
+class History:
+    """A SQLite database of how long every run took, on every machine.
+
+    It's used to predict how long a run will take before it starts, and to
+    show whether encoding is getting faster or slower over time.
+    """
+
+    def __init__(self, path: str, host=None):
+        self.path = path
+        self.host = host if host is not None else platform.node()
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA foreign_keys = ON")
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            with connection:
+                connection.executescript(SCHEMA)
+                connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        return connection
+
+    def record(
+        self,
+        profile: str,
+        bitrate: str,
+        duration_ms: int,
+        stages: dict,
+        input_path=None,
+    ) -> None:
+        """Save a finished run.
+
+        :param stages: The ``(wall_seconds, cpu_seconds)`` of each stage, by
+        name.
+        """
+        input_bytes = None
+        if input_path is not None and os.path.exists(input_path):
+            input_bytes = os.path.getsize(input_path)
+        connection = self._connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    "INSERT INTO runs (finished_at, host, profile, bitrate, "
+                    "input_path, input_bytes, duration_ms) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        time.time(),
+                        self.host,
+                        profile,
+                        bitrate,
+                        input_path,
+                        input_bytes,
+                        duration_ms,
+                    ),
+                )
+                connection.executemany(
+                    "INSERT INTO stages (run_id, stage, wall_seconds, cpu_seconds) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (cursor.lastrowid, stage, wall, cpu)
+                        for stage, (wall, cpu) in stages.items()
+                    ],
+                )
+        finally:
+            connection.close()
+
+    def _seconds_per_audio_second(self, connection, bitrate: str):
+        """The median time each stage takes, per second of audio.
+
+        Runs on this machine at this bitrate are best; failing that, this
+        machine at any bitrate, then any machine.
+        """
+        queries = [
+            ("r.host = ? AND r.bitrate = ?", (self.host, bitrate)),
+            ("r.host = ?", (self.host,)),
+            ("1", ()),
+        ]
+        for where, params in queries:
+            rows = connection.execute(
+                "SELECT s.stage, s.wall_seconds * 1000.0 / r.duration_ms "
+                "FROM stages s JOIN runs r ON r.id = s.run_id "
+                "WHERE r.id IN (SELECT r.id FROM runs r WHERE {} AND "
+                "r.duration_ms > 0 ORDER BY r.finished_at DESC LIMIT ?)".format(where),
+                params + (RECENT_RUNS,),
+            ).fetchall()
+            if rows:
+                rates = {}
+                for stage, rate in rows:
+                    rates.setdefault(stage, []).append(rate)
+                return {
+                    stage: statistics.median(values) for stage, values in rates.items()
+                }
+        return None
+
+    def predict(self, bitrate: str, duration_ms: int):
+        """Predict how long each stage of a run will take.
+
+        :return: A dict of seconds by stage name, or None if there's no
+        history to go on.
+        """
+        connection = self._connect()
+        try:
+            rates = self._seconds_per_audio_second(connection, bitrate)
+        finally:
+            connection.close()
+        if rates is None:
+            return None
+        return {stage: rate * duration_ms / 1000 for stage, rate in rates.items()}
+
+    def speed_report(self):
+        """Encoding speed (times realtime) by machine and month.
+
+        :return: A list of ``(host, month, runs, median_speed, best_speed)``
+        tuples, oldest first.
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT r.host, strftime('%Y-%m', r.finished_at, 'unixepoch'), "
+                "r.duration_ms / 1000.0 / s.wall_seconds "
+                "FROM runs r JOIN stages s ON s.run_id = r.id "
+                "WHERE s.stage = 'encode' AND s.wall_seconds > 0 "
+                "ORDER BY r.host, r.finished_at"
+            ).fetchall()
+        finally:
+            connection.close()
+        groups = {}
+        for host, month, speed in rows:
+            groups.setdefault((host, month), []).append(speed)
+        return [
+            (host, month, len(speeds), statistics.median(speeds), max(speeds))
+            for (host, month), speeds in groups.items()
+        ]
+
+
+def format_seconds(seconds: float) -> str:
+    """Say roughly how long something will take, for people."""
+    if seconds < 60:
+        seconds = max(1, int(round(seconds)))
+        return "{} second{}".format(seconds, "" if seconds == 1 else "s")
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return "{} minute{}".format(minutes, "" if minutes == 1 else "s")
+    return "{}h {:02d}m".format(minutes // 60, minutes % 60)
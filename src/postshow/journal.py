@@ -0,0 +1,91 @@
+import json
+import os
+import os.path
+import time
+
+JOURNAL_VERSION = 1
+# In pipeline order, so that the last one finished is the one to resume from.
+STAGES = ["encode", "tag"]
+
+
+class Journal:
+    """A record of the pipeline stages that have finished for one episode.
+
+    The journal lives next to the outputs, so that if PostShow crashes (or the
+    computer goes to sleep and never wakes up properly) after a long encode,
+    the next run for the same episode can pick up where this one left off.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.job = None
+        self.stages = {}
+        try:
+            with open(path, "r", encoding="utf-8") as fp:
+                data = json.load(fp)
+            if data.get("version") == JOURNAL_VERSION:
+                self.job = data["job"]
+                self.stages = data["stages"]
+        except (OSError, ValueError, KeyError):
+            # No journal, or one that was only half-written.  Either way,
+            # there's nothing to resume.
+            pass
+
+    @staticmethod
+    def fingerprint(input_path: str, **params) -> dict:
+        """Describe a job well enough to tell whether a journal belongs to it."""
+        stat = os.stat(input_path)
+        job = {
+            "input": os.path.abspath(input_path),
+            "input_size": stat.st_size,
+            "input_mtime_ns": stat.st_mtime_ns,
+        }
+        job.update(params)
+        return job
+
+    def resume_point(self, job: dict):
+        """Find the last finished stage that can be resumed from.
+
+        :return: A ``(stage, artifacts)`` tuple, or None if the job has to start
+        from the beginning.
+        """
+        if self.job != job:
+            return None
+        for stage in reversed(STAGES):
+            artifacts = self.stages.get(stage)
+            if artifacts is not None and os.path.exists(artifacts["path"]):
+                return stage, artifacts
+        return None
+
+    def begin(self, job: dict) -> None:
+        """Start a new journal for ``job``, forgetting anything already in it."""
+        self.job = job
+        self.stages = {}
+        self._write()
+
+    def complete(self, stage: str, path: str, **artifacts) -> None:
+        """Record that ``stage`` finished, and left its output at ``path``."""
+        if self.job is None:
+            return
+        artifacts["path"] = path
+        artifacts["finished_at"] = time.time()
+        self.stages[stage] = artifacts
+        self._write()
+
+    def discard(self) -> None:
+        """Delete the journal, because the job is done (or abandoned)."""
+        self.job = None
+        self.stages = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self) -> None:
+        partial = self.path + ".partial"
+        with open(partial, "w", encoding="utf-8") as fp:
+            json.dump(
+                {"version": JOURNAL_VERSION, "job": self.job, "stages": self.stages},
+                fp,
+            )
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(partial, self.path)
@@ -11,6 +11,8 @@
 # If you would like to ask questions about what things do (or complain about what I'm
 # putting you through), contact awoo@s0ph0s.dog or t.me/s0ph0s.
 
+import argparse
+import importlib.util
 import sys
 import traceback
 from typing import List
@@ -24,22 +26,39 @@ from PySide6.QtWidgets import (
     QWizard,
 )
 import IOSetupPage
-import MetadataPage
 import EncoderProgressPage
-import FinishPage
 import config
+import finalize
+import history
+import journal
 import model
+import mp3frames
+import profiling
+import tracing
 
 import os
 import tempfile
 import datetime
 import shutil
+import sqlite3
+import threading
+import time
 
 DEFAULT_CONFIG_PATH = os.path.join(
     QStandardPaths.writableLocation(QStandardPaths.GenericConfigLocation),
     "PostShow",
     "config.ini",
 )
+HISTORY_PATH = os.path.join(
+    QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation),
+    "PostShow",
+    "history.sqlite3",
+)
+BUMPER_CACHE_PATH = os.path.join(
+    QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation),
+    "PostShow",
+    "bumpers",
+)
 
 
 class Controller:
@@ -60,9 +79,9 @@ class Controller:
     def __init__(self, config_data):
         self.encoder: model.MP3Encoder | None = None
         self.config_data = config_data
-        self.skip_encoding = False
         self.metadata = None
         self.mp3_path = None
+        self.staging_path = None
         self.chapters = None
         self.tmp_path = tempfile.TemporaryDirectory()
         self.outdir = None
@@ -70,11 +89,131 @@ class Controller:
         self.profile = "default"
         self.encoder_progress_signal = EncoderProgressPage.ProgressUpdateEmitter()
         self.output_files = []
+        self.file_digests = {}
         self.markers_file = None
+        self.input_path = None
+        self.mcs: model.MCS | None = None
+        self.frame_index = None
+        # How many frames of intro bumper are in front of the episode, once
+        # the bumpers are spliced on (None until then).
+        self.intro_frames = None
+        self.journal: journal.Journal | None = None
+        self.job = None
+        self.resumed = False
+        self.duration_ms = None
+        self.stage_times = {}
+        # The stage process_episode is in, so a failure can be pinned on it
+        self.current_stage = None
+        # The (wall, CPU) seconds of each stage, for the run history
+        self.stage_usage = {}
+        self.tag_stopwatch: history.Stopwatch | None = None
+        # Where to record how long this run took, if anywhere
+        self.history: history.History | None = None
+        # Controllers for the other profiles published from this run.
+        self.fanout: List[Controller] = []
+        self.tag_thread: threading.Thread | None = None
+        self.tracer = tracing.NULL_TRACER
+        self.profiler = profiling.NULL_PROFILER
 
     def exit_handler(self):
         if self.encoder:
             self.encoder.request_stop()
+        for child in self.fanout:
+            child.exit_handler()
+
+    def set_profile(self, profile: str) -> None:
+        """Choose the profile, along with any profiles it's also published to.
+
+        A profile's ``also_publish`` key lists other profiles that get their own
+        tagged copy of the episode.  If their encode settings match, the audio
+        is only encoded once.
+        """
+        self.profile = profile
+        self.fanout = []
+        if tracing.wanted(self.config_data, profile):
+            self.tracer = tracing.Tracer(owner=self)
+        else:
+            self.tracer = tracing.NULL_TRACER
+        if profiling.wanted(self.config_data, profile):
+            self.profiler = profiling.StageProfiler(self.build_output_file_path)
+        else:
+            self.profiler = profiling.NULL_PROFILER
+        also_publish = self.config_data.get(profile, "also_publish", fallback="")
+        # Which profile writes to each file name, so that two of them can't
+        # overwrite each other's files
+        file_names = {self.output_file_name(profile): profile}
+        for name in also_publish.split(","):
+            name = name.strip()
+            if name == "" or name == profile:
+                continue
+            if name not in self.config_data or name == "DEFAULT":
+                raise model.PostShowError(
+                    "[{}] is also published to [{}], which doesn't exist.".format(
+                        profile, name
+                    )
+                )
+            file_name = self.output_file_name(name)
+            if file_name in file_names:
+                raise model.PostShowError(
+                    "[{}] and [{}] would both write {}; give them different "
+                    "slugs or filenames.".format(file_names[file_name], name, file_name)
+                )
+            file_names[file_name] = name
+            child = Controller(self.config_data)
+            child.profile = name
+            child.tracer = self.tracer
+            child.profiler = self.profiler
+            self.fanout.append(child)
+
+    def output_file_name(self, profile: str) -> str:
+        """The name a profile gives its MP3s, with the episode number left in."""
+        return self.config_data.get(profile, "filename").format(
+            slug=self.config_data.get(profile, "slug").lower(),
+            epnum="{epnum}",
+            ext="mp3",
+        )
+
+    def encode_key(self) -> tuple:
+        """Everything about the profile that changes the encoded audio."""
+        return (
+            self.config_data.get(self.profile, "bitrate"),
+            self.config_data.get(self.profile, "bitrate_mode", fallback="cbr"),
+            self.config_data.get(self.profile, "vbr_quality", fallback=None),
+            # Segments are encoded without the bit reservoir.
+            len(self.encode_workers()) > 0,
+            self.config_data.get(self.profile, "target_lufs", fallback=None),
+            self.config_data.get(self.profile, "max_true_peak", fallback=None),
+            self.config_data.get(self.profile, "intro_bumper", fallback=None),
+            self.config_data.get(self.profile, "outro_bumper", fallback=None),
+        )
+
+    def encoder_options(self) -> dict:
+        """The profile's settings for ``MP3Encoder``, besides the bitrate."""
+        return {
+            "target_lufs": self.config_data.getfloat(
+                self.profile, "target_lufs", fallback=None
+            ),
+            "max_true_peak": self.config_data.getfloat(
+                self.profile, "max_true_peak", fallback=-1.0
+            ),
+            "bitrate_mode": self.bitrate_mode(),
+            "vbr_quality": self.config_data.getfloat(
+                self.profile, "vbr_quality", fallback=None
+            ),
+            "workers": self.encode_workers(),
+            "segment_seconds": self.config_data.getfloat(
+                self.profile, "segment_seconds", fallback=None
+            ),
+        }
+
+    def encode_workers(self) -> list:
+        return config.encode_workers(self.config_data[self.profile])
+
+    def bitrate_mode(self) -> str:
+        return self.config_data.get(self.profile, "bitrate_mode", fallback="cbr")
+
+    def shares_encode(self, child) -> bool:
+        return child.encode_key() == self.encode_key()
 
     def reset_encoder(self):
         if self.encoder:
@@ -87,22 +226,137 @@ class Controller:
                 )
             self.encoder = None
             self.output_files = []
+            if self.staging_path and os.path.exists(self.staging_path):
+                os.remove(self.staging_path)
+            self.staging_path = None
+            if self.journal:
+                self.journal.discard()
             print("Encoder reset")
+        self.resumed = False
+        for child in self.fanout:
+            child.reset_encoder()
+
+    def open_journal(self, wav_path):
+        """Load the journal for this episode, if the output folder can hold one."""
+        self.journal = None
+        self.job = None
+        if not self.outdir or not os.access(self.outdir, os.W_OK):
+            return
+        self.journal = journal.Journal(
+            finalize.staging_path_for(self.build_output_file_path("mp3"), "journal")
+        )
+        self.job = journal.Journal.fingerprint(
+            wav_path,
+            profile=self.profile,
+            encode=list(self.encode_key()),
+        )
+
+    def find_resumable_stage(self, wav_path):
+        """Check for an unfinished run of this episode.
+
+        :return: The name of the last stage that finished, or None.
+        """
+        self.open_journal(wav_path)
+        if self.journal is None:
+            return None
+        resume_point = self.journal.resume_point(self.job)
+        if resume_point is None:
+            return None
+        return resume_point[0]
 
-    def start_encoder(self, wav_path):
-        # Encode the mp3 to a temp file first, then move it later
-        if not self.skip_encoding:
-            self.mp3_path = self.build_output_file_path(
-                "mp3", parent=self.tmp_path.name
+    def resume(self):
+        """Pick up an unfinished run from the last stage that finished."""
+        stage, artifacts = self.journal.resume_point(self.job)
+        self.duration_ms = artifacts.get("duration_ms")
+        self.intro_frames = artifacts.get("intro_frames")
+        if stage == "encode":
+            self.staging_path = artifacts["path"]
+            self.mp3_path = self.staging_path
+        else:
+            # The tagged MP3 is already in place; it just gets tagged again.
+            self.staging_path = None
+            self.mp3_path = artifacts["path"]
+        self.resumed = True
+        print("Resuming after the {} stage".format(stage))
+
+    @tracing.traced("start_encoder")
+    def start_encoder(self, input_path, resume=False):
+        # Encode the mp3 to a staging file first, then move it later
+        self.input_path = input_path
+        self.tracer.count_file_in(input_path)
+        for child in self.fanout:
+            child.input_path = input_path
+            if not self.shares_encode(child):
+                child.start_encoder(input_path)
+        if self.journal is None:
+            self.open_journal(input_path)
+        if resume:
+            self.resume()
+            return
+        if self.journal:
+            self.journal.begin(self.job)
+        self.staging_path = self.build_staging_file_path("mp3")
+        self.mp3_path = self.staging_path
+        bitrate = self.config_data.get(self.profile, "bitrate")
+        options = self.encoder_options()
+        if (
+            input_path.endswith(".mp3")
+            and options["target_lufs"] is None
+            and options["bitrate_mode"] == "cbr"
+            and model.MP3Passthrough.matches(input_path, bitrate)
+        ):
+            # It's already encoded the way this profile wants.
+            print("{} is already {} Kbps; copying it".format(input_path, bitrate))
+            self.encoder = model.MP3Passthrough(
+                input_path, self.mp3_path, self.encoder_progress_signal
             )
+        else:
             self.encoder = model.MP3Encoder(
-                wav_path,
+                input_path,
                 self.mp3_path,
-                self.config_data.get(self.profile, "bitrate"),
+                bitrate,
                 self.encoder_progress_signal,
+                **options,
             )
-            # Start the encoder on its own thread
-            self.encoder.start()
+        self.encoder.tracer = self.tracer
+        self.encoder.profiler = self.profiler
+        # Start the encoder on its own thread
+        self.encoder.start()
+
+    def run_preflight(self, wav_path, progress=None) -> List[str]:
+        """Check the recording (and chapter list) for problems before encoding.
+
+        A report is written next to the other outputs as ``.qa.json``.  This
+        needs NumPy, and is skipped without it.
+
+        :param progress: An optional function that's called with the fraction of
+        the recording that has been checked.
+        :return: A description of every problem found.
+        """
+        if not self.config_data.getboolean(self.profile, "preflight_qa", fallback=True):
+            return []
+        if importlib.util.find_spec("numpy") is None:
+            print("NumPy isn't installed, so the recording won't be checked")
+            return []
+        import analysis
+        import decoder
+        import publish
+
+        chapters = None
+        if self.markers_file:
+            mcs = model.MCS()
+            mcs.load(self.markers_file)
+            chapters = mcs.get()
+        report = analysis.preflight(
+            decoder.open_audio(wav_path), chapters, progress=progress
+        )
+        report_path = self.build_output_file_path("qa.json")
+        if report_path:
+            publish.write_manifest(report_path, report.as_dict())
+            self.output_files.append(report_path)
+        for problem in report.problems:
+            print("QA: {}".format(problem))
+        return report.problems
 
     def check_before_wreck(self) -> List[str]:
         outfiles = [
@@ -110,23 +364,32 @@ class Controller:
             self.build_output_file_path("lrc"),
             self.build_output_file_path("cue"),
             self.build_output_file_path("txt"),
+            self.build_output_file_path("chapters.json"),
         ]
         files_that_exist = []
         for file in outfiles:
             if file and os.path.exists(file):
                 files_that_exist.append(file)
+        for child in self.fanout:
+            files_that_exist.extend(child.check_before_wreck())
         return files_that_exist
 
     def set_metadata(self, metadata: model.EpisodeMetadata):
         self.metadata = metadata
         # Metadata conversion
         self.complete_metadata(self.profile)
+        for child in self.fanout:
+            child.outdir = self.outdir
+            child.markers_file = self.markers_file
+            child.set_metadata(model.EpisodeMetadata(metadata.number, metadata.name))
 
     def exit(self):
         if self.encoder is not None and self.encoder.started:
             print("Waiting for the encoder to stop...")
             self.encoder.request_stop()
             self.encoder.join()
+        for child in self.fanout:
+            child.exit()
 
     def build_output_file_path(self, ext: str, parent=None) -> str:
         """Create the path for an output file with the given extension.
@@ -146,38 +409,141 @@ class Controller:
         else:
             return os.path.join(parent, "encoding." + ext)
 
+    def build_staging_file_path(self, ext: str) -> str:
+        """Create the path that an output file is built at before it's finished.
+
+        The staging file is hidden in the output folder, next to where the
+        finished file will go.  Nothing is ever moved across filesystems, so
+        there's no reflink or ``copy_file_range`` fallback: the tagger rewrites
+        the audio behind the tag anyway, and renames the result into place.
+        """
+        if not os.access(self.outdir, os.W_OK):
+            raise model.PostShowError(
+                "The output folder {} isn't writable.".format(self.outdir)
+            )
+        return finalize.staging_path_for(self.build_output_file_path(ext), ext)
+
+    @tracing.traced("build_chapters")
+    @profiling.profiled("chapters")
     def build_chapters(self):
         """Create a chapter list"""
-        mcs = model.MCS(
+        self.mcs = model.MCS(
             metadata=self.metadata, media_filename=self.build_output_file_path("mp3")
         )
         if self.markers_file:
-            mcs.load(self.markers_file)
-            self.chapters = mcs.get()
-            lrc_path = self.build_output_file_path("lrc")
-            cue_path = self.build_output_file_path("cue")
-            txt_path = self.build_output_file_path("txt")
-            mcs.save(lrc_path, model.MCS.LRC)
-            mcs.save(cue_path, model.MCS.CUE)
-            mcs.save(txt_path, model.MCS.SIMPLE)
-            self.output_files.append(lrc_path)
-            self.output_files.append(cue_path)
-            self.output_files.append(txt_path)
+            self.mcs.load(self.markers_file)
+            self.tracer.count_file_in(self.markers_file)
+            self.chapters = self.mcs.get()
+            self.save_chapters()
             if self.metadata:
                 self.metadata.lyrics = "\n".join(
                     [chapter.text for chapter in self.chapters]
                 )
         else:
             print("markers_file was None")
+        for child in self.fanout:
+            child.build_chapters()
+
+    def save_chapters(self):
+        """Write the chapter list out in every format."""
+        for ext, marker_type in (
+            ("lrc", model.MCS.LRC),
+            ("cue", model.MCS.CUE),
+            ("txt", model.MCS.SIMPLE),
+            ("chapters.json", model.MCS.JSON_CHAPTERS),
+        ):
+            path = self.build_output_file_path(ext)
+            self.mcs.save(path, marker_type)
+            self.tracer.count_file_out(path)
+            if path not in self.output_files:
+                self.output_files.append(path)
+
+    def snap_chapters(self) -> bool:
+        """Move the chapters onto MP3 frame boundaries, if the profile asks.
 
+        This happens once the audio is encoded, because LAME may have
+        resampled it, and only when encoding from a WAV file, because the frame
+        boundaries depend on how LAME was fed the audio.  VBR and ABR chapters
+        are always snapped, so that their CHAP frames get byte offsets: players
+        can't work out where a time is in VBR audio any closer than the Xing
+        table of contents says.
+
+        :return: True if the chapters were moved.
+        """
+        if (
+            not self.config_data.getboolean(
+                self.profile, "snap_chapters", fallback=False
+            )
+            and self.bitrate_mode() == "cbr"
+        ):
+            return False
+        if self.input_path is None or self.input_path.endswith(".mp3"):
+            return False
+        import decoder
+
+        if self.load_frame_index() is None:
+            print("Couldn't find the MP3 frames, so chapters won't be snapped")
+            return False
+        window_ms = self.config_data.getfloat(
+            self.profile, "snap_window_ms", fallback=0
+        )
+        mp3frames.snap_chapters(
+            self.chapters,
+            self.frame_index,
+            decoder.open_audio(self.input_path),
+            window_ms,
+        )
+        return True
+
+    def load_frame_index(self):
+        """Get the frame index of the encoded audio.
+
+        The encoder builds one as it goes; otherwise (when resuming, say) the
+        MP3 is scanned for its frames.
+        """
+        if self.frame_index is None:
+            audio_path = self.staging_path or self.mp3_path
+            with open(audio_path, "rb") as fp:
+                audio_start = mp3frames.id3v2_size(fp)
+            self.frame_index = mp3frames.FrameIndex.scan(audio_path, audio_start)
+        return self.frame_index
+
+    @tracing.traced("do_tag")
     def do_tag(self):
         """Tag the file, and do step 8.
 
         8. Exit
+
+        The copies for the other profiles are written on the same thread,
+        before this profile's, so that the tagger only reports that it's done
+        once all of them are.
         """
         if not self.metadata:
             return
-        t = model.MP3Tagger(self.mp3_path, self.encoder_progress_signal)
+        self.tag_stopwatch = history.Stopwatch()
+        self.build_tagger()
+        for child in self.fanout:
+            child.build_tagger()
+        self.tag_thread = threading.Thread(target=self.run_taggers)
+        self.tag_thread.start()
+
+    @tracing.traced("run_taggers")
+    @profiling.profiled("tag")
+    def run_taggers(self):
+        for child in self.fanout:
+            child.tagger.write()
+        self.tagger.run()
+
+    def build_tagger(self) -> "model.MP3Tagger":
+        """Create the tagger and fill in the tags, ready to write the MP3."""
+        t = model.MP3Tagger(
+            self.staging_path or self.mp3_path,
+            self.encoder_progress_signal,
+            output_path=self.mp3_path,
+            length_ms=self.duration_ms,
+        )
+        t.frame_index = self.frame_index
+        t.tracer = self.tracer
         self.tagger = t
         t.set_title(self.metadata.title)
         t.set_album(self.metadata.album)
@@ -201,8 +567,10 @@ class Controller:
             t.add_chapters(self.chapters)
         if "cover_art" in self.config_data[self.profile].keys():
             t.set_cover_art(self.config_data.get(self.profile, "cover_art"))
-        t.start()
+        return t
 
+    @tracing.traced("progress_view_finished")
+    @profiling.profiled("encode_finished")
     def progress_view_finished(self):
         """Do steps 6 and 7.
 
@@ -210,22 +578,437 @@ class Controller:
         7. Save the tags to the file, which will lock up the UI ( threading :( )
 
         This method is supposed to be called by the EncoderProgress view
-        after it finishes.
+        after it finishes.  The encoded audio stays in the staging file until
+        the tagger writes the finished MP3.
         """
         # This isn't inside the if so that do_tag doesn't fail
         self.mp3_path = self.build_output_file_path("mp3")
         # Join the encoder thread, since tagging can't occur until it is
         # done
-        if not self.skip_encoding and self.encoder:
+        if self.encoder:
             self.encoder.join()
-            output_mp3 = self.build_output_file_path("mp3", parent=self.tmp_path.name)
-            if output_mp3 and self.mp3_path:
-                shutil.move(
-                    output_mp3,
+            if not self.encoder.succeeded:
+                raise model.PostShowError("The encoder did not finish successfully.")
+            self.duration_ms = self.encoder.duration_ms
+            self.frame_index = self.encoder.frame_index
+            if self.encoder.usage is not None:
+                self.stage_usage["encode"] = self.encoder.usage
+            if self.journal and self.staging_path:
+                self.journal.complete(
+                    "encode", self.staging_path, duration_ms=self.duration_ms
+                )
+        self.splice_bumpers()
+        self.place_chapters()
+        for child in self.fanout:
+            if self.shares_encode(child):
+                # Tag straight from this profile's encode.
+                child.mp3_path = child.build_output_file_path("mp3")
+                child.staging_path = self.staging_path or self.mp3_path
+                child.duration_ms = self.duration_ms
+                child.frame_index = self.frame_index
+                child.intro_frames = self.intro_frames
+                child.place_chapters()
+            else:
+                child.progress_view_finished()
+
+    def encode_bumper(self, source: str, mp3_path: str, **options) -> int:
+        """Encode a bumper the same way as the episode.
+
+        :param options: ``MP3Encoder`` options that override the profile's.
+        :return: The number of samples of real audio in the MP3.
+        """
+        encoder = model.MP3Encoder(
+            source,
+            mp3_path,
+            self.config_data.get(self.profile, "bitrate"),
+            EncoderProgressPage.ProgressUpdateEmitter(),
+            **dict(self.encoder_options(), **options),
+        )
+        encoder.run()
+        if not encoder.succeeded:
+            raise model.PostShowError("Couldn't encode {}.".format(source))
+        return round(
+            encoder.sample_count * encoder.frame_index.sample_rate / encoder.sample_rate
+        )
+
+    def render_previews(
+        self, recording_path, markers_path, number, clips=False, window_seconds=None
+    ) -> List[str]:
+        """Encode just the few seconds either side of each chapter start, so the
+        markers can be checked by ear without scrubbing through the episode.
+
+        The windows are encoded in parallel with the profile's settings, but
+        without loudness normalization, which would mean measuring the whole
+        recording first.  ``outdir`` must be set before calling this.
+
+        :param clips: Write one MP3 per chapter, rather than joining them into
+        one MP3 with a CUE sheet that has a track for each chapter.
+        :param window_seconds: How much to hear either side of each chapter
+        start.
+        :return: The paths of the files written.
+        """
+        import decoder
+        import preview
+
+        if window_seconds is None:
+            window_seconds = preview.DEFAULT_WINDOW_SECONDS
+        self.set_metadata(model.EpisodeMetadata(number, "Preview"))
+        mcs = model.MCS()
+        mcs.load(markers_path)
+        audio = decoder.open_audio(recording_path)
+        windows = preview.plan_windows(
+            mcs.get(), audio.sample_rate, audio.frame_count, window_seconds
+        )
+        if clips:
+
+            def path_for(window):
+                return self.build_output_file_path(
+                    "preview{:02d}.mp3".format(window.number)
+                )
+
+        else:
+
+            def path_for(window):
+                return os.path.join(
+                    self.tmp_path.name, "preview{:02d}.mp3".format(window.number)
+                )
+
+        previews = preview.render(
+            windows,
+            path_for,
+            lambda window, path: self.encode_bumper(
+                recording_path,
+                path,
+                target_lufs=None,
+                frame_range=(window.start, window.end),
+            ),
+        )
+        if clips:
+            for clip in previews:
+                preview.tag_clip(clip)
+            paths = [clip.path for clip in previews]
+            lines = preview.describe(previews, [0] * len(previews), audio.sample_rate)
+        else:
+            mp3_path = self.build_output_file_path("preview.mp3")
+            cue_path = self.build_output_file_path("preview.cue")
+            starts = preview.join(previews, mp3_path)
+            preview.write_cue(cue_path, mp3_path, previews, starts, audio.sample_rate)
+            paths = [mp3_path, cue_path]
+            lines = preview.describe(previews, starts, audio.sample_rate, mp3_path)
+        for line in lines:
+            print(line)
+        return paths
+
+    @tracing.traced("splice_bumpers")
+    def splice_bumpers(self) -> None:
+        """Put the profile's intro and outro bumpers around the encoded episode.
+
+        Bumpers are encoded with the profile's settings the first time they're
+        used, and cached.  The frames are joined without re-encoding anything.
+        """
+        intro = self.config_data.get(self.profile, "intro_bumper", fallback=None)
+        outro = self.config_data.get(self.profile, "outro_bumper", fallback=None)
+        if intro is None and outro is None:
+            return
+        if self.intro_frames is not None or self.staging_path is None:
+            # Already spliced, in the run that's being resumed.
+            return
+        import splice
+
+        if self.load_frame_index() is None:
+            raise model.PostShowError("Couldn't find the MP3 frames to splice onto.")
+        if self.encoder is not None and self.encoder.sample_count is not None:
+            samples = round(
+                self.encoder.sample_count
+                * self.frame_index.sample_rate
+                / self.encoder.sample_rate
+            )
+        else:
+            samples = round(self.duration_ms * self.frame_index.sample_rate / 1000)
+        episode = splice.load_segment(self.staging_path, samples)
+        segments = [episode]
+        if intro is not None:
+            segments.insert(
+                0,
+                splice.cached_bumper(
+                    intro, BUMPER_CACHE_PATH, self.encode_key(), self.encode_bumper
+                ),
+            )
+        if outro is not None:
+            segments.append(
+                splice.cached_bumper(
+                    outro, BUMPER_CACHE_PATH, self.encode_key(), self.encode_bumper
+                )
+            )
+        self.intro_frames = len(segments[0].index) if intro is not None else 0
+        for segment in segments:
+            self.tracer.count_in(segment.index.audio_length)
+        self.frame_index, samples = splice.splice(segments, self.staging_path)
+        self.tracer.count_file_out(self.staging_path)
+        self.duration_ms = int(round(samples * 1000 / self.frame_index.sample_rate, 0))
+        if self.journal:
+            self.journal.complete(
+                "encode",
+                self.staging_path,
+                duration_ms=self.duration_ms,
+                intro_frames=self.intro_frames,
+            )
+
+    def place_chapters(self) -> None:
+        """Snap the chapters and move them past the intro, once the audio is final.
+
+        The chapter files are written again if anything moved.
+        """
+        if not self.chapters:
+            return
+        moved = self.snap_chapters()
+        if self.intro_frames:
+            index = self.load_frame_index()
+            offset_ms = (
+                self.intro_frames * index.samples_per_frame * 1000 / index.sample_rate
+            )
+            for chapter in self.chapters:
+                if chapter.frame is not None:
+                    chapter.frame += self.intro_frames
+                    chapter.end_frame += self.intro_frames
+                    chapter.start = mp3frames.frame_start_ms(chapter.frame, index)
+                    chapter.end = mp3frames.frame_start_ms(chapter.end_frame, index)
+                else:
+                    chapter.start = int(round(chapter.start + offset_ms, 0))
+                    chapter.end = int(round(chapter.end + offset_ms, 0))
+            moved = True
+        if moved:
+            self.save_chapters()
+
+    @tracing.traced("tagging_finished")
+    @profiling.profiled("publish")
+    def tagging_finished(self):
+        """Clean up after the tagger and write the publish manifest.
+
+        This method is supposed to be called by the EncoderProgress view
+        once the tagger reports that it's done.
+        """
+        if self.tag_stopwatch is not None:
+            self.stage_usage["tag"] = self.tag_stopwatch.read()
+        stopwatch = history.Stopwatch()
+        for child in self.fanout:
+            if self.shares_encode(child):
+                # The staging file is this controller's to clean up.
+                child.staging_path = None
+        if self.staging_path:
+            if self.staging_path != self.mp3_path and os.path.exists(self.staging_path):
+                os.remove(self.staging_path)
+            self.staging_path = None
+            self.tmp_path.cleanup()
+        if self.tagger and self.tagger.digest:
+            self.file_digests[self.mp3_path] = self.tagger.digest
+            if self.journal:
+                self.journal.complete(
+                    "tag",
                     self.mp3_path,
+                    duration_ms=self.tagger.length_ms,
+                    intro_frames=self.intro_frames,
                 )
-                self.output_files.append(self.mp3_path)
-                self.tmp_path.cleanup()
+        if self.mp3_path and self.mp3_path not in self.output_files:
+            self.output_files.append(self.mp3_path)
+        self.write_rss_item()
+        self.write_seek_index()
+        self.split_chapters()
+        self.write_manifest()
+        if self.journal:
+            self.journal.discard()
+        for child in self.fanout:
+            child.tagging_finished()
+            self.output_files.extend(child.output_files)
+        self.stage_usage["publish"] = stopwatch.read()
+
+    def run_finished(self):
+        """Record the finished run, once everything's done."""
+        self.write_trace()
+        self.record_history()
+
+    def record_history(self):
+        """Add this run's timings to the run history.
+
+        Resumed runs aren't recorded, since they skipped the encode.
+        """
+        if self.history is None or "encode" not in self.stage_usage:
+            return
+        if not self.config_data.getboolean(
+            self.profile, "record_history", fallback=True
+        ):
+            return
+        if self.duration_ms is None:
+            return
+        try:
+            self.history.record(
+                self.profile,
+                self.config_data.get(self.profile, "bitrate"),
+                self.duration_ms,
+                self.stage_usage,
+                input_path=self.input_path,
+            )
+        except (sqlite3.Error, OSError) as e:
+            print("Couldn't record this run in the history:", e)
+
+    @staticmethod
+    def input_duration_ms(input_path: str):
+        """The length of a recording, from its header, or None if it can't be
+        read without decoding it."""
+        if input_path.endswith(".mp3"):
+            return None
+        import decoder
+
+        return decoder.open_audio(input_path).duration_ms
+
+    def predict_seconds(self, duration_ms=None):
+        """Predict how long each stage will take, from the run history.
+
+        :param duration_ms: The length of the recording.  If not provided, the
+        length that the encoder found is used.
+        :return: A dict of seconds by stage name, or None if there's no history
+        to go on.
+        """
+        if duration_ms is None and self.encoder is not None:
+            duration_ms = self.encoder.duration_ms
+        if self.history is None or duration_ms is None:
+            return None
+        try:
+            return self.history.predict(
+                self.config_data.get(self.profile, "bitrate"), duration_ms
+            )
+        except (sqlite3.Error, OSError) as e:
+            print("Couldn't read the run history:", e)
+            return None
+
+    def write_trace(self):
+        """Export the trace of this run, if tracing is on, next to the outputs.
+
+        This is called once everything's finished, so that every span is in it.
+        """
+        if self.tracer.owner is not self:
+            return
+        trace_path = self.build_output_file_path("trace.json")
+        if trace_path is None:
+            return
+        self.tracer.export(trace_path)
+        print("Wrote a trace of this run to {}".format(trace_path))
+
+    def build_publish_url(self, key: str, path: str):
+        """Fill in a URL pattern from the config, like ``media_url``."""
+        pattern = self.config_data.get(self.profile, key, fallback=None)
+        if pattern is None:
+            return None
+        return pattern.format(
+            slug=self.config_data.get(self.profile, "slug").lower(),
+            epnum=self.metadata.number,
+            filename=os.path.basename(path),
+        )
+
+    @tracing.traced("write_rss_item")
+    def write_rss_item(self):
+        """Write an RSS ``<item>`` fragment for the episode."""
+        mp3_digest = self.file_digests.get(self.mp3_path)
+        if not self.metadata or mp3_digest is None:
+            return
+        import publish
+
+        chapters_path = self.build_output_file_path("chapters.json")
+        chapters_url = None
+        if chapters_path in self.output_files:
+            chapters_url = self.build_publish_url("chapters_url", chapters_path)
+        item = publish.build_rss_item(
+            title=self.metadata.title,
+            media_url=self.build_publish_url("media_url", self.mp3_path)
+            or os.path.basename(self.mp3_path),
+            media_length=mp3_digest.length,
+            duration_ms=self.get_mp3_length_ms(),
+            guid=os.path.splitext(os.path.basename(self.mp3_path))[0],
+            episode=self.metadata.number,
+            season=self.metadata.season,
+            chapters_url=chapters_url,
+        )
+        item_path = self.build_output_file_path("item.xml")
+        publish.write_rss_item(item_path, item)
+        self.tracer.count_file_out(item_path)
+        self.output_files.append(item_path)
+
+    @tracing.traced("write_seek_index")
+    def write_seek_index(self):
+        """Write a table of where every frame (and chapter) is in the MP3."""
+        if not self.config_data.getboolean(self.profile, "seek_index", fallback=False):
+            return
+        if self.tagger is None or self.tagger.tag_size is None:
+            return
+        if self.load_frame_index() is None:
+            print("Couldn't find the MP3 frames, so there's no seek index")
+            return
+        import publish
+
+        index_path = self.build_output_file_path("seek")
+        publish.write_seek_index(
+            index_path,
+            publish.build_seek_index(
+                self.frame_index, self.tagger.tag_size, self.chapters
+            ),
+        )
+        self.tracer.count_file_out(index_path)
+        self.output_files.append(index_path)
+
+    @tracing.traced("split_chapters")
+    def split_chapters(self):
+        """Cut the finished MP3 into one file per chapter, if the profile asks."""
+        if not self.config_data.getboolean(
+            self.profile, "split_chapters", fallback=False
+        ):
+            return
+        if not self.chapters or self.tagger is None or self.tagger.tag_size is None:
+            return
+        if self.load_frame_index() is None:
+            print("Couldn't find the MP3 frames, so the chapters can't be split")
+            return
+        import split
+
+        clips = split.plan_clips(
+            self.chapters,
+            self.frame_index,
+            lambda number: self.build_output_file_path("ch{:02d}.mp3".format(number)),
+        )
+        digests = split.split(
+            self.mp3_path,
+            self.frame_index,
+            self.tagger.tag_size,
+            self.tagger.tag,
+            clips,
+        )
+        for digest in digests:
+            self.tracer.count_out(digest.length)
+            self.file_digests[digest.path] = digest
+            self.output_files.append(digest.path)
+
+    @tracing.traced("write_manifest")
+    def write_manifest(self):
+        """Write a JSON manifest listing the length and checksum of every output."""
+        if not self.metadata:
+            return
+        import publish
+
+        digests = []
+        for path in self.output_files:
+            if path not in self.file_digests:
+                # The marker files are tiny, so reading them back is cheap.
+                self.file_digests[path] = finalize.digest_file(path)
+            digests.append(self.file_digests[path])
+        manifest = publish.build_manifest(
+            self.metadata,
+            self.profile,
+            digests,
+            {self.mp3_path: self.get_mp3_length_ms()},
+        )
+        manifest_path = self.build_output_file_path("manifest.json")
+        publish.write_manifest(manifest_path, manifest)
+        self.tracer.count_file_out(manifest_path)
+        self.output_files.append(manifest_path)
 
     def complete_metadata(self, profile_name: str) -> None:
         """Complete the metadata using the config file.
@@ -265,6 +1048,39 @@ class Controller:
         else:
             return 0
 
+    def process_episode(self, wav_path, markers_path, number, name):
+        """Run the whole pipeline for one episode, without the wizard.
+
+        ``profile`` and ``outdir`` must be set before calling this.  It blocks
+        until the episode is finished, and records how long each stage took in
+        ``stage_times``.
+        """
+        self.markers_file = markers_path
+        self.set_metadata(model.EpisodeMetadata(number, name))
+        started = time.perf_counter()
+        self.current_stage = "encode"
+        stage = self.find_resumable_stage(wav_path)
+        self.start_encoder(wav_path, resume=stage is not None)
+        self.build_chapters()
+        if self.encoder:
+            self.encoder.join()
+        self.progress_view_finished()
+        self.stage_times["encode"] = time.perf_counter() - started
+        started = time.perf_counter()
+        self.current_stage = "tag"
+        self.do_tag()
+        if self.tag_thread:
+            self.tag_thread.join()
+            if self.tagger.digest is None:
+                raise model.PostShowError("Tagging {} failed.".format(self.mp3_path))
+        self.stage_times["tag"] = time.perf_counter() - started
+        started = time.perf_counter()
+        self.current_stage = "publish"
+        self.tagging_finished()
+        self.stage_times["publish"] = time.perf_counter() - started
+        self.run_finished()
+        self.current_stage = None
+
 
 def config_wizard(default_config_path) -> bool:
     wizard_box = QMessageBox(
@@ -294,19 +1110,213 @@ def config_wizard(default_config_path) -> bool:
             os.path.join(basedir, "data", "template_config.ini"),
             default_config_path,
         )
-    show_config()
+    show_config(default_config_path)
     return True
 
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="PostShow",
+        description="Encode and tag podcast episodes.  Without any options, the "
+        "wizard is shown.",
+    )
+    parser.add_argument(
+        "--config",
+        default=DEFAULT_CONFIG_PATH,
+        help="Path to the config file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Process recordings dropped in each profile's watch_folder, "
+        "instead of showing the wizard",
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        nargs="?",
+        const=8765,
+        metavar="PORT",
+        help="Accept jobs over HTTP on localhost (default port: %(const)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="How many episodes to process at the same time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between checks of the watch folders (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=10.0,
+        help="How long a file must stay unchanged before it's picked up "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--status-file",
+        help="Keep a JSON file with the queue depth and job timings up to date",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Keep an OpenMetrics textfile of throughput counters up to date, "
+        "for node_exporter's textfile collector (name it *.prom)",
+    )
+    parser.add_argument(
+        "--encode-worker",
+        metavar="[HOST:]PORT",
+        help="Encode segments for other PostShows' encode_workers, instead of "
+        "showing the wizard.  Only listens on localhost unless HOST says "
+        "otherwise; there's no authentication, so only use a trusted network",
+    )
+    parser.add_argument(
+        "--encode-slots",
+        type=int,
+        help="How many segments to encode at once as an encode worker "
+        "(default: one per CPU)",
+    )
+    parser.add_argument(
+        "--preview",
+        nargs=2,
+        metavar=("RECORDING", "MARKERS"),
+        help="Encode a few seconds either side of each chapter start, to check "
+        "the markers by ear, instead of showing the wizard",
+    )
+    parser.add_argument(
+        "--episode",
+        default="0",
+        help="The episode number, for naming the preview files (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile",
+        default="default",
+        help="The profile to preview with (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Where to write the previews (default: next to the recording)",
+    )
+    parser.add_argument(
+        "--preview-seconds",
+        type=float,
+        help="How much to hear either side of each chapter start (default: 5)",
+    )
+    parser.add_argument(
+        "--preview-clips",
+        action="store_true",
+        help="Write one MP3 per chapter, instead of one MP3 and a CUE sheet",
+    )
+    parser.add_argument(
+        "--history-report",
+        action="store_true",
+        help="Show how fast episodes have encoded on each machine, by month",
+    )
+    # Ignore anything else, like the -psn_ argument macOS passes to app bundles.
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def run_daemon(args):
+    import daemon
+
+    config_data = config.check_config(args.config)
+    folders = []
+    if args.daemon:
+        folders = daemon.watch_folders_from_config(config_data, args.settle_seconds)
+        if len(folders) == 0:
+            raise model.PostShowError(
+                "No profile has a watch_folder, so there's nothing to watch."
+            )
+    run_history = history.History(HISTORY_PATH)
+
+    def make_controller():
+        controller = Controller(config_data)
+        controller.history = run_history
+        return controller
+
+    run_metrics = None
+    if args.metrics_file is not None:
+        import metrics
+
+        run_metrics = metrics.Metrics()
+    runner = daemon.JobRunner(make_controller, args.workers, metrics=run_metrics)
+    if args.serve is not None:
+        import service
+
+        service.serve(config_data, runner, args.serve)
+    daemon.run(
+        runner,
+        folders,
+        poll_interval=args.poll_interval,
+        status_path=args.status_file,
+        metrics_path=args.metrics_file,
+    )
+
+
+def run_preview(args):
+    recording_path, markers_path = args.preview
+    controller = Controller(config.check_config(args.config))
+    controller.set_profile(args.profile)
+    controller.outdir = args.output_dir or os.path.dirname(
+        os.path.abspath(recording_path)
+    )
+    controller.render_previews(
+        recording_path,
+        markers_path,
+        args.episode,
+        clips=args.preview_clips,
+        window_seconds=args.preview_seconds,
+    )
+
+
+def print_history_report():
+    rows = history.History(HISTORY_PATH).speed_report()
+    if len(rows) == 0:
+        print("No runs have been recorded yet.")
+        return
+    print(
+        "{:24} {:8} {:>5} {:>14} {:>12}".format(
+            "Machine", "Month", "Runs", "Median speed", "Best speed"
+        )
+    )
+    for host, month, runs, median, best in rows:
+        print(
+            "{:24} {:8} {:5d} {:13.1f}x {:11.1f}x".format(
+                host, month, runs, median, best
+            )
+        )
+
+
 def main():
+    args = parse_args(sys.argv[1:])
+    if args.history_report:
+        print_history_report()
+        return
+    if args.preview is not None:
+        run_preview(args)
+        return
+    if args.encode_worker is not None:
+        import farm
+
+        farm.serve(args.encode_worker, args.encode_slots)
+        return
+    if args.daemon or args.serve is not None:
+        run_daemon(args)
+        return
     app = QApplication([])
-    if not os.path.exists(DEFAULT_CONFIG_PATH):
-        if not config_wizard(DEFAULT_CONFIG_PATH):
+    if not os.path.exists(args.config):
+        if not config_wizard(args.config):
             return
     try:
-        config_data = config.check_config(DEFAULT_CONFIG_PATH)
+        config_data = config.check_config(args.config)
         controller = Controller(config_data)
-        wizard = PostShowWizard(controller)
+        controller.history = history.History(HISTORY_PATH)
+        wizard = PostShowWizard(controller, args.config)
         wizard.show()
         sys.exit(app.exec())
     except model.PostShowError as pse:
@@ -326,8 +1336,8 @@ def main():
             qem.exec()
 
 
-@Slot()
-def show_config():
+@Slot(str)
+def show_config(config_path):
     QMessageBox.information(
         None,
         "Opening Config",
@@ -338,25 +1348,61 @@ def show_config():
     product_type = QSysInfo.productType()
     if product_type == "macos":
         p = QProcess()
-        p.startDetached("open", ["-e", DEFAULT_CONFIG_PATH])
+        p.startDetached("open", ["-e", config_path])
     else:
-        default_config_url = QUrl.fromLocalFile(DEFAULT_CONFIG_PATH)
-        QDesktopServices.openUrl(default_config_url)
+        config_url = QUrl.fromLocalFile(config_path)
+        QDesktopServices.openUrl(config_url)
     sys.exit(0)
 
 
 class PostShowWizard(QWizard):
-    def __init__(self, controller):
+    """The wizard.  Pages after the first are built when they're first needed.
+
+    The progress page is the exception: it has to be listening to the encoder,
+    which starts as soon as the first page is done.
+    """
+
+    IO_PAGE = 0
+    METADATA_PAGE = 1
+    PROGRESS_PAGE = 2
+    FINISH_PAGE = 3
+
+    def __init__(self, controller, config_path=DEFAULT_CONFIG_PATH):
         super().__init__()
+        self.controller = controller
         self.setButtonText(QWizard.CommitButton, "Encode")
         self.setButtonText(QWizard.HelpButton, "Open Config")
-        self.addPage(IOSetupPage.InputOutputPage(controller))
-        self.addPage(MetadataPage.MetadataPage(controller))
-        self.addPage(EncoderProgressPage.EncoderProgressPage(controller))
-        self.addPage(FinishPage.FinishPage(controller))
+        self.setPage(self.IO_PAGE, IOSetupPage.InputOutputPage(controller))
+        self.setPage(
+            self.PROGRESS_PAGE, EncoderProgressPage.EncoderProgressPage(controller)
+        )
         self.setWindowTitle("Encode and Tag Podcast Episode")
         self.setOption(QWizard.HaveHelpButton, True)
-        self.helpRequested.connect(show_config)
+        self.helpRequested.connect(lambda: show_config(config_path))
+
+    def build_page(self, page_id: int):
+        if page_id == self.METADATA_PAGE:
+            import MetadataPage
+
+            return MetadataPage.MetadataPage(self.controller)
+        import FinishPage
+
+        return FinishPage.FinishPage(self.controller)
+
+    def nextId(self) -> int:
+        # The next page may not have been built yet, so QWizard can't find it.
+        if self.currentId() < self.FINISH_PAGE:
+            return self.currentId() + 1
+        return -1
+
+    def validateCurrentPage(self) -> bool:
+        """Build the next page, if it hasn't been, once it's OK to go to it."""
+        if not super().validateCurrentPage():
+            return False
+        next_id = self.nextId()
+        if next_id != -1 and self.page(next_id) is None:
+            self.setPage(next_id, self.build_page(next_id))
+        return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+import math
+import os
+import threading
+
+import finalize
+
+# Upper bounds of the histogram buckets
+REALTIME_FACTOR_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+
+def format_labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in labels.items()
+        )
+        + "}"
+    )
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """One metric family, with a value for each combination of labels."""
+
+    kind = None
+
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: tuple, **extra) -> str:
+        labels = dict(zip(self.label_names, key))
+        labels.update(extra)
+        return format_labels(labels)
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.help_text)
+        yield "# TYPE {} {}".format(self.name, self.kind)
+        for key, value in sorted(self.values.items()):
+            yield from self._render_value(key, value)
+
+    def _render_value(self, key: tuple, value):
+        yield "{}{} {}".format(self.name, self._labels(key), format_value(value))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def add(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self.buckets = sorted(buckets) + [math.inf]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0]
+        counts, _ = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key][1] += value
+
+    def _render_value(self, key: tuple, value):
+        counts, total = value
+        for bound, count in zip(self.buckets, counts):
+            yield "{}_bucket{} {}".format(
+                self.name, self._labels(key, le=format_value(bound)), count
+            )
+        yield "{}_count{} {}".format(self.name, self._labels(key), counts[-1])
+        yield "{}_sum{} {}".format(self.name, self._labels(key), format_value(total))
+
+
+class Metrics:
+    """Throughput counters for a long-running PostShow, for monitoring.
+
+    The daemon writes them out as a textfile for node_exporter's textfile
+    collector to pick up.  Counters start from zero whenever PostShow starts,
+    as Prometheus expects.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.episodes = Counter(
+            "postshow_episodes_processed_total",
+            "Episodes that made it all the way through the pipeline.",
+            ["profile"],
+        )
+        self.audio_seconds = Counter(
+            "postshow_audio_seconds_encoded_total",
+            "Seconds of audio encoded.",
+            ["profile"],
+        )
+        self.realtime_factor = Histogram(
+            "postshow_encode_realtime_factor",
+            "How many times faster than realtime each episode encoded.",
+            REALTIME_FACTOR_BUCKETS,
+            ["profile"],
+        )
+        self.tag_bytes = Counter(
+            "postshow_tag_write_bytes_total",
+            "Bytes written by the tagger, audio included.",
+            ["profile"],
+        )
+        self.move_seconds = Histogram(
+            "postshow_move_seconds",
+            "How long it took to move each tagged MP3 into place.",
+            LATENCY_BUCKETS,
+            ["profile"],
+        )
+        self.finalize_seconds = Histogram(
+            "postshow_finalize_seconds",
+            "How long the publish step (manifest, RSS item, split clips) took.",
+            LATENCY_BUCKETS,
+            ["profile"],
+        )
+        self.failures = Counter(
+            "postshow_stage_failures_total",
+            "Episodes that failed, by the stage they failed in.",
+            ["profile", "stage"],
+        )
+        self.queue_depth = Gauge(
+            "postshow_queue_depth", "Episodes waiting for a worker."
+        )
+        self.running = Gauge("postshow_running_jobs", "Episodes being processed.")
+        self.metrics = [
+            self.episodes,
+            self.audio_seconds,
+            self.realtime_factor,
+            self.tag_bytes,
+            self.move_seconds,
+            self.finalize_seconds,
+            self.failures,
+            self.queue_depth,
+            self.running,
+        ]
+        self.queue_depth.set(0)
+        self.running.set(0)
+
+    def episode_finished(self, controller) -> None:
+        """Count an episode that a ``Controller`` has finished."""
+        profile = controller.profile
+        with self.lock:
+            self.episodes.add(profile=profile)
+            if controller.duration_ms is not None:
+                seconds = controller.duration_ms / 1000
+                self.audio_seconds.add(seconds, profile=profile)
+                # Resumed runs didn't encode anything.
+                if "encode" in controller.stage_usage:
+                    wall = controller.stage_usage["encode"][0]
+                    if wall > 0:
+                        self.realtime_factor.observe(seconds / wall, profile=profile)
+            for child in [controller] + controller.fanout:
+                tagger = child.tagger
+                if tagger is None or tagger.digest is None:
+                    continue
+                self.tag_bytes.add(tagger.digest.length, profile=child.profile)
+                if tagger.move_seconds is not None:
+                    self.move_seconds.observe(
+                        tagger.move_seconds, profile=child.profile
+                    )
+            if "publish" in controller.stage_usage:
+                self.finalize_seconds.observe(
+                    controller.stage_usage["publish"][0], profile=profile
+                )
+
+    def stage_failed(self, profile: str, stage: str) -> None:
+        with self.lock:
+            self.failures.add(profile=profile, stage=stage)
+
+    def set_queue(self, queued: int, running: int) -> None:
+        with self.lock:
+            self.queue_depth.set(queued)
+            self.running.set(running)
+
+    def render(self) -> str:
+        """The metrics in the OpenMetrics text format.
+
+        Counters are named with their ``_total`` suffix, so node_exporter (which
+        reads the older Prometheus format) takes the file too.
+        """
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.extend(metric.render())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Replace the textfile at ``path``, so it's never read half-written."""
+        partial = finalize.staging_path_for(path, "partial")
+        with open(partial, "w", encoding="utf-8") as fp:
+            fp.write(self.render())
+        os.replace(partial, path)
@@ -1,36 +1,10 @@
 import math
 import csv
 import datetime
+import json
 import re
-import threading
-import mutagen.id3
-import mutagen.mp3
-import subprocess
-import mimetypes
+import importlib
 import os.path
-from mutagen import MutagenError
-from mutagen.id3 import (
-    CHAP,
-    TIT2,
-    WXXX,
-    TLEN,
-    TPE1,
-    TALB,
-    TPOS,
-    TCON,
-    TCOM,
-    TPE2,
-    APIC,
-    TDRC,
-    TRCK,
-    TLAN,
-    COMM,
-    USLT,
-    CTOC,
-    CTOCFlags,
-    PictureType,
-    ID3TimeStamp,
-)
 
 
 class Chapter(object):
@@ -57,6 +31,12 @@ class Chapter(object):
         self.url = url
         self.image = image
         self.indexed = indexed
+        # The MP3 frames the chapter starts and ends on, if it has been snapped
+        # to them, and where those frames are in the tagged file.
+        self.frame = None
+        self.end_frame = None
+        self.start_offset = None
+        self.end_offset = None
 
     def __repr__(self):
         """Turn this Chapter into a string."""
@@ -72,8 +52,10 @@ class Chapter(object):
             indexed=self.indexed,
         )
 
-    def as_chap(self) -> CHAP:
+    def as_chap(self):
         """Convert this object into a mutagen CHAP object."""
+        from mutagen.id3 import CHAP, TIT2, WXXX
+
         sub_frames = []
         if self.text is not None:
             # Fix issue #1 by replacing em-dashes with regular hyphen-minuses
@@ -83,199 +65,19 @@ class Chapter(object):
             sub_frames.append(WXXX(desc="chapter url", url=self.url))
         if self.image is not None:
             raise NotImplementedError("I haven't done this bit yet.")
+        offsets = {}
+        if self.start_offset is not None:
+            offsets["start_offset"] = self.start_offset
+            offsets["end_offset"] = self.end_offset
         return CHAP(
             element_id=self.elem_id,
             start_time=self.start,
             end_time=self.end,
             sub_frames=sub_frames,
+            **offsets,
         )
 
 
-class MP3Tagger(threading.Thread):
-    """Tag an MP3."""
-
-    def __init__(self, path: str, progress_signal):
-        """Create a new tagger."""
-        super().__init__()
-        self.path = path
-        self.progress_signal = progress_signal
-        # Create an ID3 tag if none exists
-        try:
-            self.tag = mutagen.id3.ID3(path)
-        except MutagenError:
-            broken = mutagen.id3.ID3FileType(path)
-            broken.add_tags(ID3=mutagen.id3.ID3)
-            self.tag = broken.ID3()
-        # Determine the length of the MP3 and write it to a TLEN frame
-        mp3 = mutagen.mp3.MP3(path)
-        self.length_ms = int(round(mp3.info.length * 1000, 0))
-        self.tag.add(TLEN(text=str(self.length_ms)))
-
-    @staticmethod
-    def _no_padding(arg):
-        return 0
-
-    def run(self) -> None:
-        self.tag.save(self.path, v2_version=3, padding=self._no_padding)
-        self.progress_signal.progressed.emit(101)
-
-    def set_title(self, title: str) -> None:
-        """Set the title of the MP3."""
-        self.tag.delall("TIT2")
-        self.tag.add(TIT2(text=title))
-
-    def set_artist(self, artist: str) -> None:
-        """Set the artist of the MP3."""
-        self.tag.delall("TPE1")
-        self.tag.add(TPE1(text=artist))
-
-    def set_album(self, album: str) -> None:
-        """Set the album of the MP3."""
-        self.tag.delall("TALB")
-        self.tag.add(TALB(text=album))
-
-    def set_season(self, season: str) -> None:
-        """Set the season of the MP3."""
-        self.tag.delall("TPOS")
-        self.tag.add(TPOS(text=season))
-
-    def set_genre(self, genre: str) -> None:
-        """Set the genre of the MP3."""
-        self.tag.delall("TCON")
-        self.tag.add(TCON(text=genre))
-
-    def set_composer(self, composer: str) -> None:
-        """Set the composer of the MP3."""
-        self.tag.delall("TCOM")
-        self.tag.add(TCOM(text=composer))
-
-    def set_accompaniment(self, accompaniment: str) -> None:
-        """Set the accompaniment of the MP3."""
-        self.tag.delall("TPE2")
-        self.tag.add(TPE2(text=accompaniment))
-
-    def set_cover_art(self, path: str):
-        """Set the cover art of the MP3."""
-        self.tag.delall("APIC")
-        mime, ignored = mimetypes.guess_type(path)
-        if mime is None:
-            raise PostShowError("Unable to guess MIME type of cover image.")
-        data = None
-        try:
-            with open(path, "rb") as fp:
-                data = fp.read()
-        except IOError:
-            raise PostShowError("Unable to read cover image file.")
-        apic = APIC(
-            mime=mime,
-            type=PictureType.COVER_FRONT,
-            desc="podcast cover art",
-            data=data,
-        )
-        self.tag.add(apic)
-
-    def set_date(self, year: str) -> None:
-        """Set the date of recording of the MP3."""
-        self.tag.delall("TDRC")
-        self.tag.add(TDRC(text=[ID3TimeStamp(year)]))
-
-    def set_trackno(self, trackno: str) -> None:
-        """Set the track number of the MP3."""
-        self.tag.delall("TRCK")
-        self.tag.add(TRCK(text=trackno))
-
-    def set_language(self, language: str) -> None:
-        """Set the language of the MP3."""
-        self.tag.delall("TLAN")
-        self.tag.add(TLAN(text=language))
-
-    def add_comment(self, lang: str, desc: str, comment: str) -> None:
-        """Add a comment to the MP3."""
-        self.tag.add(COMM(lang=lang, desc=desc, text=[comment]))
-
-    def add_lyrics(self, lang: str, desc: str, lyrics: str) -> None:
-        """Add lyrics to the MP3."""
-        self.tag.add(USLT(lang=lang, desc=desc, text=lyrics))
-
-    def add_chapter(self, chapter: Chapter):
-        """Add a chapter to the MP3."""
-        self.tag.add(chapter.as_chap())
-
-    def add_chapters(self, chapters: list):
-        """Add a whole list of chapters to the MP3."""
-        child_element_ids = []
-        for chapter in chapters:
-            self.add_chapter(chapter)
-            if chapter.indexed:
-                child_element_ids.append(chapter.elem_id)
-        self.tag.add(
-            CTOC(
-                element_id="toc",
-                flags=CTOCFlags.TOP_LEVEL | CTOCFlags.ORDERED,
-                child_element_ids=child_element_ids,
-                sub_frames=[TIT2(text="Primary Chapter List")],
-            )
-        )
-
-
-class MP3Encoder(threading.Thread):
-    """Shell out to LAME to encode the WAV file as an MP3."""
-
-    def __init__(self, infile: str, outfile: str, bitrate: str, progress_updater):
-        """
-        :param infile: Path to WAV file.
-        :param outfile: Path to create MP3 file at.
-        :param bitrate: LAME CBR bitrate, in Kbps.
-        """
-        super().__init__()
-        self.infile = infile
-        self.outfile = outfile
-        self.bitrate = bitrate
-        self.progress_updater = progress_updater
-        self.matcher = re.compile(r"\(([0-9]?[0-9 ][0-9])%\)")
-        self.p = None
-        self.percent = 0
-        self.started = False
-        self.finished = False
-
-    def run(self):
-        self.started = True
-        basedir = os.path.dirname(__file__)
-        lame_path = os.path.join(basedir, "vendor", "lame")
-        if "DEBUG" in os.environ.keys():
-            lame_path = os.path.join(basedir, "..", "..", "vendor", "lame")
-        p = subprocess.Popen(
-            [lame_path, "-t", "-b", self.bitrate, "--cbr", self.infile, self.outfile],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-        )
-        self.p = p
-        if not p:
-            raise PostShowError("failed to start encoder")
-        stderr = p.stderr
-        if stderr is None:
-            raise PostShowError("this shouldn't happen")
-        for block in iter(lambda: stderr.read(1024), ""):
-            # Stop when the process terminates.
-            if p.poll() is not None:
-                break
-            text = block.decode("utf-8")
-            groups = self.matcher.findall(text)
-            if len(groups) < 1:
-                continue
-            percent = int(groups[-1])
-            self.percent = percent
-            self.progress_updater.set_progress(percent)
-            if percent == 100 and p.poll() is not None:
-                break
-        self.finished = True
-        self.progress_updater.set_finished()
-
-    def request_stop(self):
-        if self.started and self.p is not None:
-            self.p.terminate()
-
-
 class EpisodeMetadata(object):
     """Metadata about an episode."""
 
@@ -317,6 +119,7 @@ class MCS:
     Supported output formats:
     * CUE file
     * LRC file
+    * Podcasting 2.0 JSON chapters
     * Internal representation (for use in other parts of the program)
 
     Create a new instance and call ``load('path/to/file.ext')`` on it to load
@@ -324,6 +127,7 @@ class MCS:
     one of the constants on this class:
     * LRC
     * CUE
+    * JSON_CHAPTERS
     """
 
     AUDACITY = 0
@@ -332,6 +136,7 @@ class MCS:
     UMR = 12
     SIMPLE = 13
     FFMETADATA1 = 14
+    JSON_CHAPTERS = 15
 
     def __init__(self, metadata=None, media_filename=None):
         self.load_path = None
@@ -467,6 +272,8 @@ class MCS:
             self._save_audacity(path)
         elif marker_type == self.FFMETADATA1:
             self._save_ffmetadata1(path)
+        elif marker_type == self.JSON_CHAPTERS:
+            self._save_json_chapters(path)
 
     def _save_lrc(self, path: str):
         with open(path, "w", encoding="utf-8") as fp:
@@ -558,9 +365,43 @@ class MCS:
             if self.metadata is not None:
                 fp.write("\n[STREAM]\ntitle={}".format(self.metadata.title))
 
+    def _save_json_chapters(self, path: str):
+        """Write the chapters in the Podcasting 2.0 JSON chapters format.
+
+        https://github.com/Podcastindex-org/podcast-namespace/blob/main/chapters/jsonChapters.md
+        """
+        chapters = []
+        for chapter in self.chapters:
+            entry = {"startTime": chapter.start / 1000, "title": chapter.text}
+            if chapter.end > chapter.start:
+                entry["endTime"] = chapter.end / 1000
+            if chapter.url is not None:
+                entry["url"] = chapter.url
+            if not chapter.indexed:
+                entry["toc"] = False
+            chapters.append(entry)
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump({"version": "1.2.0", "chapters": chapters}, fp, indent=2)
+            fp.write("\n")
+
     def get(self):
         return self.chapters
 
 
+# The tagger and encoder are only loaded when they're first used, so that
+# starting the wizard doesn't have to wait for mutagen.
+LAZY_CLASSES = {
+    "MP3Tagger": "tagger",
+    "MP3Encoder": "encoder",
+    "MP3Passthrough": "encoder",
+}
+
+
+def __getattr__(name: str):
+    if name in LAZY_CLASSES:
+        return getattr(importlib.import_module(LAZY_CLASSES[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 class PostShowError(Exception):
     """Something went wrong, use this to explain."""
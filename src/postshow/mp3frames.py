@@ -0,0 +1,418 @@
+import array
+import mmap
+from typing import NamedTuple
+
+# LAME delays the audio by 576 samples, and decoders by another 529, so input
+# sample ``s`` comes out of the decoder as sample ``s + ENCODER_DELAY``.
+ENCODER_DELAY = 576 + 529
+# LAME's own delay, not counting the decoder's; this is what goes in the tag.
+LAME_DELAY = 576
+
+# Frames, bytes, TOC and quality
+INFO_FLAGS = 0x0F
+LAME_VERSION = b"LAME3.100"
+# The size of a Xing/Info tag with every field, and of the LAME extension
+INFO_SIZE = 8 + 4 + 4 + 100 + 4
+LAME_SIZE = 36
+# The LAME tag's codes for how the bitrate was chosen
+LAME_METHODS = {"unknown": 0, "cbr": 1, "abr": 2, "vbr": 4}
+
+# Bitrates (Kbps) by index, for MPEG-1 and MPEG-2/2.5 Layer III.
+BITRATES_V1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+BITRATES_V2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],  # MPEG-2.5
+}
+
+
+class FrameHeader(NamedTuple):
+    """The interesting parts of an MPEG audio Layer III frame header."""
+
+    version: int
+    bitrate: int
+    sample_rate: int
+    padding: int
+    channel_mode: int
+    length: int
+    samples: int
+
+
+def parse_header(data: bytes):
+    """Parse the four-byte header at the start of ``data``.
+
+    :return: A ``FrameHeader``, or None if ``data`` doesn't start with a Layer
+    III frame.
+    """
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return None
+    version = (data[1] >> 3) & 0x03
+    layer = (data[1] >> 1) & 0x03
+    bitrate_index = data[2] >> 4
+    sample_rate_index = (data[2] >> 2) & 0x03
+    # Version 1 is reserved, and layer 1 is Layer III.
+    if version == 1 or layer != 1:
+        return None
+    if bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    padding = (data[2] >> 1) & 0x01
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        bitrate = BITRATES_V1[bitrate_index]
+        samples = 1152
+    else:
+        bitrate = BITRATES_V2[bitrate_index]
+        samples = 576
+    length = samples // 8 * bitrate * 1000 // sample_rate + padding
+    return FrameHeader(
+        version, bitrate, sample_rate, padding, data[3] >> 6, length, samples
+    )
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes) -> int:
+    """The CRC-16 that LAME puts in its tag."""
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def id3v2_size(fp) -> int:
+    """Return the size of the ID3v2 tag at the start of ``fp``, if any."""
+    header = fp.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    # Footer present
+    if header[5] & 0x10:
+        size += 10
+    return size + 10
+
+
+def side_info_size(header: FrameHeader) -> int:
+    """The size of the side information that follows a frame's header."""
+    mono = header.channel_mode == 3
+    if header.version == 3:
+        return 17 if mono else 32
+    return 9 if mono else 17
+
+
+def read_info_frame(frame: bytes, header: FrameHeader):
+    """Read the Xing/Info tag that LAME puts in the first frame, if it's there.
+
+    :return: None if ``frame`` is an ordinary frame; otherwise an
+    ``(encoder_delay, encoder_padding)`` tuple, where either may be None if the
+    tag doesn't have a LAME extension.
+    """
+    position = 4 + side_info_size(header)
+    if frame[position : position + 4] not in (b"Xing", b"Info"):
+        return None
+    flags = int.from_bytes(frame[position + 4 : position + 8], "big")
+    position += 8
+    # Frames, bytes, TOC and quality, if they're present.
+    for flag, size in ((0x1, 4), (0x2, 4), (0x4, 100), (0x8, 4)):
+        if flags & flag:
+            position += size
+    lame = frame[position : position + 36]
+    if len(lame) < 36 or lame[:4] != b"LAME":
+        return None, None
+    packed = int.from_bytes(lame[21:24], "big")
+    return packed >> 12, packed & 0xFFF
+
+
+def info_frame_header(first_header: bytes) -> bytes:
+    """A frame header for a Xing tag to go in front of VBR audio.
+
+    The tag frame is silent, so its bitrate doesn't matter, except that the
+    frame has to be big enough for the tag.  The smallest bitrate that is gets
+    used.
+    """
+    header = bytearray(first_header)
+    # No CRC, and no padding slot
+    header[1] |= 0x01
+    header[2] &= ~0x02 & 0xFF
+    for bitrate_index in range(1, 15):
+        header[2] = (header[2] & 0x0F) | (bitrate_index << 4)
+        parsed = parse_header(header)
+        if parsed.length >= 4 + side_info_size(parsed) + INFO_SIZE + LAME_SIZE:
+            break
+    return bytes(header)
+
+
+def build_info_frame(
+    first_header: bytes, frames: int, length: int, padding: int, toc=None, method="cbr"
+):
+    """Build a LAME Info tag frame, so players can trim the delay and padding.
+
+    :param first_header: The header of the first audio frame, which the tag
+    copies.  For VBR audio, use ``info_frame_header`` to get one that's big
+    enough.
+    :param frames: The number of audio frames (not counting this one).
+    :param length: The length of the audio, counting this frame.
+    :param toc: The table of contents for seeking, from ``build_toc``, which
+    makes this a Xing tag (for VBR audio).  Without it, the table is a straight
+    line, as it is for CBR audio.
+    :param method: How the bitrate was chosen: a key of ``LAME_METHODS``.
+    :return: The frame, or None if frames at this bitrate are too small to
+    hold the tag.
+    """
+    header = parse_header(first_header)
+    size = header.length - header.padding
+    position = 4 + side_info_size(header)
+    if position + INFO_SIZE + LAME_SIZE > size:
+        return None
+    frame = bytearray(size)
+    frame[:4] = first_header
+    # No CRC, and no padding slot
+    frame[1] |= 0x01
+    frame[2] &= ~0x02 & 0xFF
+    info = bytearray(b"Info" if toc is None else b"Xing")
+    info += INFO_FLAGS.to_bytes(4, "big")
+    info += frames.to_bytes(4, "big")
+    info += length.to_bytes(4, "big")
+    if toc is None:
+        toc = bytes(percent * 256 // 100 for percent in range(100))
+    info += toc
+    info += (0).to_bytes(4, "big")
+    lame = bytearray(LAME_VERSION)
+    # Tag revision 0 and the method; then the lowpass, peak and gains, which
+    # aren't known
+    lame += bytes([LAME_METHODS[method], 0]) + bytes(4 + 2 + 2)
+    lame += bytes([0, min(header.bitrate, 255)])
+    lame += ((LAME_DELAY << 12) | padding).to_bytes(3, "big")
+    # Misc, MP3Gain, surround and preset
+    lame += bytes(1 + 1 + 2)
+    lame += length.to_bytes(4, "big")
+    # The CRC of the music isn't checked by anything that matters.
+    lame += bytes(2)
+    frame[position : position + len(info)] = info
+    position += len(info)
+    frame[position : position + len(lame)] = lame
+    position += len(lame)
+    frame[position : position + 2] = crc16(frame[:position]).to_bytes(2, "big")
+    return bytes(frame)
+
+
+class FrameIndex:
+    """The byte offset of every frame in an MP3's audio.
+
+    Offsets are relative to the first frame, so that they stay the same
+    whatever size of tag ends up in front of the audio.
+    """
+
+    def __init__(self, sample_rate=None, samples=None):
+        """
+        :param sample_rate: The sample rate of the MP3.  If it isn't known yet,
+        it's taken from the first frame passed to ``feed``.
+        :param samples: The number of samples in each frame.
+        """
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples
+        self.offsets = array.array("Q")
+        self.audio_length = 0
+        # The bitrate of the first frame, and whether any other frame differs
+        self.bitrate = None
+        self.variable = False
+        # From the LAME tag, if the MP3 has one.
+        self.encoder_delay = None
+        self.encoder_padding = None
+        # False if something that isn't a frame turned up in the stream.
+        self.valid = True
+        # For ``feed``: the offset of the next frame header, and the data that
+        # hasn't been indexed yet, starting at ``_buffer_start``.
+        self._next = 0
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._checked_info = False
+
+    def feed(self, data: bytes) -> None:
+        """Index the frames in the next piece of an MP3 as it's written.
+
+        ``data`` can be any size; frames that span pieces are handled.  As with
+        ``scan``, a Xing/Info frame at the start isn't indexed.
+        """
+        self._buffer += data
+        while self.valid:
+            start = self._next - self._buffer_start
+            if start + 4 > len(self._buffer):
+                break
+            header = parse_header(self._buffer[start : start + 4])
+            if header is None:
+                self.valid = False
+                break
+            if self.sample_rate is None:
+                self.sample_rate = header.sample_rate
+                self.samples_per_frame = header.samples
+            if not self._checked_info:
+                if start + header.length > len(self._buffer):
+                    break
+                self._checked_info = True
+                info = read_info_frame(
+                    self._buffer[start : start + header.length], header
+                )
+                if info is not None:
+                    self.encoder_delay, self.encoder_padding = info
+                    self._next += header.length
+                    continue
+            self.offsets.append(self._next)
+            self._count_bitrate(header.bitrate)
+            self._next += header.length
+        # Only the start of the next frame ever needs to be kept.
+        done = min(self._next - self._buffer_start, len(self._buffer))
+        del self._buffer[:done]
+        self._buffer_start += done
+        self.audio_length = self._buffer_start + len(self._buffer)
+
+    @classmethod
+    def scan(cls, path: str, start: int = 0):
+        """Index the frames of the MP3 at ``path``, starting at byte ``start``.
+
+        Only the frame headers are read.  Scanning stops at the first thing that
+        isn't a frame (an ID3v1 tag, or garbage).  A Xing/Info tag in the first
+        frame isn't audio, so it isn't indexed, but the encoder delay and
+        padding are read from it.
+
+        :return: A ``FrameIndex``, or None if there are no frames at ``start``.
+        """
+        with open(path, "rb") as fp:
+            fp.seek(0, 2)
+            if fp.tell() <= start:
+                return None
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                header = parse_header(mapped[start : start + 4])
+                if header is None:
+                    return None
+                index = cls(header.sample_rate, header.samples)
+                position = start
+                info = read_info_frame(mapped[start : start + header.length], header)
+                if info is not None:
+                    index.encoder_delay, index.encoder_padding = info
+                    position += header.length
+                end = len(mapped)
+                while position + 4 <= end:
+                    header = parse_header(mapped[position : position + 4])
+                    if header is None or position + header.length > end:
+                        break
+                    index.offsets.append(position - start)
+                    index._count_bitrate(header.bitrate)
+                    position += header.length
+                index.audio_length = position - start
+        return index
+
+    def _count_bitrate(self, bitrate: int) -> None:
+        if self.bitrate is None:
+            self.bitrate = bitrate
+        elif bitrate != self.bitrate:
+            self.variable = True
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def offset_of(self, frame: int) -> int:
+        """The offset of ``frame``, or the end of the audio if it's past it."""
+        if frame >= len(self.offsets):
+            return self.audio_length
+        return self.offsets[max(0, frame)]
+
+
+def build_toc(index: FrameIndex) -> bytes:
+    """Build a Xing table of contents from the frame index.
+
+    Entry ``i`` is where the audio ``i`` percent of the way through starts, as
+    a fraction (in 256ths) of the audio's length.  Players that seek VBR audio
+    by time interpolate between entries.  The index's offsets count from the
+    start of the audio after the ID3 tag, where the Xing frame goes, and the
+    Xing frame itself isn't one of its frames (``scan`` and ``feed`` skip it),
+    so entry 0 is where the first real frame starts.
+    """
+    frames = len(index)
+    toc = bytearray(100)
+    if frames == 0 or index.audio_length == 0:
+        return bytes(toc)
+    for percent in range(100):
+        offset = index.offset_of(percent * frames // 100)
+        toc[percent] = min(255, offset * 256 // index.audio_length)
+    return bytes(toc)
+
+
+def frame_start_ms(frame: int, index: FrameIndex) -> int:
+    """When the audio that starts ``frame`` was in the original recording."""
+    sample = frame * index.samples_per_frame - ENCODER_DELAY
+    return max(0, int(round(sample * 1000 / index.sample_rate, 0)))
+
+
+def nearest_frame(ms: int, index: FrameIndex) -> int:
+    """The frame whose start is closest to ``ms`` in the original recording."""
+    sample = ms * index.sample_rate / 1000
+    return max(0, int(round((sample + ENCODER_DELAY) / index.samples_per_frame)))
+
+
+def frame_at(ms: int, index: FrameIndex) -> int:
+    """The frame that holds ``ms`` in the original recording."""
+    sample = ms * index.sample_rate / 1000
+    return max(0, int((sample + ENCODER_DELAY) // index.samples_per_frame))
+
+
+def snap_chapters(chapters, index: FrameIndex, wav=None, window_ms: float = 0):
+    """Move each chapter to start exactly on a frame boundary.
+
+    Players can only seek to the start of a frame, so a chapter that starts
+    in the middle of one starts with a few milliseconds of the one before it.
+    The frames come from the finished encode, since LAME may have resampled
+    the audio.
+
+    :param chapters: The ``Chapter`` list, in order.  Each one is updated, and
+    gets the ``frame`` and ``end_frame`` it starts and ends on.
+    :param wav: The ``WaveFile`` that was encoded.  If it is provided along with
+    ``window_ms``, each chapter is moved to the quietest frame boundary within
+    ``window_ms`` of where it was, so it doesn't start mid-word.  This needs
+    NumPy.
+    """
+    frames = [nearest_frame(chapter.start, index) for chapter in chapters]
+    if wav is not None and window_ms > 0:
+        import analysis
+
+        window = max(
+            1, int(window_ms * index.sample_rate / 1000 / index.samples_per_frame)
+        )
+        frames = [
+            analysis.quietest_frame_boundary(
+                wav,
+                frame,
+                window,
+                index.samples_per_frame,
+                ENCODER_DELAY,
+                index.sample_rate,
+            )
+            for frame in frames
+        ]
+    previous = -1
+    for chapter, frame in zip(chapters, frames):
+        if chapter.start == 0:
+            frame = 0
+        # Two chapters can't share a frame.
+        frame = max(frame, previous + 1)
+        end_frame = frame
+        if chapter.end != chapter.start:
+            end_frame = max(frame, nearest_frame(chapter.end, index))
+        chapter.frame = frame
+        chapter.end_frame = end_frame
+        chapter.start = frame_start_ms(frame, index)
+        chapter.end = frame_start_ms(end_frame, index)
+        previous = frame
@@ -0,0 +1,182 @@
+import concurrent.futures
+import os
+import os.path
+from typing import List, NamedTuple
+
+import splice
+from model import PostShowError
+
+# How much of the recording to hear either side of each chapter start
+DEFAULT_WINDOW_SECONDS = 5.0
+
+
+class Window(NamedTuple):
+    """The stretch of the recording around one chapter's start."""
+
+    # 1-based, like the chapter files
+    number: int
+    chapter: object
+    # Sample frames of the recording
+    start: int
+    end: int
+    # How far into the window the chapter starts, in sample frames
+    lead_in: int
+
+
+class Preview(NamedTuple):
+    """An encoded window."""
+
+    window: Window
+    path: str
+    # The number of samples of real audio in the MP3
+    samples: int
+
+
+def plan_windows(
+    chapters, sample_rate: int, frame_count, window_seconds: float
+) -> List[Window]:
+    """Work out which part of the recording to encode for each chapter.
+
+    :param frame_count: The length of the recording, if it's known, so that
+    chapters past the end can be left out.
+    """
+    reach = int(round(window_seconds * sample_rate))
+    windows = []
+    for number, chapter in enumerate(chapters, start=1):
+        point = int(round(chapter.start * sample_rate / 1000))
+        if frame_count is not None and point >= frame_count:
+            print(
+                "Chapter {} starts after the end, so it has no preview".format(number)
+            )
+            continue
+        start = max(0, point - reach)
+        end = point + reach
+        if frame_count is not None:
+            end = min(frame_count, end)
+        windows.append(Window(number, chapter, start, end, point - start))
+    return windows
+
+
+def render(windows: List[Window], path_for, encode, workers=None) -> List[Preview]:
+    """Encode every window, in parallel.
+
+    :param path_for: A function that gives the path to encode a window to.
+    :param encode: A function that encodes ``(window, mp3_path)``, and returns
+    the number of samples of real audio in the MP3.
+    """
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(encode, window, path_for(window)) for window in windows]
+        return [
+            Preview(window, path_for(window), future.result())
+            for window, future in zip(windows, futures)
+        ]
+
+
+def join(previews: List[Preview], output_path: str) -> List[float]:
+    """Join the encoded windows into one MP3, without re-encoding them.
+
+    :return: Where each window starts in the joined MP3, in seconds.
+    """
+    segments = [
+        splice.load_segment(preview.path, preview.samples) for preview in previews
+    ]
+    if len(segments) == 0:
+        raise PostShowError("There are no chapters to preview.")
+    index, _ = splice.splice(segments, output_path)
+    starts = []
+    frames = 0
+    for segment in segments:
+        # The encoder delay is only trimmed once, at the start, and every
+        # segment's own delay puts its audio on its first frame.
+        starts.append(frames * index.samples_per_frame / index.sample_rate)
+        frames += len(segment.index)
+    return starts
+
+
+def cue_time(seconds: float) -> str:
+    """A time as CUE sheet minutes, seconds and (1/75 second) frames."""
+    frames = int(round(seconds * 75))
+    return "{:02d}:{:02d}:{:02d}".format(
+        frames // (75 * 60), frames // 75 % 60, frames % 75
+    )
+
+
+def episode_time(ms: int) -> str:
+    return "{}:{:02d}:{:02d}.{:03d}".format(
+        ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000
+    )
+
+
+def write_cue(
+    path: str, media_path: str, previews: List[Preview], starts, sample_rate: int
+):
+    """Write a CUE sheet for the joined previews.
+
+    Each chapter is a track.  Its pregap (index 0) is the start of its window,
+    and the track itself (index 1) starts exactly where the chapter does, so
+    skipping tracks jumps from one chapter start to the next.
+
+    :param sample_rate: The recording's sample rate, which the windows are
+    measured in.
+    """
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write("\ufeff")  # UTF-8 BOM for foobar2000
+        fp.write('REM COMMENT "Chapter previews generated by PostShow v3"\n')
+        fp.write('FILE "{}" MP3\n'.format(os.path.basename(media_path)))
+        for track, (preview, start) in enumerate(zip(previews, starts), start=1):
+            chapter = preview.window.chapter
+            fp.write(
+                "  TRACK {:02d} AUDIO\n"
+                '    TITLE "{}"\n'
+                "    REM EPISODE_TIME {}\n".format(
+                    track,
+                    (
+                        chapter.text or "Chapter {}".format(preview.window.number)
+                    ).replace('"', "_"),
+                    episode_time(chapter.start),
+                )
+            )
+            # A chapter at the very start has no pregap.
+            if preview.window.lead_in > 0:
+                fp.write("    INDEX 00 {}\n".format(cue_time(start)))
+            fp.write(
+                "    INDEX 01 {}\n".format(
+                    cue_time(start + preview.window.lead_in / sample_rate)
+                )
+            )
+
+
+def tag_clip(preview: Preview) -> None:
+    """Title a chapter's clip, so players show which chapter it is."""
+    import mutagen.id3
+    from mutagen.id3 import TIT2
+
+    chapter = preview.window.chapter
+    tag = mutagen.id3.ID3()
+    tag.add(
+        TIT2(
+            text="{:02d} {} (at {})".format(
+                preview.window.number,
+                chapter.text or "Chapter",
+                episode_time(chapter.start),
+            )
+        )
+    )
+    tag.save(preview.path, v2_version=3)
+
+
+def describe(previews: List[Preview], starts, sample_rate: int, joined_path=None):
+    """Say where to listen for each chapter start.
+
+    :param starts: Where each preview starts in its file, in seconds.
+    :param joined_path: The MP3 they were joined into, if they were.
+    """
+    for preview, start in zip(previews, starts):
+        yield "Chapter {} ({}) starts {:.2f} s into {}".format(
+            preview.window.number,
+            episode_time(preview.window.chapter.start),
+            start + preview.window.lead_in / sample_rate,
+            os.path.basename(joined_path or preview.path),
+        )
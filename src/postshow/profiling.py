@@ -0,0 +1,169 @@
+import cProfile
+import functools
+import os
+import threading
+import tracemalloc
+
+# How many frames of each allocation's traceback to keep
+TRACEBACK_FRAMES = 10
+# How many allocation sites go in each memory report
+TOP_ALLOCATIONS = 25
+
+# tracemalloc traces the whole process, so it's only stopped once the last
+# stage that needs it is done.
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def _start_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+        _tracemalloc_users += 1
+        tracemalloc.reset_peak()
+
+
+def _stop_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GB".format(size)
+
+
+class StageProfiler:
+    """Profile each stage of the pipeline with cProfile and tracemalloc.
+
+    Each stage gets a ``.pstats`` file (open it with ``python -m pstats``, or
+    a viewer like SnakeViz) and a ``.memory.txt`` report of its peak memory use
+    and where the memory it kept went.  Both slow the stage down a lot, so this
+    is only for tracking a problem down.
+    """
+
+    enabled = True
+
+    def __init__(self, path_for):
+        """
+        :param path_for: A function that gives the path to write an output
+        file to, given its extension.
+        """
+        self.path_for = path_for
+        self.local = threading.local()
+        # How many times each stage has run, so that a second run (for another
+        # profile) doesn't overwrite the first one's reports
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    def run(self, stage: str, function, *args, **kwargs):
+        """Call ``function`` as the stage named ``stage``.
+
+        A stage inside another one on the same thread is part of the outer
+        one, rather than getting its own reports.
+        """
+        if getattr(self.local, "active", False):
+            return function(*args, **kwargs)
+        with self.lock:
+            self.runs[stage] = self.runs.get(stage, 0) + 1
+            if self.runs[stage] > 1:
+                stage = "{}{}".format(stage, self.runs[stage])
+        self.local.active = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12, only one profiler can run at a time, so
+            # stages on other threads can't overlap.
+            print("Another stage is being profiled, so {} isn't".format(stage))
+            profile = None
+        _start_tracemalloc()
+        before = tracemalloc.take_snapshot()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.local.active = False
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            _stop_tracemalloc()
+            self._write_reports(stage, profile, current, peak, before, snapshot)
+
+    def _write_reports(self, stage, profile, current, peak, before, after) -> None:
+        stats_path = self.path_for("{}.pstats".format(stage))
+        memory_path = self.path_for("{}.memory.txt".format(stage))
+        if stats_path is None or memory_path is None:
+            return
+        if profile is not None:
+            profile.dump_stats(stats_path)
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        differences = after.filter_traces(filters).compare_to(
+            before.filter_traces(filters), "traceback"
+        )
+        with open(memory_path, "w", encoding="utf-8") as fp:
+            fp.write("Stage: {}\n".format(stage))
+            fp.write("Peak traced memory: {}\n".format(format_size(peak)))
+            fp.write("Still allocated at the end: {}\n".format(format_size(current)))
+            fp.write(
+                "(Memory is traced for the whole process, so stages running at the "
+                "same time are counted together.)\n\n"
+            )
+            fp.write("Where the memory kept by the end of the stage was allocated:\n")
+            for statistic in differences[:TOP_ALLOCATIONS]:
+                if statistic.size_diff <= 0:
+                    break
+                fp.write(
+                    "\n{} more, in {} more blocks\n".format(
+                        format_size(statistic.size_diff), statistic.count_diff
+                    )
+                )
+                for line in statistic.traceback.format(most_recent_first=True):
+                    fp.write("  {}\n".format(line))
+        print("Wrote profiles of the {} stage to {}".format(stage, stats_path))
+
+
+class NullProfiler:
+    """A profiler that just runs the stage, for when profiling is off."""
+
+    enabled = False
+
+    def run(self, stage: str, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def wanted(config_data, profile: str) -> bool:
+    """Whether the profile, or the POSTSHOW_PROFILE environment variable, asks
+    for profiling."""
+    if "POSTSHOW_PROFILE" in os.environ.keys():
+        return True
+    return config_data.getboolean(profile, "profile_stages", fallback=False)
+
+
+def profiled(stage: str):
+    """Run every call of a method as a stage, on the object's ``profiler``."""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.profiler
+            if not profiler.enabled:
+                return method(self, *args, **kwargs)
+            return profiler.run(stage, method, self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
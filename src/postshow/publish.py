@@ -0,0 +1,178 @@
+import array
+import json
+import math
+import mimetypes
+import os
+import os.path
+import struct
+import sys
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+import finalize
+import mp3frames
+
+MANIFEST_VERSION = 1
+SEEK_INDEX_MAGIC = b"PSSK"
+SEEK_INDEX_VERSION = 1
+# magic, version, samples per frame, sample rate, encoder delay, audio start,
+# audio length, frame count, chapter count
+SEEK_INDEX_HEADER = struct.Struct("<4sHHIIIIII")
+SEEK_INDEX_CHAPTER = struct.Struct("<III")
+
+
+def build_manifest(
+    metadata,
+    profile: str,
+    digests: List[finalize.FileDigest],
+    durations: Dict[str, int],
+) -> dict:
+    """Build the publish manifest for one episode.
+
+    :param metadata: The ``EpisodeMetadata`` for the episode.
+    :param profile: The name of the config section the episode was made with.
+    :param digests: The digest of every output file, in the order they should be
+    listed.
+    :param durations: The duration, in milliseconds, of each audio file, keyed
+    by path.
+    """
+    files = []
+    for digest in digests:
+        mime, _ = mimetypes.guess_type(digest.path)
+        entry = {
+            "name": os.path.basename(digest.path),
+            "type": mime,
+            "length": digest.length,
+            "sha256": digest.sha256,
+        }
+        if digest.path in durations:
+            entry["duration_ms"] = durations[digest.path]
+        files.append(entry)
+    return {
+        "version": MANIFEST_VERSION,
+        "generator": "PostShow v3",
+        "profile": profile,
+        "episode": {
+            "number": metadata.number,
+            "title": metadata.title,
+        },
+        "files": files,
+    }
+
+
+def write_manifest(path: str, manifest: dict) -> None:
+    """Write the manifest, replacing any previous one in a single step."""
+    partial = finalize.staging_path_for(path, "partial")
+    with open(partial, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+        fp.write("\n")
+    os.replace(partial, path)
+
+
+def build_rss_item(
+    title: str,
+    media_url: str,
+    media_length: int,
+    duration_ms: int,
+    guid: str,
+    episode: Optional[str] = None,
+    season: Optional[str] = None,
+    chapters_url: Optional[str] = None,
+) -> str:
+    """Build an RSS ``<item>`` for the episode, ready to paste into a feed.
+
+    Everything comes from values the pipeline already has, so nothing needs to
+    open the MP3 again.  The ``itunes`` and ``podcast`` prefixes are expected to
+    be declared on the feed's ``<rss>`` element, as they always are.
+
+    :param media_length: The size of the MP3 file, in bytes.
+    :param duration_ms: The length of the episode, in milliseconds.  It's
+    rounded up to whole seconds, since that's what the feed format allows.
+    """
+    lines = [
+        "<item>",
+        "  <title>{}</title>".format(escape(title)),
+        "  <itunes:title>{}</itunes:title>".format(escape(title)),
+        '  <guid isPermaLink="false">{}</guid>'.format(escape(guid)),
+        '  <enclosure url={} length="{}" type="audio/mpeg"/>'.format(
+            quoteattr(media_url), media_length
+        ),
+        "  <itunes:duration>{}</itunes:duration>".format(
+            int(math.ceil(duration_ms / 1000))
+        ),
+    ]
+    if episode is not None and episode.isdigit():
+        lines.append("  <itunes:episode>{}</itunes:episode>".format(int(episode)))
+    if season is not None and season.isdigit():
+        lines.append("  <itunes:season>{}</itunes:season>".format(int(season)))
+    if chapters_url is not None:
+        lines.append(
+            '  <podcast:chapters url={} type="application/json+chapters"/>'.format(
+                quoteattr(chapters_url)
+            )
+        )
+    lines.append("</item>")
+    return "\n".join(lines) + "\n"
+
+
+def write_rss_item(path: str, item: str) -> None:
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write(item)
+
+
+def build_seek_index(
+    index: mp3frames.FrameIndex, audio_start: int, chapters=None
+) -> bytes:
+    """Build the seek index for a finished MP3.
+
+    The index lets a server turn a time into a byte range without reading
+    the MP3.  Every frame holds the same number of samples, so the frame for
+    time ``t`` (in seconds) is
+    ``floor((t * sample_rate + encoder_delay) / samples_per_frame)``, and its
+    offset is entry number ``frame`` in the frame table (or the end of the
+    audio, past the last frame).  All numbers are little-endian:
+
+    * The header: ``SEEK_INDEX_HEADER``.
+    * The frame table: the offset of every frame from the start of the file
+      (tag included), as 32-bit unsigned integers.
+    * The chapter table: for each chapter, its start time in milliseconds, its
+      first frame, and that frame's offset (``SEEK_INDEX_CHAPTER``).
+
+    :param audio_start: The size of the ID3 tag in front of the audio.
+    :param chapters: The ``Chapter`` list.
+    """
+    if audio_start + index.audio_length > 0xFFFFFFFF:
+        raise ValueError("The MP3 is too big for a seek index.")
+    chapters = chapters or []
+    offsets = array.array("I", (audio_start + offset for offset in index.offsets))
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    parts = [
+        SEEK_INDEX_HEADER.pack(
+            SEEK_INDEX_MAGIC,
+            SEEK_INDEX_VERSION,
+            index.samples_per_frame,
+            index.sample_rate,
+            mp3frames.ENCODER_DELAY,
+            audio_start,
+            index.audio_length,
+            len(index),
+            len(chapters),
+        ),
+        offsets.tobytes(),
+    ]
+    for chapter in chapters:
+        frame = chapter.frame
+        if frame is None:
+            frame = mp3frames.frame_at(chapter.start, index)
+        parts.append(
+            SEEK_INDEX_CHAPTER.pack(
+                chapter.start, frame, audio_start + index.offset_of(frame)
+            )
+        )
+    return b"".join(parts)
+
+
+def write_seek_index(path: str, data: bytes) -> None:
+    with open(path, "wb") as fp:
+        fp.write(data)
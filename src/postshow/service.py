@@ -0,0 +1,206 @@
+import hmac
+import json
+import os.path
+import re
+import secrets
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from daemon import CANCELLED, DONE, FAILED, Job, JobRunner
+
+EVENT_POLL_SECONDS = 0.5
+JOB_PATH = re.compile(r"^/jobs/(?P<id>[0-9a-f]+)(?P<events>/events)?$")
+# Everything a job submission has to include.
+REQUIRED_FIELDS = ["profile", "number", "title", "wav_path", "markers_path", "outdir"]
+# The only names the API answers to, so that a web page can't reach it by
+# pointing its own host name at 127.0.0.1.
+ALLOWED_HOSTS = ["localhost", "127.0.0.1"]
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Handle requests to the job submission API.
+
+    * ``POST /jobs`` submits an episode, and returns the new job.
+    * ``GET /jobs`` lists every job.
+    * ``GET /jobs/<id>`` returns one job.
+    * ``GET /jobs/<id>/events`` streams the job's progress as server-sent
+      events, until it finishes.
+    * ``DELETE /jobs/<id>`` cancels a job.
+
+    Every request must be addressed to localhost, and have an
+    ``Authorization: Bearer <token>`` header with the API's token, and jobs
+    must be submitted as ``application/json``.  Web pages can't send requests
+    like that to another site without its say-so, so they can't submit jobs.
+    """
+
+    # Set by ``serve``.
+    runner: JobRunner = None
+    config_data = None
+    token: str = None
+
+    def _send_json(self, status: int, body) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send_json(status, {"error": message})
+
+    def _check_request(self) -> bool:
+        """Check that a request is from someone allowed to use the API.
+
+        :return: False if it isn't, in which case the error has been sent.
+        """
+        host = self.headers.get("Host", "")
+        # Without the port, or the brackets around an IPv6 address
+        if host.rpartition(":")[0] and not host.endswith("]"):
+            host = host.rpartition(":")[0]
+        if host not in ALLOWED_HOSTS:
+            self._send_error(HTTPStatus.FORBIDDEN, "Use http://127.0.0.1 for the API")
+            return False
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            token.strip().encode("utf-8"), self.token.encode("utf-8")
+        ):
+            self._send_error(
+                HTTPStatus.UNAUTHORIZED, "The API token is missing or wrong"
+            )
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._check_request():
+            return
+        if self.path == "/jobs":
+            self._send_json(HTTPStatus.OK, self.runner.status())
+            return
+        match = JOB_PATH.match(self.path)
+        job = self.runner.get(match.group("id")) if match else None
+        if job is None:
+            self._send_error(HTTPStatus.NOT_FOUND, "No such job")
+        elif match.group("events"):
+            self._stream_events(job)
+        else:
+            self._send_json(HTTPStatus.OK, job.as_dict())
+
+    def do_POST(self):
+        if not self._check_request():
+            return
+        if self.path != "/jobs":
+            self._send_error(HTTPStatus.NOT_FOUND, "Submit jobs to /jobs")
+            return
+        if self.headers.get_content_type() != "application/json":
+            self._send_error(
+                HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                "Jobs must be sent as application/json",
+            )
+            return
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._send_error(HTTPStatus.BAD_REQUEST, "The request isn't valid JSON")
+            return
+        problem = self._check_submission(request)
+        if problem is not None:
+            self._send_error(HTTPStatus.BAD_REQUEST, problem)
+            return
+        job = self.runner.submit(
+            Job(
+                request["profile"],
+                request["wav_path"],
+                request["markers_path"],
+                str(request["number"]),
+                request["title"],
+                request["outdir"],
+            )
+        )
+        self._send_json(HTTPStatus.CREATED, job.as_dict())
+
+    def do_DELETE(self):
+        if not self._check_request():
+            return
+        match = JOB_PATH.match(self.path)
+        if match is None or match.group("events"):
+            self._send_error(HTTPStatus.NOT_FOUND, "No such job")
+        elif self.runner.cancel(match.group("id")):
+            self._send_json(HTTPStatus.OK, self.runner.get(match.group("id")).as_dict())
+        else:
+            self._send_error(HTTPStatus.CONFLICT, "The job can't be cancelled")
+
+    def _check_submission(self, request):
+        if not isinstance(request, dict):
+            return "The request must be a JSON object"
+        for field in REQUIRED_FIELDS:
+            if field not in request:
+                return 'The request is missing "{}"'.format(field)
+        if (
+            request["profile"] == "DEFAULT"
+            or request["profile"] not in self.config_data
+        ):
+            return "There is no [{}] profile".format(request["profile"])
+        for field in ("wav_path", "markers_path"):
+            if not os.path.isfile(request[field]):
+                return "{} doesn't exist".format(request[field])
+        if not os.path.isdir(request["outdir"]):
+            return "{} isn't a folder".format(request["outdir"])
+        return None
+
+    def _stream_events(self, job: Job) -> None:
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        last = None
+        while True:
+            event = job.as_dict()
+            if event != last:
+                try:
+                    self.wfile.write(
+                        "event: {}\ndata: {}\n\n".format(
+                            event["state"], json.dumps(event)
+                        ).encode("utf-8")
+                    )
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped listening; the job carries on.
+                    return
+                last = event
+            if event["state"] in (DONE, FAILED, CANCELLED):
+                break
+            time.sleep(EVENT_POLL_SECONDS)
+
+    def log_message(self, format, *args):
+        print("API: " + format % args)
+
+
+def serve(config_data, runner: JobRunner, port: int) -> ThreadingHTTPServer:
+    """Start the job submission API on localhost, on a background thread.
+
+    The parsed config and the worker pool are shared by every job, so
+    submitting one doesn't pay for starting PostShow up again.  Requests need
+    the ``api_token`` from the config file's ``[DEFAULT]`` section; without
+    one, a token is made up, and printed for the clients to use.
+    """
+    token = config_data.defaults().get("api_token", "").strip()
+    if token == "":
+        token = secrets.token_urlsafe(32)
+        print("API token for this run: {}".format(token))
+    handler = type(
+        "BoundJobRequestHandler",
+        (JobRequestHandler,),
+        {"runner": runner, "config_data": config_data, "token": token},
+    )
+    # Only localhost: the paths in jobs are local.
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="postshow-api", daemon=True
+    ).start()
+    print("Accepting jobs at http://127.0.0.1:{}/jobs".format(server.server_port))
+    return server
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import os.path
+from typing import List, NamedTuple
+
+import finalize
+import mp3frames
+from model import PostShowError
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class Segment(NamedTuple):
+    """A run of frames from one MP3, to be spliced with others."""
+
+    path: str
+    audio_start: int
+    index: mp3frames.FrameIndex
+    first_header: bytes
+    # The number of samples of real audio: everything but LAME's delay at the
+    # start and padding at the end.
+    samples: int
+
+
+def load_segment(path: str, samples=None) -> Segment:
+    """Find the frames in an MP3, skipping its ID3 and Xing/Info tags.
+
+    :param samples: The number of samples of real audio, if it's known.  If not,
+    it's worked out from the LAME tag, or (without one) assumed to be every
+    sample but LAME's delay.
+    """
+    with open(path, "rb") as fp:
+        audio_start = mp3frames.id3v2_size(fp)
+        index = mp3frames.FrameIndex.scan(path, audio_start)
+        if index is None or len(index) == 0:
+            raise PostShowError("{} has no MP3 frames.".format(path))
+        fp.seek(audio_start + index.offsets[0])
+        first_header = fp.read(4)
+    total = len(index) * index.samples_per_frame
+    if samples is None:
+        if index.encoder_padding is not None:
+            samples = total - index.encoder_delay - index.encoder_padding
+        else:
+            samples = total - mp3frames.LAME_DELAY
+    return Segment(path, audio_start, index, first_header, samples)
+
+
+def _copy_range(src, dst, start: int, length: int) -> None:
+    src.seek(start)
+    while length > 0:
+        block = src.read(min(length, COPY_BLOCK_SIZE))
+        if not block:
+            raise PostShowError("{} ended unexpectedly.".format(src.name))
+        dst.write(block)
+        length -= len(block)
+
+
+def splice(segments: List[Segment], output_path: str):
+    """Join MP3s together frame by frame, without re-encoding.
+
+    A LAME Info tag goes in front, so that players can trim the encoder delay
+    at the start and the padding at the end, making the file gapless.  If any
+    of the segments are VBR, it's a Xing tag, with a table of contents built
+    from where the frames ended up.  The
+    delay and padding where two segments meet stay in; at around 50 ms that's
+    not noticeable next to a bumper's own silence.
+
+    :return: A ``(FrameIndex, samples)`` tuple, describing the joined audio.
+    """
+    first = mp3frames.parse_header(segments[0].first_header)
+    for segment in segments[1:]:
+        header = mp3frames.parse_header(segment.first_header)
+        if header.sample_rate != first.sample_rate or (header.channel_mode == 3) != (
+            first.channel_mode == 3
+        ):
+            raise PostShowError(
+                "{} can't be joined to {}: they have different sample rates or "
+                "channel counts.".format(segment.path, segments[0].path)
+            )
+    frames = sum(len(segment.index) for segment in segments)
+    audio_length = sum(
+        segment.index.audio_length - segment.index.offsets[0] for segment in segments
+    )
+    total = frames * first.samples
+    last = segments[-1]
+    # The real audio runs from the start of the first segment, through the
+    # joins, to the end of the last segment's real audio.
+    padding = len(last.index) * first.samples - mp3frames.LAME_DELAY - last.samples
+    samples = total - mp3frames.LAME_DELAY - padding
+    # VBR audio needs a real table of contents, so players can seek it.
+    variable = (
+        any(segment.index.variable for segment in segments)
+        or len({segment.index.bitrate for segment in segments}) > 1
+    )
+    info_header = segments[0].first_header
+    if variable:
+        info_header = mp3frames.info_frame_header(info_header)
+    info = mp3frames.build_info_frame(info_header, frames, 0, padding)
+    if info is None:
+        # Low-bitrate frames are too small for the tag, but the tag frame is
+        # silent, so it can have a higher bitrate than the rest.
+        info_header = mp3frames.info_frame_header(info_header)
+        info = mp3frames.build_info_frame(info_header, frames, 0, padding)
+    if info is None:
+        print("The frames are too small for a LAME tag, so this won't be gapless")
+        info = b""
+    index = mp3frames.FrameIndex(first.sample_rate, first.samples)
+    position = len(info)
+    for segment in segments:
+        base = segment.index.offsets[0]
+        index.offsets.extend(
+            position + offset - base for offset in segment.index.offsets
+        )
+        position += segment.index.audio_length - base
+    index.audio_length = position
+    index.bitrate = segments[0].index.bitrate
+    index.variable = variable
+    if info:
+        info = mp3frames.build_info_frame(
+            info_header,
+            frames,
+            len(info) + audio_length,
+            padding,
+            toc=mp3frames.build_toc(index) if variable else None,
+            method="unknown" if variable else "cbr",
+        )
+    partial = finalize.staging_path_for(output_path, "partial")
+    try:
+        with open(partial, "wb") as dst:
+            dst.write(info)
+            for segment in segments:
+                base = segment.index.offsets[0]
+                length = segment.index.audio_length - base
+                with open(segment.path, "rb") as src:
+                    _copy_range(src, dst, segment.audio_start + base, length)
+        os.replace(partial, output_path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    index.encoder_delay = mp3frames.LAME_DELAY
+    index.encoder_padding = padding
+    return index, samples
+
+
+def cached_bumper(source: str, cache_dir: str, encode_key, encode) -> Segment:
+    """Get a bumper encoded for a profile, encoding it only the first time.
+
+    :param source: The bumper.  An MP3 is used as it is; anything else is
+    encoded.
+    :param encode_key: Everything about the profile that changes the encoded
+    audio; a bumper is encoded again when this changes.
+    :param encode: A function that encodes ``(source, mp3_path)``, and returns
+    the number of samples of real audio in the MP3.
+    """
+    if source.endswith(".mp3"):
+        return load_segment(source)
+    stat = os.stat(source)
+    key = hashlib.sha256(
+        json.dumps(
+            [os.path.abspath(source), stat.st_size, stat.st_mtime_ns, list(encode_key)]
+        ).encode("utf-8")
+    ).hexdigest()[:24]
+    mp3_path = os.path.join(cache_dir, key + ".mp3")
+    info_path = os.path.join(cache_dir, key + ".json")
+    try:
+        with open(info_path, "r", encoding="utf-8") as fp:
+            samples = json.load(fp)["samples"]
+        if os.path.exists(mp3_path):
+            return load_segment(mp3_path, samples)
+    except (OSError, ValueError, KeyError):
+        pass
+    print("Encoding {} (this only happens once)".format(source))
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = finalize.staging_path_for(mp3_path, "mp3")
+    try:
+        samples = encode(source, partial)
+        os.replace(partial, mp3_path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    with open(info_path, "w", encoding="utf-8") as fp:
+        json.dump({"source": os.path.abspath(source), "samples": samples}, fp)
+    return load_segment(mp3_path, samples)
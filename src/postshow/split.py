@@ -0,0 +1,120 @@
+import concurrent.futures
+import copy
+import io
+import mmap
+import os
+from typing import List, NamedTuple
+
+import mutagen.id3
+from mutagen.id3 import TIT2, TLEN, WXXX
+
+import finalize
+import mp3frames
+
+# Frames that describe the whole episode, so they don't belong on a clip.
+EPISODE_ONLY_FRAMES = ["CHAP", "CTOC", "TLEN", "TIT2"]
+
+
+class Clip(NamedTuple):
+    """One chapter's worth of frames, and where to write them."""
+
+    chapter: object
+    path: str
+    first_frame: int
+    end_frame: int
+
+
+def plan_clips(chapters, index: mp3frames.FrameIndex, path_for) -> List[Clip]:
+    """Work out which frames go in each chapter's clip.
+
+    Each clip runs from the frame its chapter starts on to the frame the next
+    chapter starts on (or the end of the audio).
+
+    :param path_for: A function that gives the output path for a clip, given
+    its (1-based) number.
+    """
+    starts = []
+    for chapter in chapters:
+        if chapter.frame is not None:
+            starts.append(chapter.frame)
+        elif chapter.start == 0:
+            starts.append(0)
+        else:
+            starts.append(mp3frames.frame_at(chapter.start, index))
+    ends = starts[1:] + [len(index)]
+    return [
+        Clip(chapter, path_for(number), start, max(start, end))
+        for number, (chapter, start, end) in enumerate(
+            zip(chapters, starts, ends), start=1
+        )
+    ]
+
+
+def render_clip_tag(episode_tag, clip: Clip, index: mp3frames.FrameIndex) -> bytes:
+    """Copy the episode's tag for a clip, with the chapter's title and length."""
+    tag = mutagen.id3.ID3()
+    for frame in episode_tag.values():
+        if frame.FrameID not in EPISODE_ONLY_FRAMES:
+            tag.add(copy.deepcopy(frame))
+    if clip.chapter.text is not None:
+        tag.add(TIT2(text=clip.chapter.text.replace("—", "-")))
+    if clip.chapter.url is not None:
+        tag.add(WXXX(desc="chapter url", url=clip.chapter.url))
+    frame_count = clip.end_frame - clip.first_frame
+    length_ms = frame_count * index.samples_per_frame * 1000 // index.sample_rate
+    tag.add(TLEN(text=str(length_ms)))
+    buffer = io.BytesIO()
+    tag.save(buffer, v2_version=3, padding=lambda info: 0)
+    return buffer.getvalue()
+
+
+def _write_clip(mapped, audio_start, index, clip: Clip, tag_data: bytes):
+    start = audio_start + index.offset_of(clip.first_frame)
+    end = audio_start + index.offset_of(clip.end_frame)
+    partial = finalize.staging_path_for(clip.path, "partial")
+    try:
+        with open(partial, "wb") as fp:
+            writer = finalize.DigestWriter(fp)
+            writer.write(tag_data)
+            with memoryview(mapped) as view:
+                writer.write(view[start:end])
+        os.replace(partial, clip.path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return writer.result(clip.path)
+
+
+def split(
+    mp3_path: str,
+    index: mp3frames.FrameIndex,
+    audio_start: int,
+    episode_tag,
+    clips: List[Clip],
+    workers=None,
+) -> List[finalize.FileDigest]:
+    """Cut an MP3 into clips at frame boundaries, without re-encoding.
+
+    The MP3 is memory-mapped, and the clips are written in parallel.  Each
+    clip's first frame may lean on the bit reservoir of a frame that isn't in
+    the clip, so some decoders will glitch for that one frame.
+
+    :param audio_start: The size of the tag in front of the audio.
+    :param episode_tag: The episode's ``mutagen.id3.ID3`` tag, which each clip
+    gets a copy of.
+    :return: The digest of each clip, in order.
+    """
+    # Rendering tags isn't thread-safe (mutagen converts frames in place), so
+    # do it up front.
+    tags = [render_clip_tag(episode_tag, clip, index) for clip in clips]
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    with open(mp3_path, "rb") as fp, mmap.mmap(
+        fp.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_write_clip, mapped, audio_start, index, clip, tag_data)
+            for clip, tag_data in zip(clips, tags)
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,244 @@
+import io
+import mimetypes
+import os.path
+import threading
+import time
+
+import mutagen.id3
+import mutagen.mp3
+from mutagen import MutagenError
+from mutagen.id3 import (
+    APIC,
+    COMM,
+    CTOC,
+    TALB,
+    TCOM,
+    TCON,
+    TDRC,
+    TIT2,
+    TLAN,
+    TLEN,
+    TPE1,
+    TPE2,
+    TPOS,
+    TRCK,
+    USLT,
+    CTOCFlags,
+    ID3TimeStamp,
+    PictureType,
+)
+
+import finalize
+import mp3frames
+import tracing
+from model import Chapter, PostShowError
+
+
+class MP3Tagger(threading.Thread):
+    """Tag an MP3."""
+
+    def __init__(self, path: str, progress_signal, output_path=None, length_ms=None):
+        """Create a new tagger.
+
+        :param path: The MP3 file to read the audio from.
+        :param progress_signal: The signal to emit progress on.
+        :param output_path: Where to write the tagged MP3.  If not provided, the
+        file at ``path`` is replaced.
+        :param length_ms: The length of the audio, if it is already known.  If not
+        provided, it is read from the MP3.
+        """
+        super().__init__()
+        self.path = path
+        self.output_path = output_path if output_path is not None else path
+        self.progress_signal = progress_signal
+        self.digest = None
+        # The size of the tag in front of the audio, once it's written.
+        self.tag_size = None
+        # How long moving the finished file into place took
+        self.move_seconds = None
+        self.chapters = []
+        # The MP3's frame index, if the encoder already made one.
+        self.frame_index = None
+        self.tracer = tracing.NULL_TRACER
+        # Create an ID3 tag if none exists
+        try:
+            self.tag = mutagen.id3.ID3(path)
+        except MutagenError:
+            broken = mutagen.id3.ID3FileType(path)
+            broken.add_tags(ID3=mutagen.id3.ID3)
+            self.tag = broken.ID3()
+        # Determine the length of the MP3 and write it to a TLEN frame
+        if length_ms is None:
+            mp3 = mutagen.mp3.MP3(path)
+            length_ms = int(round(mp3.info.length * 1000, 0))
+        self.length_ms = length_ms
+        self.tag.add(TLEN(text=str(self.length_ms)))
+
+    @staticmethod
+    def _no_padding(arg):
+        return 0
+
+    def render_tag(self) -> bytes:
+        """Render the tag exactly as it will be written to the file."""
+        buffer = io.BytesIO()
+        self.tag.save(buffer, v2_version=3, padding=self._no_padding)
+        return buffer.getvalue()
+
+    def write(self) -> None:
+        """Write the tag followed by the audio to the output file.
+
+        This is a single sequential pass over the audio (inserting a tag into
+        the existing file would move every byte anyway), and the checksum and
+        length of the finished file are computed along the way.
+        """
+        with open(self.path, "rb") as src:
+            audio_start = mp3frames.id3v2_size(src)
+        with self.tracer.span("render_tag"):
+            self._set_chapter_offsets(audio_start)
+            tag_data = self.render_tag()
+        self.tag_size = len(tag_data)
+        partial = finalize.staging_path_for(self.output_path, "partial")
+        try:
+            with open(self.path, "rb") as src, open(partial, "wb") as dst:
+                writer = finalize.DigestWriter(dst)
+                writer.write(tag_data)
+                with self.tracer.span("copy_audio"):
+                    writer.copy_from(src, audio_start)
+            started = time.perf_counter()
+            os.replace(partial, self.output_path)
+            self.move_seconds = time.perf_counter() - started
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        self.digest = writer.result(self.output_path)
+        self.tracer.count_file_in(self.path)
+        self.tracer.count_out(self.digest.length)
+
+    def _set_chapter_offsets(self, audio_start: int) -> None:
+        """Fill in the byte offsets of chapters that start on a known frame.
+
+        The offsets count from the start of the file, tag included.  The CHAP
+        frames have the same size whatever the offsets are, so the tag is
+        rendered once to find out how big it is.
+        """
+        snapped = [chapter for chapter in self.chapters if chapter.frame is not None]
+        if len(snapped) == 0:
+            return
+        index = self.frame_index
+        if index is None:
+            index = mp3frames.FrameIndex.scan(self.path, audio_start)
+        if index is None:
+            print("Couldn't find the MP3 frames, so chapters won't have offsets")
+            return
+        tag_size = len(self.render_tag())
+        for chapter in snapped:
+            chapter.start_offset = tag_size + index.offset_of(chapter.frame)
+            chapter.end_offset = tag_size + index.offset_of(chapter.end_frame)
+            # This replaces the CHAP frame with the same element ID.
+            self.add_chapter(chapter)
+
+    @tracing.traced("MP3Tagger.run")
+    def run(self) -> None:
+        self.write()
+        self.progress_signal.progressed.emit(101)
+
+    def set_title(self, title: str) -> None:
+        """Set the title of the MP3."""
+        self.tag.delall("TIT2")
+        self.tag.add(TIT2(text=title))
+
+    def set_artist(self, artist: str) -> None:
+        """Set the artist of the MP3."""
+        self.tag.delall("TPE1")
+        self.tag.add(TPE1(text=artist))
+
+    def set_album(self, album: str) -> None:
+        """Set the album of the MP3."""
+        self.tag.delall("TALB")
+        self.tag.add(TALB(text=album))
+
+    def set_season(self, season: str) -> None:
+        """Set the season of the MP3."""
+        self.tag.delall("TPOS")
+        self.tag.add(TPOS(text=season))
+
+    def set_genre(self, genre: str) -> None:
+        """Set the genre of the MP3."""
+        self.tag.delall("TCON")
+        self.tag.add(TCON(text=genre))
+
+    def set_composer(self, composer: str) -> None:
+        """Set the composer of the MP3."""
+        self.tag.delall("TCOM")
+        self.tag.add(TCOM(text=composer))
+
+    def set_accompaniment(self, accompaniment: str) -> None:
+        """Set the accompaniment of the MP3."""
+        self.tag.delall("TPE2")
+        self.tag.add(TPE2(text=accompaniment))
+
+    def set_cover_art(self, path: str):
+        """Set the cover art of the MP3."""
+        self.tag.delall("APIC")
+        mime, _ = mimetypes.guess_type(path)
+        if mime is None:
+            raise PostShowError("Unable to guess MIME type of cover image.")
+        data = None
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+        except IOError:
+            raise PostShowError("Unable to read cover image file.")
+        apic = APIC(
+            mime=mime,
+            type=PictureType.COVER_FRONT,
+            desc="podcast cover art",
+            data=data,
+        )
+        self.tag.add(apic)
+
+    def set_date(self, year: str) -> None:
+        """Set the date of recording of the MP3."""
+        self.tag.delall("TDRC")
+        self.tag.add(TDRC(text=[ID3TimeStamp(year)]))
+
+    def set_trackno(self, trackno: str) -> None:
+        """Set the track number of the MP3."""
+        self.tag.delall("TRCK")
+        self.tag.add(TRCK(text=trackno))
+
+    def set_language(self, language: str) -> None:
+        """Set the language of the MP3."""
+        self.tag.delall("TLAN")
+        self.tag.add(TLAN(text=language))
+
+    def add_comment(self, lang: str, desc: str, comment: str) -> None:
+        """Add a comment to the MP3."""
+        self.tag.add(COMM(lang=lang, desc=desc, text=[comment]))
+
+    def add_lyrics(self, lang: str, desc: str, lyrics: str) -> None:
+        """Add lyrics to the MP3."""
+        self.tag.add(USLT(lang=lang, desc=desc, text=lyrics))
+
+    def add_chapter(self, chapter: Chapter):
+        """Add a chapter to the MP3."""
+        self.tag.add(chapter.as_chap())
+        if chapter not in self.chapters:
+            self.chapters.append(chapter)
+
+    def add_chapters(self, chapters: list):
+        """Add a whole list of chapters to the MP3."""
+        child_element_ids = []
+        for chapter in chapters:
+            self.add_chapter(chapter)
+            if chapter.indexed:
+                child_element_ids.append(chapter.elem_id)
+        self.tag.add(
+            CTOC(
+                element_id="toc",
+                flags=CTOCFlags.TOP_LEVEL | CTOCFlags.ORDERED,
+                child_element_ids=child_element_ids,
+                sub_frames=[TIT2(text="Primary Chapter List")],
+            )
+        )
@@ -0,0 +1,203 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Span:
+    """One timed step of the pipeline, with how many bytes it read and wrote.
+
+    Use it as a context manager; it's recorded when the block exits.
+    """
+
+    __slots__ = ("tracer", "name", "args", "start", "bytes_in", "bytes_out")
+
+    def __init__(self, tracer, name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        self.tracer._pop(self, end, exc_type)
+        return False
+
+
+class Tracer:
+    """Collects spans from every thread, to export as a Chrome trace.
+
+    The export can be opened in Perfetto (https://ui.perfetto.dev) or Chrome's
+    ``about:tracing``.
+    """
+
+    enabled = True
+
+    def __init__(self, owner=None):
+        """
+        :param owner: Whatever made the tracer, and so should export it.
+        """
+        self.owner = owner
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+        self.thread_names = {}
+        self.thread_count = 0
+
+    def span(self, name: str, **args) -> Span:
+        return Span(self, name, args)
+
+    def _stack(self) -> list:
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _push(self, span: Span) -> None:
+        self._stack().append(span)
+
+    def _pop(self, span: Span, end: int, exc_type) -> None:
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        args = dict(span.args)
+        args["bytes_in"] = span.bytes_in
+        args["bytes_out"] = span.bytes_out
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        tid = getattr(self.local, "tid", None)
+        if tid is None:
+            # Thread idents get reused, so number the threads instead.
+            with self.lock:
+                self.thread_count += 1
+                tid = self.local.tid = self.thread_count
+                self.thread_names[tid] = threading.current_thread().name
+        event = {
+            "name": span.name,
+            "cat": "postshow",
+            "ph": "X",
+            "ts": (span.start - self.origin) / 1000,
+            "dur": (end - span.start) / 1000,
+            "pid": self.pid,
+            "tid": tid,
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def count_in(self, length: int) -> None:
+        """Add to the bytes read by the innermost span on this thread."""
+        stack = self._stack()
+        if stack:
+            stack[-1].bytes_in += length
+
+    def count_out(self, length: int) -> None:
+        """Add to the bytes written by the innermost span on this thread."""
+        stack = self._stack()
+        if stack:
+            stack[-1].bytes_out += length
+
+    def count_file_in(self, path) -> None:
+        if path and os.path.exists(path):
+            self.count_in(os.path.getsize(path))
+
+    def count_file_out(self, path) -> None:
+        if path and os.path.exists(path):
+            self.count_out(os.path.getsize(path))
+
+    def as_chrome_trace(self) -> dict:
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+            names = dict(self.thread_names)
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in names.items()
+        ]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str) -> None:
+        """Write the trace as Chrome trace event JSON."""
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(self.as_chrome_trace(), fp)
+
+
+class NullTracer:
+    """A tracer that records nothing, for when tracing is off."""
+
+    enabled = False
+    owner = None
+
+    def span(self, name: str, **args):
+        return NULL_SPAN
+
+    def count_in(self, length: int) -> None:
+        pass
+
+    def count_out(self, length: int) -> None:
+        pass
+
+    def count_file_in(self, path) -> None:
+        pass
+
+    def count_file_out(self, path) -> None:
+        pass
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+NULL_TRACER = NullTracer()
+
+
+def wanted(config_data, profile: str) -> bool:
+    """Whether the profile, or the POSTSHOW_TRACE environment variable, asks
+    for tracing."""
+    if os.environ.get("POSTSHOW_TRACE", "") not in ("", "0"):
+        return True
+    return config_data.getboolean(profile, "trace", fallback=False)
+
+
+def traced(name: str):
+    """Make every call of a method a span, on the object's ``tracer``.
+
+    When tracing is off, this costs well under a microsecond per call.
+    """
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = self.tracer
+            if not tracer.enabled:
+                return method(self, *args, **kwargs)
+            profile = getattr(self, "profile", None)
+            span_args = {} if profile is None else {"profile": profile}
+            with tracer.span(name, **span_args):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
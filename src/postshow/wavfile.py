@@ -0,0 +1,260 @@
+import mmap
+import struct
+
+from model import PostShowError
+
+# How much audio to hand out at a time when streaming a file.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# RF64 (and BW64) files put this in a 32-bit size, and the real size in the
+# ds64 chunk.
+RF64_SIZE_UNSET = 0xFFFFFFFF
+# Sony Wave64 identifies chunks by GUID rather than four-character code.
+W64_GUID_SUFFIX = b"\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a"
+W64_RIFF = b"riff\x2e\x91\xcf\x11\xa5\xd6\x28\xdb\x04\xc1\x00\x00"
+W64_WAVE = b"wave" + W64_GUID_SUFFIX
+W64_FMT = b"fmt " + W64_GUID_SUFFIX
+W64_DATA = b"data" + W64_GUID_SUFFIX
+# AIFF-C compression types for uncompressed audio: big-endian and
+# little-endian integers, and big-endian floats.
+AIFC_BIG_ENDIAN = [b"NONE", b"twos", b"in24", b"in32"]
+AIFC_LITTLE_ENDIAN = [b"sowt"]
+AIFC_FLOAT = [b"fl32", b"FL32", b"fl64", b"FL64"]
+# AIFF's 8-bit samples are signed, and WAV's are unsigned.
+SIGNED_TO_UNSIGNED = bytes((byte + 128) % 256 for byte in range(256))
+
+
+class WaveFile:
+    """The layout of the audio inside a WAV file.
+
+    Plain RIFF WAV files are read, along with Broadcast WAV (which is RIFF
+    with a ``bext`` chunk), and the RF64, BW64 and Wave64 formats that
+    recordings over 4 GB need.  Only the header is read; the sample data is
+    left where it is, so opening a huge recording is instant.
+
+    AIFF and AIFF-C files are read too.  Their samples are handed out as they
+    would be in a WAV file (little-endian, with unsigned 8-bit samples), so
+    nothing else has to know the difference.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.format_tag = None
+        self.channels = None
+        self.sample_rate = None
+        self.bits_per_sample = None
+        self.block_align = None
+        self.data_offset = None
+        self.data_length = None
+        # Set for AIFF files, whose samples need converting to WAV's layout
+        self.big_endian = False
+        self.signed_8bit = False
+        with open(path, "rb") as fp:
+            header = fp.read(16)
+            fp.seek(0)
+            if header == W64_RIFF:
+                self._parse_w64(fp)
+            elif header[:4] == b"FORM":
+                self._parse_aiff(fp)
+            else:
+                self._parse(fp)
+            if self.format_tag is None:
+                raise PostShowError("{} has no format chunk.".format(self.path))
+            # Recorders that crash (or stream) leave the data length unset or
+            # wrong, so never trust it past the end of the file.
+            fp.seek(0, 2)
+            available = fp.tell() - self.data_offset
+            if self.data_length > available:
+                self.data_length = available
+            self.data_length -= self.data_length % self.block_align
+
+    def _parse(self, fp) -> None:
+        riff = fp.read(12)
+        if (
+            len(riff) < 12
+            or riff[:4] not in (b"RIFF", b"RF64", b"BW64")
+            or riff[8:12] != b"WAVE"
+        ):
+            raise PostShowError("{} is not a WAV file.".format(self.path))
+        is_rf64 = riff[:4] != b"RIFF"
+        rf64_data_length = None
+        while self.data_offset is None:
+            chunk_header = fp.read(8)
+            if len(chunk_header) < 8:
+                raise PostShowError("{} has no audio data.".format(self.path))
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"ds64":
+                # The RIFF size, then the data size, as 64-bit numbers
+                rf64_data_length = struct.unpack("<Q", fp.read(16)[8:16])[0]
+                fp.seek(chunk_size - 16, 1)
+            elif chunk_id == b"fmt ":
+                self._parse_fmt(fp.read(chunk_size))
+            elif chunk_id == b"data":
+                self.data_offset = fp.tell()
+                self.data_length = chunk_size
+                if is_rf64 and rf64_data_length is not None:
+                    self.data_length = rf64_data_length
+                elif chunk_size == RF64_SIZE_UNSET:
+                    # A recorder that didn't know how long the audio would be;
+                    # it runs to the end of the file.
+                    self.data_length = 1 << 64
+                break
+            else:
+                fp.seek(chunk_size, 1)
+            # Chunks are padded to an even length.
+            if chunk_size % 2 == 1:
+                fp.seek(1, 1)
+
+    def _parse_w64(self, fp) -> None:
+        riff = fp.read(40)
+        if len(riff) < 40 or riff[24:40] != W64_WAVE:
+            raise PostShowError("{} is not a Wave64 file.".format(self.path))
+        while self.data_offset is None:
+            chunk_header = fp.read(24)
+            if len(chunk_header) < 24:
+                raise PostShowError("{} has no audio data.".format(self.path))
+            chunk_id = chunk_header[:16]
+            # Wave64 sizes count the chunk header.
+            chunk_size = struct.unpack("<Q", chunk_header[16:])[0] - 24
+            if chunk_id == W64_FMT:
+                self._parse_fmt(fp.read(chunk_size))
+            elif chunk_id == W64_DATA:
+                self.data_offset = fp.tell()
+                self.data_length = chunk_size
+                break
+            else:
+                fp.seek(chunk_size, 1)
+            # Chunks are padded to a multiple of eight bytes.
+            fp.seek(-chunk_size % 8, 1)
+
+    def _parse_aiff(self, fp) -> None:
+        form = fp.read(12)
+        if len(form) < 12 or form[8:12] not in (b"AIFF", b"AIFC"):
+            raise PostShowError("{} is not an AIFF file.".format(self.path))
+        is_aifc = form[8:12] == b"AIFC"
+        # The sound data can come before the COMM chunk that describes it.
+        while self.data_offset is None or self.format_tag is None:
+            chunk_header = fp.read(8)
+            if len(chunk_header) < 8:
+                if self.format_tag is None:
+                    break
+                raise PostShowError("{} has no audio data.".format(self.path))
+            chunk_id, chunk_size = struct.unpack(">4sI", chunk_header)
+            if chunk_id == b"COMM":
+                self._parse_comm(fp.read(chunk_size), is_aifc)
+            elif chunk_id == b"SSND":
+                offset = struct.unpack(">I", fp.read(8)[:4])[0]
+                self.data_offset = fp.tell() + offset
+                self.data_length = chunk_size - 8 - offset
+                fp.seek(chunk_size - 8, 1)
+            else:
+                fp.seek(chunk_size, 1)
+            if chunk_size % 2 == 1:
+                fp.seek(1, 1)
+
+    def _parse_comm(self, data: bytes, is_aifc: bool) -> None:
+        self.channels, _, bits = struct.unpack(">hIh", data[:8])
+        # The sample rate is an 80-bit extended-precision float.
+        exponent, mantissa = struct.unpack(">HQ", data[8:18])
+        self.sample_rate = int(
+            round(mantissa * 2.0 ** ((exponent & 0x7FFF) - 16383 - 63))
+        )
+        compression = data[18:22] if is_aifc else b"NONE"
+        if compression in AIFC_FLOAT:
+            self.format_tag = WAVE_FORMAT_IEEE_FLOAT
+            bits = 64 if compression.lower() == b"fl64" else 32
+            self.big_endian = True
+        elif compression in AIFC_BIG_ENDIAN + AIFC_LITTLE_ENDIAN:
+            self.format_tag = WAVE_FORMAT_PCM
+            self.big_endian = compression in AIFC_BIG_ENDIAN
+        else:
+            raise PostShowError(
+                "{} is compressed ({}), which isn't supported.".format(
+                    self.path, compression.decode("latin-1")
+                )
+            )
+        # Samples are padded out to whole bytes.
+        width = (bits + 7) // 8
+        self.bits_per_sample = width * 8
+        self.block_align = width * self.channels
+        self.signed_8bit = width == 1
+
+    def _to_wav_layout(self, block: bytes) -> bytes:
+        """Rearrange a block of AIFF samples the way a WAV file has them."""
+        width = self.block_align // self.channels
+        if self.big_endian and width > 1:
+            swapped = bytearray(len(block))
+            for i in range(width):
+                swapped[i::width] = block[width - 1 - i :: width]
+            block = bytes(swapped)
+        if self.signed_8bit:
+            block = block.translate(SIGNED_TO_UNSIGNED)
+        return block
+
+    def _parse_fmt(self, data: bytes) -> None:
+        (
+            self.format_tag,
+            self.channels,
+            self.sample_rate,
+            _,
+            self.block_align,
+            self.bits_per_sample,
+        ) = struct.unpack("<HHIIHH", data[:16])
+        if self.format_tag == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+            # The real format tag is the first two bytes of the sub-format GUID.
+            self.format_tag = struct.unpack("<H", data[24:26])[0]
+        if self.format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise PostShowError(
+                "{} uses an unsupported sample format ({:#06x}).".format(
+                    self.path, self.format_tag
+                )
+            )
+
+    @property
+    def is_float(self) -> bool:
+        return self.format_tag == WAVE_FORMAT_IEEE_FLOAT
+
+    @property
+    def frame_count(self) -> int:
+        """The number of samples in each channel."""
+        return self.data_length // self.block_align
+
+    @property
+    def duration_ms(self) -> int:
+        return int(round(self.frame_count * 1000 / self.sample_rate, 0))
+
+    def iter_blocks(self, block_size: int = BLOCK_SIZE, start_frame=0, end_frame=None):
+        """Read the sample data in blocks of whole sample frames.
+
+        Each block is memory-mapped on its own and copied out, so memory use
+        stays flat however big the file is.
+
+        :param block_size: The approximate size of each block, in bytes.
+        :param start_frame: The first sample frame to read.
+        :param end_frame: The sample frame to stop before (default: the end).
+        """
+        if end_frame is None or end_frame > self.frame_count:
+            end_frame = self.frame_count
+        block_length = max(1, block_size // self.block_align) * self.block_align
+        position = self.data_offset + start_frame * self.block_align
+        end = self.data_offset + end_frame * self.block_align
+        with open(self.path, "rb") as fp:
+            while position < end:
+                length = min(block_length, end - position)
+                map_start = position - position % mmap.ALLOCATIONGRANULARITY
+                skip = position - map_start
+                with mmap.mmap(
+                    fp.fileno(),
+                    skip + length,
+                    access=mmap.ACCESS_READ,
+                    offset=map_start,
+                ) as mapped:
+                    block = mapped[skip : skip + length]
+                if self.big_endian or self.signed_8bit:
+                    block = self._to_wav_layout(block)
+                yield block
+                position += length
@@ -0,0 +1,52 @@
+import struct
+import wave
+
+import pytest
+
+
+@pytest.fixture
+def write_wav(tmp_path):
+    """Write a 16-bit PCM WAV of constant samples, and return its path."""
+
+    def write(name, seconds, sample_rate=8000, channels=2, value=16):
+        path = tmp_path / name
+        frames = round(seconds * sample_rate)
+        with wave.open(str(path), "wb") as wav:
+            wav.setnchannels(channels)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes(struct.pack("<h", value) * channels * frames)
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def write_mp3(tmp_path):
+    """Write an MP3 of silent MPEG-1 Layer III frames, and return its path.
+
+    ``bitrates`` has the bitrate (Kbps) of each frame.  The frames hold nothing
+    but zeroes, which is enough for anything that only reads the headers.
+    """
+    import mp3frames
+
+    def write(name, bitrates, sample_rate=44100, mono=False):
+        sample_rate_index = mp3frames.SAMPLE_RATES[3].index(sample_rate)
+        data = bytearray()
+        for bitrate in bitrates:
+            header = bytes(
+                [
+                    0xFF,
+                    0xFB,
+                    (mp3frames.BITRATES_V1.index(bitrate) << 4)
+                    | (sample_rate_index << 2),
+                    0xC0 if mono else 0x00,
+                ]
+            )
+            length = mp3frames.parse_header(header).length
+            data += header + bytes(length - 4)
+        path = tmp_path / name
+        path.write_bytes(bytes(data))
+        return str(path)
+
+    return write
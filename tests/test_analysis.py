@@ -0,0 +1,17 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+import analysis  # noqa: E402
+import wavfile  # noqa: E402
+
+
+@pytest.mark.parametrize("seconds", [0.5, 60, 60.5, 61.5])
+def test_preflight_handles_a_partial_last_block(write_wav, seconds):
+    # Chunks hold 60 one-second blocks, so 0.5 s and 60.5 s both end on a
+    # chunk with no whole blocks in it.
+    path = write_wav("episode.wav", seconds)
+    report = analysis.preflight(wavfile.WaveFile(path))
+    assert report.duration_ms == int(seconds * 1000)
+    assert report.block_rms_dbfs.shape == (-(-int(seconds * 10) // 10), 2)
+    assert "The recording is empty." not in report.problems
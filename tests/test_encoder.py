@@ -0,0 +1,28 @@
+import encoder
+from model import PostShowError
+
+
+class Progress:
+    def __init__(self):
+        self.finished = False
+
+    def set_progress(self, value):
+        pass
+
+    def set_finished(self):
+        self.finished = True
+
+
+def test_more_than_two_channels_is_refused_before_lame_starts(
+    write_wav, tmp_path, monkeypatch
+):
+    # If LAME were started, this would fail with an OSError instead.
+    monkeypatch.setenv("POSTSHOW_LAME", str(tmp_path / "no-such-lame"))
+    path = write_wav("surround.wav", 0.5, channels=6)
+    progress = Progress()
+    mp3 = encoder.MP3Encoder(path, str(tmp_path / "out.mp3"), "64", progress)
+    mp3.run()
+    assert isinstance(mp3.error, PostShowError)
+    assert "6 channels" in str(mp3.error)
+    assert mp3.p is None
+    assert progress.finished
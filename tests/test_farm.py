@@ -0,0 +1,71 @@
+import io
+import socket
+
+import pytest
+
+import farm
+from model import PostShowError
+
+
+def test_segments_cover_the_recording_on_frame_boundaries():
+    sample_count = 1152 * 1000 + 100
+    segments = farm.plan_segments(sample_count, 1152, 4)
+    assert [segment.number for segment in segments] == [0, 1, 2, 3]
+    assert segments[0].start == 0
+    assert segments[-1].end is None
+    for before, after in zip(segments, segments[1:]):
+        assert before.end == after.start
+        assert before.end % 1152 == 0
+    for segment in segments[1:]:
+        assert segment.skip_frames == farm.PREROLL_FRAMES
+        assert segment.read_start == segment.start - farm.PREROLL_FRAMES * 1152
+    assert segments[0].skip_frames == 0
+    assert segments[0].read_start == 0
+    assert segments[0].keep_frames == 251
+    assert segments[0].read_end == (251 + farm.POSTROLL_FRAMES) * 1152
+    assert segments[-1].keep_frames is None
+
+
+def test_short_recordings_are_one_segment():
+    (segment,) = farm.plan_segments(1152 * 10, 1152, 8)
+    assert (segment.start, segment.end, segment.read_end) == (0, None, None)
+    (segment,) = farm.plan_segments(0, 1152, 8)
+    assert segment.start == 0
+
+
+def test_trim_frames(write_mp3):
+    with open(write_mp3("segment.mp3", [32, 64, 96, 128, 160]), "rb") as fp:
+        data = fp.read()
+    # 104, 208, 313 and 417 bytes
+    assert farm.trim_frames(data, 1, 2) == data[104 : 104 + 208 + 313]
+    assert farm.trim_frames(data, 3, None) == data[104 + 208 + 313 :]
+    with pytest.raises(PostShowError):
+        farm.trim_frames(data, 4, 2)
+    with pytest.raises(PostShowError):
+        farm.trim_frames(data[:-1] + b"garbage", 0, 5)
+
+
+def test_parse_address():
+    assert farm.parse_address("worker:9000") == ("worker", 9000)
+    assert farm.parse_address("9000") == ("localhost", 9000)
+    assert farm.parse_address("[::1]:9000") == ("[::1]", 9000)
+    with pytest.raises(PostShowError):
+        farm.parse_address("worker")
+
+
+def test_message_round_trip():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        farm.send_message(sender, {"type": "encode", "segment": 3}, b"\x01\x02")
+        farm.send_message(sender, {"type": "bye"})
+        with receiver.makefile("rb") as fp:
+            assert farm.read_message(fp) == (
+                {"type": "encode", "segment": 3, "length": 2},
+                b"\x01\x02",
+            )
+            assert farm.read_message(fp) == ({"type": "bye", "length": 0}, b"")
+
+
+def test_a_truncated_message_is_a_connection_error():
+    with pytest.raises(ConnectionError):
+        farm.read_message(io.BytesIO(b"\x00\x00\x00\x10{}"))
@@ -0,0 +1,27 @@
+import hashlib
+import io
+
+import finalize
+
+
+def test_digest_writer_matches_the_file(tmp_path):
+    data = bytes(range(256)) * 9000
+    path = tmp_path / "episode.mp3"
+    with open(str(path), "wb") as fp:
+        writer = finalize.DigestWriter(fp)
+        writer.write(b"ID3")
+        # Bigger than a block, from part way in
+        writer.copy_from(io.BytesIO(data), 10, finalize.DIGEST_BLOCK_SIZE + 5)
+        writer.copy_from(io.BytesIO(b"tail"))
+    expected = b"ID3" + data[10 : 10 + finalize.DIGEST_BLOCK_SIZE + 5] + b"tail"
+    digest = writer.result(str(path))
+    assert digest.length == len(expected)
+    assert digest.sha256 == hashlib.sha256(expected).hexdigest()
+    assert finalize.digest_file(str(path)) == digest
+
+
+def test_staging_path_is_hidden_next_to_the_final_path(tmp_path):
+    final = str(tmp_path / "osw-1.mp3")
+    assert finalize.staging_path_for(final, "mp3") == str(
+        tmp_path / ".osw-1.mp3.encoding.mp3"
+    )
@@ -0,0 +1,74 @@
+import json
+
+import journal
+
+
+def test_resume_round_trip(write_wav, tmp_path):
+    recording = write_wav("episode.wav", 0.5)
+    encoded = tmp_path / "episode.mp3"
+    encoded.write_bytes(b"not really an MP3")
+    path = str(tmp_path / "episode.journal")
+    job = journal.Journal.fingerprint(recording, profile="default", bitrate="64")
+
+    first = journal.Journal(path)
+    assert first.resume_point(job) is None
+    first.begin(job)
+    first.complete("encode", str(encoded), duration_ms=500, intro_frames=0)
+
+    # What the next run, after a crash, sees
+    second = journal.Journal(path)
+    stage, artifacts = second.resume_point(job)
+    assert stage == "encode"
+    assert artifacts["path"] == str(encoded)
+    assert artifacts["duration_ms"] == 500
+    assert artifacts["intro_frames"] == 0
+
+
+def test_a_different_job_starts_over(write_wav, tmp_path):
+    recording = write_wav("episode.wav", 0.5)
+    encoded = tmp_path / "episode.mp3"
+    encoded.write_bytes(b"")
+    path = str(tmp_path / "episode.journal")
+    job = journal.Journal.fingerprint(recording, bitrate="64")
+    first = journal.Journal(path)
+    first.begin(job)
+    first.complete("encode", str(encoded))
+
+    second = journal.Journal(path)
+    assert second.resume_point(job) is not None
+    assert (
+        second.resume_point(journal.Journal.fingerprint(recording, bitrate="96"))
+        is None
+    )
+    # The recording was edited since.
+    write_wav("episode.wav", 1)
+    assert (
+        second.resume_point(journal.Journal.fingerprint(recording, bitrate="64"))
+        is None
+    )
+
+
+def test_nothing_to_resume_without_the_output(write_wav, tmp_path):
+    recording = write_wav("episode.wav", 0.5)
+    path = str(tmp_path / "episode.journal")
+    job = journal.Journal.fingerprint(recording)
+    first = journal.Journal(path)
+    first.begin(job)
+    first.complete("encode", str(tmp_path / "deleted.mp3"))
+    assert journal.Journal(path).resume_point(job) is None
+
+
+def test_a_half_written_journal_is_ignored(tmp_path):
+    path = tmp_path / "episode.journal"
+    path.write_text(json.dumps({"version": journal.JOURNAL_VERSION})[:-3])
+    assert journal.Journal(str(path)).job is None
+
+
+def test_discard(write_wav, tmp_path):
+    path = tmp_path / "episode.journal"
+    done = journal.Journal(str(path))
+    done.begin(journal.Journal.fingerprint(write_wav("episode.wav", 0.5)))
+    assert path.exists()
+    done.discard()
+    assert not path.exists()
+    assert journal.Journal(str(path)).job is None
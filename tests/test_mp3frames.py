@@ -0,0 +1,131 @@
+import mp3frames
+
+
+def test_parse_header():
+    header = mp3frames.parse_header(b"\xff\xfb\x92\x00")
+    assert header.version == 3
+    assert header.bitrate == 128
+    assert header.sample_rate == 44100
+    assert header.padding == 1
+    assert header.samples == 1152
+    assert header.length == 418
+    assert mp3frames.parse_header(b"ID3\x04") is None
+    # Layer II
+    assert mp3frames.parse_header(b"\xff\xfd\x90\x00") is None
+
+
+def test_feeding_in_pieces_matches_a_scan(write_mp3):
+    path = write_mp3("episode.mp3", [128, 64, 320, 128, 32])
+    scanned = mp3frames.FrameIndex.scan(path)
+    with open(path, "rb") as fp:
+        data = fp.read()
+    fed = mp3frames.FrameIndex()
+    # Small enough that frames and headers span pieces
+    for start in range(0, len(data), 3):
+        fed.feed(data[start : start + 3])
+    assert fed.valid
+    assert list(fed.offsets) == list(scanned.offsets)
+    assert list(scanned.offsets) == [0, 417, 625, 1669, 2086]
+    assert fed.audio_length == scanned.audio_length == len(data)
+    assert fed.variable and scanned.variable
+    assert fed.sample_rate == 44100
+    assert fed.samples_per_frame == 1152
+
+
+def test_offset_of_past_the_end_is_the_end_of_the_audio(write_mp3):
+    index = mp3frames.FrameIndex.scan(write_mp3("episode.mp3", [64] * 3))
+    assert index.offset_of(1) == 208
+    assert index.offset_of(3) == index.audio_length == 3 * 208
+
+
+def test_garbage_makes_a_fed_index_invalid(write_mp3):
+    with open(write_mp3("episode.mp3", [64] * 2), "rb") as fp:
+        data = fp.read()
+    index = mp3frames.FrameIndex()
+    index.feed(data + b"TAG" + bytes(125))
+    assert not index.valid
+    assert len(index) == 2
+
+
+def test_scan_skips_the_id3_tag_it_is_given(write_mp3, tmp_path):
+    with open(write_mp3("episode.mp3", [64] * 2), "rb") as fp:
+        frames = fp.read()
+    # A 100-byte ID3v2 tag; its size is four 7-bit bytes.
+    tag = b"ID3\x04\x00\x00\x00\x00\x00\x5a" + bytes(90)
+    path = tmp_path / "tagged.mp3"
+    path.write_bytes(tag + frames)
+    with open(str(path), "rb") as fp:
+        audio_start = mp3frames.id3v2_size(fp)
+    assert audio_start == 100
+    index = mp3frames.FrameIndex.scan(str(path), audio_start)
+    assert list(index.offsets) == [0, 208]
+
+
+def test_crc16():
+    # The standard check value for CRC-16/ARC
+    assert mp3frames.crc16(b"123456789") == 0xBB3D
+
+
+def test_info_frame_round_trip():
+    header = b"\xff\xfb\x90\x00"
+    frame = mp3frames.build_info_frame(header, 1000, 418000, 1234)
+    parsed = mp3frames.parse_header(frame)
+    assert len(frame) == parsed.length == 417
+    assert mp3frames.read_info_frame(frame, parsed) == (
+        mp3frames.LAME_DELAY,
+        1234,
+    )
+    position = 4 + mp3frames.side_info_size(parsed)
+    assert frame[position : position + 4] == b"Info"
+    assert int.from_bytes(frame[position + 8 : position + 12], "big") == 1000
+    assert int.from_bytes(frame[position + 12 : position + 16], "big") == 418000
+    # The tag's CRC covers everything in the frame before it.
+    end = position + mp3frames.INFO_SIZE + mp3frames.LAME_SIZE
+    crc = int.from_bytes(frame[end - 2 : end], "big")
+    assert crc == mp3frames.crc16(frame[: end - 2])
+
+
+def test_xing_frame_for_vbr_audio_is_skipped_by_the_index(write_mp3):
+    path = write_mp3("episode.mp3", [64, 128, 256, 32])
+    with open(path, "rb") as fp:
+        audio = fp.read()
+    toc = mp3frames.build_toc(mp3frames.FrameIndex.scan(path))
+    info_header = mp3frames.info_frame_header(b"\xff\xfb\x10\x00")
+    xing = mp3frames.build_info_frame(info_header, 4, 0, 99, toc=toc, method="vbr")
+    assert xing[4 + 32 : 4 + 32 + 4] == b"Xing"
+
+    index = mp3frames.FrameIndex()
+    index.feed(xing + audio)
+    assert len(index) == 4
+    assert index.offsets[0] == len(xing)
+    assert (index.encoder_delay, index.encoder_padding) == (
+        mp3frames.LAME_DELAY,
+        99,
+    )
+
+
+def test_info_frame_header_picks_the_smallest_bitrate_that_fits():
+    # The header, side information and tags take 192 bytes; 56 Kbps frames are
+    # 182 bytes and 64 Kbps frames 208.
+    header = mp3frames.parse_header(mp3frames.info_frame_header(b"\xff\xfb\x12\x00"))
+    assert header.bitrate == 64
+    assert header.padding == 0
+    assert mp3frames.build_info_frame(b"\xff\xfb\x30\x00", 1, 0, 0) is None
+
+
+def test_toc_of_cbr_audio_is_a_straight_line(write_mp3):
+    index = mp3frames.FrameIndex.scan(write_mp3("episode.mp3", [128] * 200))
+    toc = mp3frames.build_toc(index)
+    assert len(toc) == 100
+    assert toc[0] == 0
+    assert list(toc) == [percent * 256 // 100 for percent in range(100)]
+
+
+def test_toc_of_vbr_audio_follows_the_frames(write_mp3):
+    # The first half of the frames hold a fifth of the bytes.
+    index = mp3frames.FrameIndex.scan(
+        write_mp3("episode.mp3", [64] * 100 + [256] * 100)
+    )
+    toc = mp3frames.build_toc(index)
+    assert toc[50] == 100 * 208 * 256 // index.audio_length
+    assert all(a <= b for a, b in zip(toc, toc[1:]))
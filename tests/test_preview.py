@@ -0,0 +1,58 @@
+import model
+import preview
+
+
+def chapters(*starts):
+    return [
+        model.Chapter(start, start + 1000, text="Chapter at {}".format(start))
+        for start in starts
+    ]
+
+
+def test_windows_are_clipped_to_the_recording():
+    windows = preview.plan_windows(chapters(0, 3000, 9000, 20000), 1000, 10000, 2.0)
+    assert [(w.number, w.start, w.end, w.lead_in) for w in windows] == [
+        (1, 0, 2000, 0),
+        (2, 1000, 5000, 2000),
+        # The recording ends 1 s after this chapter starts.
+        (3, 7000, 10000, 2000),
+    ]
+
+
+def test_windows_without_a_known_length():
+    (window,) = preview.plan_windows(chapters(20000), 8000, None, 0.5)
+    assert (window.start, window.end, window.lead_in) == (156000, 164000, 4000)
+
+
+def test_cue_time():
+    assert preview.cue_time(0) == "00:00:00"
+    assert preview.cue_time(61.5) == "01:01:37"
+    # Rounded to the nearest 1/75 second
+    assert preview.cue_time(1.999) == "00:02:00"
+    assert preview.cue_time(3600) == "60:00:00"
+
+
+def test_write_cue(tmp_path):
+    windows = preview.plan_windows(chapters(0, 60000), 1000, None, 5.0)
+    previews = [
+        preview.Preview(window, "clip{}.mp3".format(window.number), 0)
+        for window in windows
+    ]
+    windows[1].chapter.text = 'The "good" part'
+    path = tmp_path / "previews.cue"
+    # The first preview is 5 s long, so the second starts there.
+    preview.write_cue(str(path), str(tmp_path / "previews.mp3"), previews, [0, 5], 1000)
+    assert path.read_text(encoding="utf-8") == (
+        "\ufeff"
+        'REM COMMENT "Chapter previews generated by PostShow v3"\n'
+        'FILE "previews.mp3" MP3\n'
+        "  TRACK 01 AUDIO\n"
+        '    TITLE "Chapter at 0"\n'
+        "    REM EPISODE_TIME 0:00:00.000\n"
+        "    INDEX 01 00:00:00\n"
+        "  TRACK 02 AUDIO\n"
+        '    TITLE "The _good_ part"\n'
+        "    REM EPISODE_TIME 0:01:00.000\n"
+        "    INDEX 00 00:05:00\n"
+        "    INDEX 01 00:10:00\n"
+    )
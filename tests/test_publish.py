@@ -0,0 +1,68 @@
+import array
+import json
+import os.path
+
+import finalize
+import model
+import mp3frames
+import publish
+
+
+def test_seek_index_round_trip(write_mp3):
+    index = mp3frames.FrameIndex.scan(write_mp3("episode.mp3", [64] * 100))
+    chapters = [
+        model.Chapter(0, 1000, text="Intro"),
+        model.Chapter(1000, 2600, text="Main"),
+    ]
+    data = publish.build_seek_index(index, 500, chapters)
+
+    header = publish.SEEK_INDEX_HEADER.unpack_from(data)
+    assert header == (
+        publish.SEEK_INDEX_MAGIC,
+        publish.SEEK_INDEX_VERSION,
+        1152,
+        44100,
+        mp3frames.ENCODER_DELAY,
+        500,
+        100 * 208,
+        100,
+        2,
+    )
+    table_start = publish.SEEK_INDEX_HEADER.size
+    offsets = array.array("I")
+    offsets.frombytes(data[table_start : table_start + 4 * 100])
+    assert list(offsets) == [500 + 208 * frame for frame in range(100)]
+
+    chapter_start = table_start + 4 * 100
+    second = publish.SEEK_INDEX_CHAPTER.unpack_from(
+        data, chapter_start + publish.SEEK_INDEX_CHAPTER.size
+    )
+    # (1 s * 44100 + 1105) // 1152
+    assert second == (1000, 39, 500 + 39 * 208)
+    assert len(data) == chapter_start + 2 * publish.SEEK_INDEX_CHAPTER.size
+
+
+def test_manifest(tmp_path):
+    metadata = model.EpisodeMetadata("12", "Staplers")
+    metadata.title = "OSW-12 Staplers"
+    mp3 = finalize.FileDigest(str(tmp_path / "osw-12.mp3"), 1000, "ab" * 32)
+    cue = finalize.FileDigest(str(tmp_path / "osw-12.cue"), 20, "cd" * 32)
+    manifest = publish.build_manifest(
+        metadata, "default", [mp3, cue], {mp3.path: 61000}
+    )
+    path = str(tmp_path / "osw-12.manifest.json")
+    publish.write_manifest(path, manifest)
+    with open(path, encoding="utf-8") as fp:
+        written = json.load(fp)
+    assert written == manifest
+    assert manifest["profile"] == "default"
+    assert manifest["episode"] == {"number": "12", "title": "OSW-12 Staplers"}
+    assert manifest["files"][0] == {
+        "name": "osw-12.mp3",
+        "type": "audio/mpeg",
+        "length": 1000,
+        "sha256": "ab" * 32,
+        "duration_ms": 61000,
+    }
+    assert "duration_ms" not in manifest["files"][1]
+    assert not os.path.exists(finalize.staging_path_for(path, "partial"))
@@ -0,0 +1,73 @@
+import pytest
+
+import mp3frames
+import splice
+
+
+def test_segment_without_lame_tag_loses_only_lames_delay(write_mp3):
+    segment = splice.load_segment(write_mp3("plain.mp3", [128] * 10))
+    assert segment.index.encoder_delay is None
+    assert segment.samples == 10 * 1152 - mp3frames.LAME_DELAY
+
+
+def test_low_bitrate_splice_still_gets_a_lame_tag(write_mp3, tmp_path):
+    # 48 Kbps stereo frames are too small to hold the tag themselves.
+    intro = splice.load_segment(write_mp3("intro.mp3", [48] * 4))
+    episode = splice.load_segment(write_mp3("episode.mp3", [48] * 20))
+    output = str(tmp_path / "joined.mp3")
+    index, samples = splice.splice([intro, episode], output)
+
+    joined = mp3frames.FrameIndex.scan(output)
+    assert len(joined) == 24
+    assert joined.bitrate == 48
+    assert not joined.variable
+    assert joined.encoder_delay == mp3frames.LAME_DELAY
+    assert joined.encoder_padding == index.encoder_padding
+    assert samples == 24 * 1152 - mp3frames.LAME_DELAY - index.encoder_padding
+    assert list(joined.offsets) == list(index.offsets)
+
+
+def test_chapters_move_past_the_intro(write_mp3, tmp_path):
+    pytest.importorskip("PySide6")
+    import configparser
+    import os.path
+
+    import main
+    import model
+
+    config_data = configparser.ConfigParser()
+    config_data.read(
+        os.path.join(os.path.dirname(__file__), "..", "data", "template_config.ini")
+    )
+    markers = tmp_path / "markers.txt"
+    markers.write_text("0.0\t10.0\tStart\n10.0\t20.0\tMiddle\n")
+    controller = main.Controller(config_data)
+    controller.set_profile("default")
+    controller.outdir = str(tmp_path)
+    controller.markers_file = str(markers)
+    controller.set_metadata(model.EpisodeMetadata("1", "Pilot"))
+    controller.build_chapters()
+
+    intro = splice.load_segment(write_mp3("intro.mp3", [64] * 40))
+    episode = splice.load_segment(write_mp3("episode.mp3", [64] * 800))
+    controller.staging_path = str(tmp_path / "joined.mp3")
+    controller.frame_index, _ = splice.splice([intro, episode], controller.staging_path)
+    controller.intro_frames = len(intro.index)
+    # As if the second chapter had been snapped to a frame
+    middle = controller.chapters[1]
+    middle.frame = mp3frames.nearest_frame(10000, controller.frame_index)
+    middle.end_frame = len(episode.index)
+    snapped_frame = middle.frame
+    controller.place_chapters()
+
+    # 40 frames of 1152 samples at 44.1 kHz
+    assert controller.chapters[0].start == 1045
+    assert controller.chapters[0].end == 11045
+    assert middle.frame == snapped_frame + 40
+    assert middle.end_frame == 840
+    assert middle.start == mp3frames.frame_start_ms(
+        middle.frame, controller.frame_index
+    )
+    assert middle.end == mp3frames.frame_start_ms(840, controller.frame_index)
+    with open(controller.build_output_file_path("txt"), encoding="utf-8") as fp:
+        assert fp.read().startswith("00:00:01 - Start\n00:00:11 - Middle")
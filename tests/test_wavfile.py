@@ -0,0 +1,123 @@
+import struct
+
+import pytest
+
+import wavfile
+from model import PostShowError
+
+# Four stereo 16-bit frames
+SAMPLES = struct.pack("<8h", 1, -1, 2, -2, 3, -3, 4, -4)
+FMT = struct.pack("<HHIIHH", wavfile.WAVE_FORMAT_PCM, 2, 8000, 32000, 4, 16)
+
+
+def chunk(chunk_id, data):
+    return chunk_id + struct.pack("<I", len(data)) + data + b"\0" * (len(data) % 2)
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_rf64_takes_the_data_length_from_ds64(tmp_path):
+    ds64 = struct.pack("<QQQI", 0, len(SAMPLES), 4, 0)
+    data = (
+        b"RF64"
+        + struct.pack("<I", wavfile.RF64_SIZE_UNSET)
+        + b"WAVE"
+        + chunk(b"ds64", ds64)
+        + chunk(b"fmt ", FMT)
+        + b"data"
+        + struct.pack("<I", wavfile.RF64_SIZE_UNSET)
+        + SAMPLES
+    )
+    wav = wavfile.WaveFile(write(tmp_path, "long.rf64", data))
+    assert (wav.channels, wav.sample_rate, wav.bits_per_sample) == (2, 8000, 16)
+    assert wav.frame_count == 4
+    assert b"".join(wav.iter_blocks()) == SAMPLES
+
+
+def test_unset_data_size_runs_to_the_end_of_the_file(tmp_path):
+    # What a recorder that crashed leaves behind; the odd byte isn't a frame.
+    data = (
+        b"RIFF"
+        + struct.pack("<I", 0)
+        + b"WAVE"
+        + chunk(b"bext", b"\0" * 3)
+        + chunk(b"fmt ", FMT)
+        + b"data"
+        + struct.pack("<I", wavfile.RF64_SIZE_UNSET)
+        + SAMPLES
+        + b"\0"
+    )
+    wav = wavfile.WaveFile(write(tmp_path, "crashed.wav", data))
+    assert wav.frame_count == 4
+    assert b"".join(wav.iter_blocks()) == SAMPLES
+
+
+def test_wave64(tmp_path):
+    def w64_chunk(guid, data):
+        return (
+            guid + struct.pack("<Q", 24 + len(data)) + data + b"\0" * (-len(data) % 8)
+        )
+
+    riff_size = 40 + 24 + 16 + 24 + len(SAMPLES)
+    data = (
+        wavfile.W64_RIFF
+        + struct.pack("<Q", riff_size)
+        + wavfile.W64_WAVE
+        + w64_chunk(wavfile.W64_FMT, FMT)
+        + w64_chunk(wavfile.W64_DATA, SAMPLES)
+    )
+    wav = wavfile.WaveFile(write(tmp_path, "long.w64", data))
+    assert (wav.channels, wav.sample_rate, wav.bits_per_sample) == (2, 8000, 16)
+    assert wav.data_offset == 40 + 24 + 16 + 24
+    assert b"".join(wav.iter_blocks()) == SAMPLES
+
+
+def test_not_a_wav_file(tmp_path):
+    with pytest.raises(PostShowError):
+        wavfile.WaveFile(write(tmp_path, "notes.wav", b"RIFF\0\0\0\0TEXTnotes"))
+
+
+def aiff(form_type, comm, samples):
+    def aiff_chunk(chunk_id, data):
+        return chunk_id + struct.pack(">I", len(data)) + data + b"\0" * (len(data) % 2)
+
+    # 8000 Hz, as an 80-bit extended-precision float
+    rate = struct.pack(">HQ", 16383 + 12, 8000 << (63 - 12))
+    ssnd = aiff_chunk(b"SSND", struct.pack(">II", 0, 0) + samples)
+    body = form_type + ssnd + aiff_chunk(b"COMM", comm[:8] + rate + comm[8:])
+    return b"FORM" + struct.pack(">I", len(body)) + body
+
+
+def test_aiff_samples_come_out_in_wav_layout(tmp_path):
+    # The sound data comes before the COMM chunk, which is allowed.
+    big_endian = struct.pack(">8h", 1, -1, 2, -2, 3, -3, 4, -4)
+    data = aiff(b"AIFF", struct.pack(">hIh", 2, 4, 16), big_endian)
+    wav = wavfile.WaveFile(write(tmp_path, "episode.aiff", data))
+    assert (wav.channels, wav.sample_rate, wav.bits_per_sample) == (2, 8000, 16)
+    assert wav.frame_count == 4
+    assert b"".join(wav.iter_blocks()) == SAMPLES
+
+
+def test_aiff_8_bit_samples_become_unsigned(tmp_path):
+    data = aiff(b"AIFF", struct.pack(">hIh", 1, 4, 8), bytes([0, 127, 128, 255]))
+    wav = wavfile.WaveFile(write(tmp_path, "episode.aif", data))
+    assert b"".join(wav.iter_blocks()) == bytes([128, 255, 0, 127])
+
+
+def test_aifc_little_endian(tmp_path):
+    comm = struct.pack(">hIh", 2, 4, 16) + b"sowt" + b"\0"
+    data = aiff(b"AIFC", comm, SAMPLES)
+    wav = wavfile.WaveFile(write(tmp_path, "episode.aifc", data))
+    assert not wav.big_endian
+    assert b"".join(wav.iter_blocks()) == SAMPLES
+
+
+def test_compressed_aifc_is_refused(tmp_path):
+    comm = struct.pack(">hIh", 2, 4, 16) + b"ima4" + b"\0"
+    data = aiff(b"AIFC", comm, SAMPLES)
+    with pytest.raises(PostShowError, match="ima4"):
+        wavfile.WaveFile(write(tmp_path, "episode.aifc", data))